@@ -1,3 +1,7 @@
+import datetime
+import numpy as np
+
+from TaxCalendar import tax_year, tax_year_bounds
 
 STATE_PENSION_2025 = (230.25/7)*365
 STATE_PENSION_2026 = 12500
@@ -8,69 +12,153 @@ def r_real(r_growth, r_inflation):
     """Calculate the real interest rate."""
     return (1 + r_growth) / (1 + r_inflation) - 1
 
+def _result(value):
+    """Plain float for scalar arguments, otherwise the broadcast array."""
+    return float(value) if np.ndim(value) == 0 else value
+
+def _nonzero(rate):
+    """Rate with zeros replaced by 1, to divide by where the zero-rate case is handled separately."""
+    return np.where(rate == 0, 1.0, rate)
+
 def annuity_factor(real_growth_rate, n_years):
-    """Calculate the annuity factor given growth rate, inflation rate, and number of years."""
-    if real_growth_rate == 0:
-        return n_years
-    return (1 -  (1 + real_growth_rate) ** (-n_years)) / real_growth_rate
+    """Calculate the annuity factor given growth rate, inflation rate, and number of years.
 
-def period_annuity_factor(real_growth_rate, n_start, n_end):
-    """Payments to be drawn from the pot in periods n_start to n_end."""
-    if n_start >= n_end:
+    Arguments may be scalars or NumPy arrays, which are broadcast together."""
+    r = np.asarray(real_growth_rate, dtype=float)
+    n = np.asarray(n_years, dtype=float)
+    factor = np.where(r == 0, n, (1 -  (1 + r) ** (-n)) / _nonzero(r))
+    return _result(factor)
+
+def _check_periods(n_start, n_end):
+    """Validate period ranges, for every element if given arrays."""
+    if np.any(np.asarray(n_start) >= np.asarray(n_end)):
         raise ValueError("n_start must be less than n_end")
-    if n_start < 0 or n_end < 0:
+    if np.any(np.asarray(n_start) < 0) or np.any(np.asarray(n_end) < 0):
         raise ValueError("n_start and n_end must be non-negative")
-    if n_start == 1:
-        return annuity_factor(real_growth_rate, n_end)
 
-    return annuity_factor(real_growth_rate, n_end) - annuity_factor(real_growth_rate, n_start-1)
-
-def annual_payment_in_arrears(real_growth_rate, n_years, present_value):
+def period_annuity_factor(real_growth_rate, n_start, n_end):
+    """Payments to be drawn from the pot in periods n_start to n_end."""
+    _check_periods(n_start, n_end)
+
+    # From period 1 this is just annuity_factor(n_end), as annuity_factor(0) is 0
+    return _result(annuity_factor(real_growth_rate, n_end) - annuity_factor(real_growth_rate, np.asarray(n_start)-1))
+
+def two_pension_phases(n_years, state_pension=state_pension):
+    """Phases with no state pension in years 1 to 3, one in years 4 and 5 and two from year 6."""
+    return [(1, 3, 0.0), (4, 5, state_pension), (6, n_years, 2*state_pension)]
+
+def _two_pension_payment(real_growth_rate, n_years, present_value, in_advance, state_pension):
+    """multi_phase_payment over two_pension_phases, for each of the years if given an array."""
+    if np.ndim(n_years) == 0:
+        rate = np.asarray(real_growth_rate, dtype=float)[..., None]
+        return multi_phase_payment(two_pension_phases(int(n_years), state_pension), rate, present_value, in_advance)
+
+    # The phases depend on the number of years, so take each number in turn
+    rate, years, pv = np.broadcast_arrays(np.asarray(real_growth_rate, dtype=float), n_years, np.asarray(present_value, dtype=float))
+    payment = np.empty(rate.shape)
+    for n in np.unique(years):
+        mask = years == n
+        payment[mask] = multi_phase_payment(two_pension_phases(int(n), state_pension), rate[mask][:, None], pv[mask], in_advance)
+    return payment
+
+def annual_payment_in_arrears(real_growth_rate, n_years, present_value, state_pension=state_pension):
     """Calculate the annual payment for an annuity, taking 2 state pensions into account."""
-
-    af_1_3 = period_annuity_factor(real_growth_rate, 1, 3)
-    # print(f"Period Annuity Factor (Years 1 to 3): {af_1_3:.4f}")
-
-    af_4_5 = period_annuity_factor(real_growth_rate, 4, 5)
-    # print(f"Period Annuity Factor (Years 4 to 5): {af_4_5:.4f}")
-
-    af_6_end = period_annuity_factor(real_growth_rate, 6, n_years)
-    # print(f"Period Annuity Factor (Years 6 to {n_years}): {af_6_end:.4f}")
-
-    return (present_value + af_4_5*state_pension + af_6_end*state_pension*2)/annuity_factor(real_growth_rate, n_years)
+    return _two_pension_payment(real_growth_rate, n_years, present_value, False, state_pension)
 
 def annuity_due_factor(real_growth_rate, n_years):
-    """Calculate the annuity due factor given growth rate, inflation rate, and number of years."""
-    if real_growth_rate == 0:
-        return n_years
-    return (1 -  (1 + real_growth_rate) ** (-n_years)) * (1 + real_growth_rate) / real_growth_rate
+    """Calculate the annuity due factor given growth rate, inflation rate, and number of years.
+
+    Arguments may be scalars or NumPy arrays, which are broadcast together."""
+    r = np.asarray(real_growth_rate, dtype=float)
+    n = np.asarray(n_years, dtype=float)
+    factor = np.where(r == 0, n, (1 -  (1 + r) ** (-n)) * (1 + r) / _nonzero(r))
+    return _result(factor)
 
 def period_annuity_due_factor(real_growth_rate, n_start, n_end):
     """Payments to be drawn from the pot in periods n_start to n_end."""
-    if n_start >= n_end:
-        raise ValueError("n_start must be less than n_end")
-    if n_start < 0 or n_end < 0:
-        raise ValueError("n_start and n_end must be non-negative")
-    if n_start == 1:
-        return annuity_due_factor(real_growth_rate, n_end)
+    _check_periods(n_start, n_end)
 
-    discount_factor = (1 + real_growth_rate) ** (n_start-1)
+    # From period 1 the discount factor is exactly 1
+    n_start = np.asarray(n_start, dtype=float)
+    discount_factor = (1 + np.asarray(real_growth_rate, dtype=float)) ** (n_start-1)
 
-    return annuity_due_factor(real_growth_rate, n_end-n_start+1) / discount_factor
+    return _result(annuity_due_factor(real_growth_rate, np.asarray(n_end)-n_start+1) / discount_factor)
 
-def annual_payment_in_advance(real_growth_rate, n_years, present_value):
+def annual_payment_in_advance(real_growth_rate, n_years, present_value, state_pension=state_pension):
     """Calculate the annual payment for an annuity, taking 2 state pensions into account."""
-
-    af_1_3 = period_annuity_due_factor(real_growth_rate, 1, 3)
-    # print(f"Period Annuity Factor (Years 1 to 3): {af_1_3:.4f}")
-
-    af_4_5 = period_annuity_due_factor(real_growth_rate, 4, 5)
-    # print(f"Period Annuity Factor (Years 4 to 5): {af_4_5:.4f}")
-
-    af_6_end = period_annuity_due_factor(real_growth_rate, 6, n_years)
-    # print(f"Period Annuity Factor (Years 6 to {n_years}): {af_6_end:.4f}")
-
-    return (present_value + af_4_5*state_pension + af_6_end*state_pension*2)/(af_1_3 + af_4_5 + af_6_end)
+    return _two_pension_payment(real_growth_rate, n_years, present_value, True, state_pension)
+
+def phase_factors(phases, real_growth_rates, in_advance=False):
+    """Annuity factors for a list of (start, end, income) phases covering years 1 to n.
+
+    real_growth_rates is a single rate, or an array whose last axis has one
+    rate per phase (or length 1 for the same rate throughout) with any leading
+    axes broadcast, so many rates can be evaluated at once. Each year
+    is discounted at the rate of the phase it falls in. Returns the factors
+    with the phases along the last axis."""
+    starts = np.array([p[0] for p in phases])
+    ends   = np.array([p[1] for p in phases])
+    if len(phases) == 0 or starts[0] != 1 or np.any(starts[1:] != ends[:-1] + 1) or np.any(ends < starts):
+        raise ValueError("Phases must be consecutive year ranges starting from year 1")
+
+    # Rate for each year from the rate of its phase
+    rates = np.asarray(real_growth_rates, dtype=float)
+    if rates.ndim == 0:
+        rates = rates[None]
+    rates = np.broadcast_to(rates, rates.shape[:-1] + (len(phases),))
+    year_phase = np.repeat(np.arange(len(phases)), ends - starts + 1)
+    discount = np.cumprod(1 / (1 + rates[..., year_phase]), axis=-1)
+
+    # Payments in advance are made a year earlier
+    if in_advance:
+        discount = np.concatenate((np.ones(discount.shape[:-1] + (1,)), discount[..., :-1]), axis=-1)
+
+    return np.add.reduceat(discount, starts - 1, axis=-1)
+
+def multi_phase_payment(phases, real_growth_rates, present_value, in_advance=False):
+    """Sustainable annual payment from a pot given external income in each phase.
+
+    phases is a list of (start, end, income) with consecutive years from 1,
+    where income (e.g. state pensions) reduces what must come from the pot.
+    Incomes, rates and present_value may be arrays broadcast over leading axes."""
+    factors = phase_factors(phases, real_growth_rates, in_advance)
+    income  = np.stack(np.broadcast_arrays(*[np.asarray(p[2], dtype=float) for p in phases]), axis=-1)
+    payment = (np.asarray(present_value, dtype=float) + np.sum(income * factors, axis=-1)) / np.sum(factors, axis=-1)
+    return _result(payment)
+
+def state_pension_phases(sp_dates, sp_ratios, start_year, n_years, state_pension=state_pension):
+    """Phases of state pension income for a household over tax years from start_year.
+
+    Each person's pension starts in the tax year of their spDate, with the
+    first year pro-rated as in the simulation, so that year is a phase of its
+    own. Dates are datetime.date or dd/mm/YYYY strings as in UserPortfolio."""
+    dates = [datetime.datetime.strptime(d, "%d/%m/%Y").date() if isinstance(d, str) else d for d in sp_dates]
+    first = tax_year(np.array(dates, dtype='datetime64[D]')) - start_year + 1
+
+    fractions = []
+    for d, year in zip(dates, first):
+        if year < 1:
+            fractions.append(1.0)
+        else:
+            fractions.append((tax_year_bounds(start_year + year - 1)[1] - d).days / 365)
+
+    # Income changes in the first (part) year of each pension and the year after
+    bounds = sorted({1} | {int(b) for year in first for b in (year, year + 1) if 1 < b <= n_years})
+    phases = []
+    for start, end in zip(bounds, bounds[1:] + [n_years + 1]):
+        income = 0.0
+        for year, ratio, fraction in zip(first, sp_ratios, fractions):
+            if start > year:
+                income += state_pension * ratio
+            elif start == year:
+                income += state_pension * ratio * fraction
+        phases.append((start, end - 1, income))
+    return phases
+
+def household_payment(portfolios, start_year, n_years, real_growth_rates, present_value, in_advance=False, state_pension=state_pension):
+    """Sustainable annual payment for the UserPortfolios of a household using their state pension dates."""
+    phases = state_pension_phases([p.spDate() for p in portfolios], [p.spRatio() for p in portfolios], start_year, n_years, state_pension)
+    return multi_phase_payment(phases, real_growth_rates, present_value, in_advance)
 
 
 if __name__ == '__main__':
@@ -95,12 +183,23 @@ if __name__ == '__main__':
     payment = annual_payment_in_advance(real_growth_rate, n_years, pot_size)
     print(f"Annual Payment (advance): {n_years} : {payment:.5f}")
 
-    exit(0)
+    # Same pot with state pensions from actual dates, over a range of rates
+    phases = state_pension_phases(['15/06/2028', '10/09/2031'], [1.0, 0.8], 2024, n_years)
+    print(f"Phases: {phases}")
+    rates = np.linspace(-0.02, 0.05, 8)[:, None]
+    for rate, payment in zip(rates[:, 0], multi_phase_payment(phases, rates, pot_size)):
+        print(f"Phased Payment (arrears): {rate:.4f} : {payment:.2f}")
+
+    # Payments over a grid of real growth rates, years and pot sizes in one call
+    rates = np.linspace(-0.02, 0.05, 100)[:, None, None]
+    years = np.arange(7, 107)[None, :, None]
+    pots  = np.linspace(500000, 3000000, 50)[None, None, :]
+    payments = annual_payment_in_arrears(rates, years, pots)
+    print(f"Payment grid {payments.shape}: {payments.min():.2f} to {payments.max():.2f}")
 
     print(f"Growth %,Inflation %,Payment")
-    for r_growth in range(3, 9):
-        for r_inflation in range(2, 8):
-            real_growth_rate = r_real(r_growth/100, r_inflation/100)
-            payment = annual_payment_in_arrears(real_growth_rate, n_years, pot_size)
-            print(f"{r_growth},{r_inflation},{payment:.2f}")
+    r_growth, r_inflation = np.meshgrid(np.arange(3, 9), np.arange(2, 8), indexing='ij')
+    payments = annual_payment_in_arrears(r_real(r_growth/100, r_inflation/100), n_years, pot_size)
+    for g, i, payment in zip(r_growth.ravel(), r_inflation.ravel(), payments.ravel()):
+        print(f"{g},{i},{payment:.2f}")
 
@@ -0,0 +1,339 @@
+# Benchmarks of loading portfolios and producing the reports
+#
+# write_synthetic_data() creates a HOME tree like the real one, at any scale:
+#   SecurityInfo/<sname>.json       one JSON definition per security, with divis
+#   SecurityInfo/Breakdown/<sname>  asset class and region breakdowns of funds
+#   AccountInfo/<user>.json         each user's details and accounts
+#   UserData/<u>_<platform>_<type>_<date>.csv   positions in each platform's format
+#
+# config works out its paths from HOME when it is imported, so to time the
+# synthetic data point HOME at it, e.g.
+#   python main.py bench-data -d /tmp/synth -s 500 -u 4
+#   HOME=/tmp/synth python main.py bench -o results.json [-c baseline.json]
+#
+# Results are saved as JSON so runs can be compared to catch regressions.
+
+import os
+import sys
+import json
+import time
+import platform
+import datetime
+import numpy as np
+
+# Security structures with the sectors, stype and payout frequencies used for them
+BENCH_STRUCTURES = {
+    'EQ':   {'stype': 'Share', 'freqs': 'QSA',
+             'sectors': ('Banks', 'Financials', 'UK Equity Income', 'UK All Companies', 'Technology & Telecommunications')},
+    'IT':   {'stype': 'Investment Trust', 'freqs': 'QQSM',
+             'sectors': ('Infrastructure', 'Global Equity Income', 'Real Estate Investment Trusts',
+                         'Debt - Loans & Bonds', 'UK Equity Income', 'Asia Pacific Income')},
+    'OEIC': {'stype': 'Fund', 'freqs': 'QSM',
+             'sectors': ('Global Equities', 'GBP Strategic Bond', 'Mixed Investment 40-85% Shares',
+                         'UK Smaller Companies', 'Global Property', 'Europe')},
+    'FP':   {'stype': 'Pension Fund', 'freqs': 'A',
+             'sectors': ('Mixed Investment 20-60% Shares', 'Global', 'With Profits', 'Global Bonds')},
+    'ETF':  {'stype': 'ETF', 'freqs': 'QM',
+             'sectors': ('Global Equities', 'Global Bonds', 'USD Index Linked', 'Gbl ETF Equity - Europe ex UK')},
+    'ETC':  {'stype': 'ETC', 'freqs': '',
+             'sectors': ('Commodities & Natural Resources',)},
+    'Cash': {'stype': 'Cash', 'freqs': 'M',
+             'sectors': ('Cash', 'Short Term Money Market')}
+}
+
+# Share of securities with each structure (cash accounts get their own as well)
+BENCH_MIX = {'EQ': 0.25, 'IT': 0.25, 'OEIC': 0.2, 'FP': 0.1, 'ETF': 0.12, 'ETC': 0.03, 'Cash': 0.05}
+
+BENCH_ASSETS  = ('Equity', 'Fixed Interest', 'Property', 'Cash', 'Other')
+BENCH_REGIONS = ('UK', 'North America', 'Europe ex UK', 'Japan', 'Asia Pacific ex Japan', 'Emerging Markets')
+
+# Accounts each user holds, and the structures held in each platform's accounts
+BENCH_ACCOUNTS = (('ISA', 'AJB'), ('Pens', 'AJB'), ('ISA', 'II'), ('Trd', 'II'), ('Pens', 'AV'), ('Sav', None))
+BENCH_HOLDINGS = {'AJB': ('EQ', 'IT', 'OEIC', 'ETF', 'ETC'), 'II': ('EQ', 'IT', 'ETF'), 'AV': ('FP',)}
+BENCH_CASH_PLATFORMS = ('GSM', 'NW', 'FSB', 'CSB', 'FD', 'NSI')
+
+BENCH_NAMES = ('Alex', 'Beth', 'Chris', 'Dana', 'Eddie', 'Fran', 'George', 'Hannah', 'Ian', 'Jo', 'Kim', 'Leo', 'Mia',
+               'Nick', 'Olivia', 'Pat', 'Quinn', 'Rob', 'Sam', 'Tom', 'Una', 'Vic', 'Will', 'Xander', 'Yasmin', 'Zoe')
+
+# Relative change in best time above which a step counts as a regression
+BENCH_THRESHOLD = 0.2
+
+
+def yyyymmdd(dt):
+    return dt.strftime("%Y%m%d")
+
+def split_percent(rng, n):
+    return np.round(rng.dirichlet(np.ones(n)) * 100.0, 2)
+
+# Recent dividends in the last year (the latest may not have been paid yet)
+def synthetic_divis(rng, freq, today, price, with_amount=True):
+    nPayments = {'A': 1, 'S': 2, 'Q': 4, 'M': 12}[freq]
+    period = 365 // nPayments
+    latest = today + datetime.timedelta(days=int(rng.integers(-period, 30)))
+    amount = price * rng.uniform(0.02, 0.08) / nPayments
+
+    prev = []
+    for k in range(nPayments):
+        payment = latest - datetime.timedelta(days=k * period)
+        exdiv = payment - datetime.timedelta(days=int(rng.integers(14, 42)))
+        divi = {'tag': "%s%d" % (freq, nPayments - k), 'ex-div': yyyymmdd(exdiv), 'payment': yyyymmdd(payment)}
+        if with_amount:
+            divi.update({'amount': round(float(amount), 3), 'unit': 'p'})
+        prev.append(divi)
+    return {'freq': freq, 'prev': sorted(prev, key=lambda d: d['payment'])}
+
+def synthetic_security(rng, n, structure, today):
+    info = BENCH_STRUCTURES[structure]
+    sname = "%s%03d" % (structure[:2].upper(), n)
+    price = float(np.round(rng.uniform(50.0, 3000.0), 2))
+    data = {
+        'sname':        sname,
+        'lname':        "Synthetic %s %d" % (info['stype'], n),
+        'stype':        info['stype'],
+        'structure':    structure,
+        'sector':       str(rng.choice(info['sectors'])),
+        'ISIN':         "GB00%07d%d" % (n, n % 10),
+        'info':         {'factsheet': "https://example.com/%s" % (sname)}
+    }
+
+    # Listed securities are also known by their exchange symbol, funds by SEDOL
+    if structure in ('EQ', 'IT', 'ETF', 'ETC'):
+        data['alias'] = sname + ".L"
+    else:
+        data['SEDOL'] = "B%06d" % (n)
+
+    freq = str(rng.choice(list(info['freqs']))) if info['freqs'] else None
+    if structure == 'Cash':
+        # Interest paid monthly on a set day
+        data['divis'] = {'freq': 'M', 'paydate': int(rng.integers(1, 29))}
+        data['fund-yield'] = round(float(rng.uniform(1.0, 5.0)), 2)
+    elif structure in ('OEIC', 'FP'):
+        # Funds are estimated from their yield
+        data['divis'] = synthetic_divis(rng, freq, today, price, with_amount=False)
+        data['fund-yield'] = round(float(rng.uniform(0.5, 6.0)), 2)
+        if rng.random() < 0.3:
+            aa = split_percent(rng, 6)
+            data['asset-allocation'] = dict(zip(('equity', 'bond', 'infrastructure', 'property', 'commodities', 'cash'),
+                                                aa.tolist()), asof=today.strftime("%d/%m/%Y"))
+    elif freq == 'M' and rng.random() < 0.2:
+        # Monthly payers without a list of payments have them generated
+        data['divis'] = {'freq': 'M', 'paydate': int(rng.integers(1, 29)),
+                         'start-date': yyyymmdd(today - datetime.timedelta(days=720))}
+        data['fund-yield'] = round(float(rng.uniform(2.0, 8.0)), 2)
+    elif freq is not None:
+        data['divis'] = synthetic_divis(rng, freq, today, price)
+
+    return data, price
+
+def breakdown_text(rng, today):
+    asof = today.strftime("%d/%m/%Y")
+    lines = ["ASSET CLASS BREAKDOWN (%s)" % (asof), "Rank\tAsset Class\tPercent"]
+    for rank, (asset, pc) in enumerate(zip(BENCH_ASSETS, split_percent(rng, len(BENCH_ASSETS))), 1):
+        lines.append("%d\t%s\t%.2f" % (rank, asset, pc))
+    lines += ["REGION BREAKDOWN (%s)" % (asof), "Rank\tRegion\tPercent"]
+    for rank, (region, pc) in enumerate(zip(BENCH_REGIONS, split_percent(rng, len(BENCH_REGIONS))), 1):
+        lines.append("%d\t%s\t%.2f" % (rank, region, pc))
+    return "\n".join(lines) + "\n"
+
+def money(value):
+    return "{0:,.2f}".format(value)
+
+# Platform CSV contents for a list of (security, price, quantity) holdings
+# plus cash, in the layout each platform's load_positions() reads
+def platform_csv(platformCode, holdings, cash):
+    rows = []
+    if platformCode == 'AJB':
+        # Prices in £, quantities and values as formatted text
+        rows.append('Investment,Quantity,Price,Value (£),Cost (£)')
+        for sec, price, qty in holdings:
+            value = qty * price / 100.0
+            if sec['structure'] in ('EQ', 'IT', 'ETF', 'ETC'):
+                inv = "%s (LSE:%s)" % (sec['lname'], sec['sname'])
+            else:
+                inv = "%s (FUND:%s)" % (sec['lname'], sec['SEDOL'])
+            rows.append('"%s","%s","%.4f","%s","%s"' % (inv, money(qty), price / 100.0, money(value), money(value * 0.9)))
+        rows.append('"Cash GBP","%s","1","%s","%s"' % (money(cash), money(cash), money(cash)))
+    elif platformCode == 'II':
+        rows.append('Symbol,Name,Qty,Price,Change,Change %,Market Value,Book Cost,Gain,Gain %,Weight,Currency')
+        for sec, price, qty in holdings:
+            value = qty * price / 100.0
+            rows.append('"%s","%s","%s","%.2fp","","","£%s","£%s","£%s","","","GBP"' % (
+                sec['sname'], sec['lname'], money(qty), price, money(value), money(value * 0.9), money(value * 0.1)))
+        rows.append('"Cash","Cash GBP","%.2f","1","","","£%s","£%s","£%s","","",""' % (cash, money(cash), money(cash), money(cash)))
+    elif platformCode == 'AV':
+        rows.append('Symbol,Qty,Price,Market Value')
+        for sec, price, qty in holdings:
+            rows.append('"%s","%s","%.2fp","£%s"' % (sec['sname'], money(qty), price, money(qty * price / 100.0)))
+    else:
+        # Savings accounts hold a single cash security priced at 100p
+        rows.append('Investment,Quantity,Price,Value (£),Cost (£)')
+        for sec, price, qty in holdings:
+            rows.append('%s,"%.2f","100","%.2f","%.2f"' % (sec['sname'], qty, qty, qty))
+    return "\n".join(rows) + "\n"
+
+# Write a synthetic HOME tree (see above) and return a summary of its size
+def write_synthetic_data(home, nSecurities=200, nUsers=2, nPositions=15, seed=1):
+    rng = np.random.default_rng(seed)
+    today = datetime.date.today()
+    secinfo = os.path.join(home, 'SecurityInfo')
+    accinfo = os.path.join(home, 'AccountInfo')
+    userdata = os.path.join(home, 'UserData')
+    for dirname in (secinfo, os.path.join(secinfo, 'Breakdown'), accinfo, userdata):
+        os.makedirs(dirname, exist_ok=True)
+
+    # Securities by structure, always including the 'Cash' held on platforms
+    securities = {s: [] for s in BENCH_STRUCTURES}
+    counts = np.maximum(1, np.round(np.array(list(BENCH_MIX.values())) * nSecurities).astype(int))
+    n = 0
+    for structure, count in zip(BENCH_MIX, counts):
+        for i in range(count):
+            n += 1
+            securities[structure].append(synthetic_security(rng, n, structure, today))
+    cash = {'sname': 'Cash', 'lname': 'Cash', 'stype': 'Cash', 'structure': 'Cash', 'sector': 'Cash'}
+    securities['Cash'].append((cash, 100.0))
+
+    for structure in securities:
+        for sec, price in securities[structure]:
+            with open(os.path.join(secinfo, "%s.json" % (sec['sname'])), 'w') as fp:
+                json.dump(sec, fp, indent=4)
+            if structure in ('IT', 'OEIC', 'FP', 'ETF'):
+                with open(os.path.join(secinfo, 'Breakdown', sec['sname']), 'w', encoding='utf-8') as fp:
+                    fp.write(breakdown_text(rng, today))
+
+    savings = [s for s in securities['Cash'] if s[0]['sname'] != 'Cash']
+    nAccounts = nHoldings = 0
+    dt = yyyymmdd(today)
+    for u in range(min(nUsers, len(BENCH_NAMES))):
+        username = BENCH_NAMES[u]
+        usercode = username[:1]
+        dob = datetime.date(1955 + int(rng.integers(0, 15)), int(rng.integers(1, 13)), int(rng.integers(1, 29)))
+        defn = {
+            'user':         username,
+            'id':           str(u + 1),
+            'dob':          dob.strftime("%d/%m/%Y"),
+            'spDate':       dob.replace(year=dob.year + 67).strftime("%d/%m/%Y"),
+            'spRatio':      round(float(rng.uniform(0.7, 1.0)), 2),
+            'drawdownPens': 0.04,
+            'drawdownISA':  0.035,
+            'drawdownTrd':  0.035,
+            'spShortfall':  "Yes" if u == 0 else "No",
+            'savShortfall': "Yes",
+            'accounts':     []
+        }
+
+        for accountType, platformCode in BENCH_ACCOUNTS:
+            if platformCode is None:
+                platformCode = BENCH_CASH_PLATFORMS[u % len(BENCH_CASH_PLATFORMS)]
+                sec, price = savings[u % len(savings)] if savings else securities['Cash'][-1]
+                holdings = [(sec, 100.0, float(np.round(rng.uniform(5000, 50000), 2)))]
+            else:
+                eligible = [s for structure in BENCH_HOLDINGS[platformCode] for s in securities[structure]]
+                chosen = rng.choice(len(eligible), size=min(nPositions, len(eligible)), replace=False)
+                holdings = [(eligible[i][0], eligible[i][1], float(np.round(rng.uniform(10000, 60000) * 100.0 / eligible[i][1])))
+                            for i in chosen]
+
+            filename = "%s_%s_%s_%s.csv" % (usercode, platformCode, accountType, dt)
+            with open(os.path.join(userdata, filename), 'w', encoding='utf-8') as fp:
+                fp.write(platform_csv(platformCode, holdings, float(np.round(rng.uniform(1000, 20000), 2))))
+
+            defn['accounts'].append({'acctype': accountType, 'platform': platformCode, 'status': 'active'})
+            nAccounts += 1
+            nHoldings += len(holdings)
+
+        with open(os.path.join(accinfo, "%s.json" % (username)), 'w') as fp:
+            json.dump(defn, fp, indent=4)
+
+    return {'securities': sum(len(s) for s in securities.values()), 'users': min(nUsers, len(BENCH_NAMES)),
+            'accounts': nAccounts, 'positions': nHoldings}
+
+
+# (name, function) for every step timed, given the loaded data
+def benchmark_steps(secu, uport, securityInfo, accountInfo, nYears=30):
+    from SecurityClasses import SecurityUniverse
+    from PortfolioClasses import UserPortfolioGroup
+    from SimulationClasses import Simulation, sim_persons
+    from SimulationConfig import SimConfig
+    from TaxCalendar import tax_year
+    from wb_bysecurity import WsEstimatedIncome
+
+    positions = uport.positions()
+    startYear = int(tax_year(datetime.date.today()))
+
+    steps = [
+        ('load securities',     lambda: SecurityUniverse(securityInfo)),
+        ('load portfolios',     lambda: UserPortfolioGroup(secu, accountInfo)),
+        ('tdl_security_detail', lambda: [s.tdl_security_detail() for s in secu.securities().values()]),
+    ]
+
+    # Every tdl_* report of the portfolios, with the arguments the views use
+    args = {'tdl_position_assetclass_value': (None, None, None, 'equity'),
+            'tdl_position_riskbucket_value': (None, None, None, 'High')}
+    for name in sorted(dir(uport)):
+        if name.startswith('tdl_') and not name.endswith('_general'):
+            steps.append((name, lambda fn=getattr(uport, name), a=args.get(name, ()): fn(*a)))
+
+    steps += [
+        ('projected_income',    lambda: WsEstimatedIncome(None, 52).projected_income(positions, secu)),
+        ('simulation %d years' % (nYears), lambda: Simulation(startYear, nYears, sim_persons(uport), SimConfig())),
+    ]
+    return steps
+
+def time_steps(steps, repeat=5, echo=None):
+    results = {}
+    for name, fn in steps:
+        times = []
+        for n in range(repeat):
+            t0 = time.perf_counter()
+            fn()
+            times.append(time.perf_counter() - t0)
+        results[name] = {'best_ms': 1000 * min(times), 'mean_ms': 1000 * sum(times) / len(times), 'runs': repeat}
+        if echo is not None:
+            echo(name, results[name])
+    return results
+
+def benchmark_results(steps, data, repeat=5, echo=None):
+    return {
+        'created':  datetime.datetime.now().isoformat(timespec='seconds'),
+        'python':   platform.python_version(),
+        'machine':  platform.machine(),
+        'data':     data,
+        'steps':    time_steps(steps, repeat, echo)
+    }
+
+def save_results(results, filename):
+    with open(filename, 'w') as fp:
+        json.dump(results, fp, indent=2)
+
+def load_results(filename):
+    with open(filename, 'r') as fp:
+        return json.load(fp)
+
+# (name, baseline ms, current ms, relative change, regressed) for the steps
+# in both runs, compared on best times
+def compare_results(current, baseline, threshold=BENCH_THRESHOLD):
+    rows = []
+    for name, result in current['steps'].items():
+        if name not in baseline['steps']:
+            continue
+        before = baseline['steps'][name]['best_ms']
+        after = result['best_ms']
+        change = (after - before) / before if before > 0 else 0.0
+        rows.append((name, before, after, change, change > threshold))
+    return rows
+
+
+if __name__ == '__main__':
+
+    # Generate a small tree and time it (HOME must be set before config is imported)
+    home = sys.argv[1] if len(sys.argv) > 1 else os.path.join('/tmp', 'foreverFund-bench')
+    print(write_synthetic_data(home))
+    os.environ['HOME'] = home
+
+    from SecurityClasses import SecurityUniverse
+    from PortfolioClasses import UserPortfolioGroup
+    from config import SECURITYINFO, ACCOUNTINFO
+
+    secu = SecurityUniverse(SECURITYINFO)
+    uport = UserPortfolioGroup(secu, ACCOUNTINFO)
+    steps = benchmark_steps(secu, uport, SECURITYINFO, ACCOUNTINFO)
+    benchmark_results(steps, {}, 3, lambda name, r: print(f"{name:<32} {r['best_ms']:>9.1f} {r['mean_ms']:>9.1f}"))
@@ -5,6 +5,8 @@ import logging
 
 from decimal import Decimal
 
+import numpy as np
+
 from config import SECURITYINFO
 
 # ASSET CLASS BREAKDOWN (DD/MM/YYYY)
@@ -29,6 +31,27 @@ def truncate_decimal(value, decimal_places=2):
     
     return truncated
 
+# Array version of float(truncate_decimal(value)). Values such as 1.13 are
+# really 1.12999... so the product with the scale can round up to a whole
+# number of pence. The rounding error of the product is found exactly in
+# float64 (Dekker's two-product, the same on every platform) and, where the
+# product came out whole, used to step back towards zero as Decimal would.
+def truncate_decimal_array(values, decimal_places=2):
+    values = np.asarray(values, dtype=float)
+    scale = float(10 ** decimal_places)
+    product = values * scale
+
+    split = lambda a: (a * 134217729.0 - (a * 134217729.0 - a))
+    vh, sh = split(values), split(scale)
+    vl, sl = values - vh, scale - sh
+    error = ((vh * sh - product) + vh * sl + vl * sh) + vl * sl
+
+    truncated = np.trunc(product)
+    whole = truncated == product
+    truncated = np.where(whole & (product > 0) & (error < 0), truncated - 1, truncated)
+    truncated = np.where(whole & (product < 0) & (error > 0), truncated + 1, truncated)
+    return truncated / scale
+
 
 class Breakdown():
     def __init__(self,name):
@@ -0,0 +1,65 @@
+# Generation of the data the reports are built from
+#
+# The securities and portfolios are loaded from the files under SECURITYINFO,
+# ACCOUNTINFO and USERDATA. Each time they are reloaded the files are listed
+# (name, size and mtime, no contents read) and, if anything has changed since
+# the last load, the generation goes up by one. A report built from the same
+# generation with the same filters is the same page, so the generation and
+# the newest file mtime give the ETag and Last-Modified for HTTP caching.
+
+import os
+import hashlib
+import logging
+import threading
+
+
+class DataGeneration:
+    def __init__(self, dirnames):
+        self._dirnames = tuple(dirnames)
+        self._generation = 0
+        self._signature = None
+        self._last_modified = None
+        self._lock = threading.Lock()
+
+    # Signature of all the input files and the newest mtime (None if no files)
+    def scan(self):
+        entries = []
+        newest = None
+        for dirname in self._dirnames:
+            for root, dirs, files in os.walk(dirname):
+                for filename in files:
+                    try:
+                        st = os.stat(os.path.join(root, filename))
+                    except OSError:
+                        continue
+                    entries.append("%s|%d|%d" % (os.path.join(root, filename), st.st_mtime_ns, st.st_size))
+                    if newest is None or st.st_mtime > newest:
+                        newest = st.st_mtime
+        signature = hashlib.sha1("\n".join(sorted(entries)).encode('utf-8')).hexdigest()
+        return signature, newest
+
+    # Reload the data with reload() (if given) and move on a generation if the
+    # files have changed. The files are listed first, so any change made while
+    # reloading is picked up next time.
+    def update(self, reload=None):
+        signature, newest = self.scan()
+        if reload is not None:
+            reload()
+        with self._lock:
+            if signature != self._signature:
+                self._signature = signature
+                self._last_modified = newest
+                self._generation += 1
+                logging.debug(f"DataGeneration: generation {self._generation}")
+            return self._generation
+
+    def generation(self):
+        return self._generation
+
+    # Signature of the files last loaded, the same across restarts of the app
+    def signature(self):
+        return self._signature
+
+    # Newest mtime (seconds since the epoch) of the files last loaded
+    def last_modified(self):
+        return self._last_modified
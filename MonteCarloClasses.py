@@ -0,0 +1,310 @@
+# Monte Carlo version of the retirement simulation
+#
+# Runs the same drawdown and tax rules as Simulation/SimYear/SimPerson, but for
+# many stochastic paths of portfolio growth and inflation at once. Every value
+# is held in a NumPy array shaped (paths, years) or (paths, years, persons) and
+# each simulation year is a handful of array operations across all paths.
+# With zero volatility every path reproduces the deterministic Simulation.
+# Living expenses and drawdown rates can also be scaled per path, so each path
+# can try different values (see SimulationSolver.py).
+
+import logging
+import numpy as np
+import pandas as pd
+
+from TaxCalendar import tax_year_bounds
+from SimulationClasses import pension_fraction, income_tax, sim_schedules, SIM_FIELDS, SIM_POTS
+
+from SimulationConfig import SimConfig
+
+# Asset pots held by each person
+MC_POTS = SIM_POTS
+
+# Values recorded for each person in each year (as in SimPerson)
+MC_FIELDS = SIM_FIELDS
+
+MC_PERCENTILES = (5, 25, 50, 75, 95)
+
+# Remaining required income (in £) below which a year counts as fully funded
+MC_SHORTFALL_TOLERANCE = 1.0
+
+
+class MonteCarloSimulation:
+    # expenseScale and drawdownScale multiply the living expenses and every
+    # drawdown rate, either for all paths or one value per path. With a
+    # stopTolerance the run stops once every path has failed (as failures()
+    # with that tolerance), leaving the later years as NaN.
+    def __init__(self, startYear, nYears, persons, nPaths=1000,
+                 growthVol=0.0, inflationVol=0.0, seed=None, config=None,
+                 expenseScale=1.0, drawdownScale=1.0, stopTolerance=None):
+        self._startYear = startYear
+        self._nYears = nYears
+        self._persons = persons
+        self._ids = sorted(persons.keys())
+        self._nPaths = nPaths
+        self._config = SimConfig() if config is None else config
+        self._expenseScale = np.broadcast_to(np.asarray(expenseScale, dtype=float), (nPaths,))
+        self._drawdownScale = np.broadcast_to(np.asarray(drawdownScale, dtype=float), (nPaths,))
+        self._stopTolerance = stopTolerance
+
+        self._rng = np.random.default_rng(seed)
+        self._growth, self._cpi, self._rpi = self.scenarios(growthVol, inflationVol)
+        self._inflationVol = inflationVol
+
+        self.run()
+
+    def firstYear(self):
+        return self._startYear
+
+    def lastYear(self):
+        return self.firstYear() + self._nYears - 1
+
+    def years(self):
+        return np.arange(self.firstYear(), self.lastYear() + 1)
+
+    def persons(self):
+        return self._persons
+
+    def nPaths(self):
+        return self._nPaths
+
+    def config(self):
+        return self._config
+
+    # Annual portfolio growth, CPI and RPI for each path and year. CPI and RPI
+    # share the same inflation shock.
+    def scenarios(self, growthVol, inflationVol):
+        shape = (self._nPaths, self._nYears)
+        growth = self._config.get_portfolioGrowth() + growthVol * self._rng.standard_normal(shape)
+        shock  = inflationVol * self._rng.standard_normal(shape)
+        cpi = self._config.get_CPI() + shock
+        rpi = self._config.get_RPI() + shock
+        return growth, cpi, rpi
+
+    #--- Values for each path and year (as SimYear)
+
+    def year_schedules(self):
+        conf = self._config
+        shape = (self._nPaths, self._nYears)
+        names = ('livingExpenses', 'livingExpenses1', 'livingExpenses2', 'fullStatePension',
+                 'tuiPension', 'taxFreeAmount', 'basicRateAmount')
+
+        # Without inflation shocks every path has the deterministic schedules
+        if self._inflationVol == 0:
+            base = sim_schedules(conf, self.firstYear(), self._nYears)
+            return {k: np.tile(base[k], (self._nPaths, 1)) for k in names}
+
+        sched = {k: np.zeros(shape) for k in names}
+
+        for t, year in enumerate(self.years()):
+            if t == 0:
+                sched['livingExpenses1'][:, t] = conf.get_livingExpenses1()
+                sched['livingExpenses2'][:, t] = conf.get_livingExpenses2()
+                sched['fullStatePension'][:, t] = conf.fullStatePension
+            else:
+                sched['livingExpenses1'][:, t] = sched['livingExpenses1'][:, t-1] * (1 + self._rpi[:, t])
+                sched['livingExpenses2'][:, t] = sched['livingExpenses2'][:, t-1] * (1 + self._rpi[:, t])
+                sched['fullStatePension'][:, t] = sched['fullStatePension'][:, t-1] * (1 + self._cpi[:, t])
+
+            if year < 2024:
+                sched['tuiPension'][:, t] = 0.0
+            elif year == 2024 or t == 0:
+                sched['tuiPension'][:, t] = conf.tuiPension
+            else:
+                sched['tuiPension'][:, t] = sched['tuiPension'][:, t-1] * 1.025
+
+            if year < self.firstYear() + conf.get_expensiveYears():
+                sched['livingExpenses'][:, t] = sched['livingExpenses1'][:, t]
+            else:
+                sched['livingExpenses'][:, t] = sched['livingExpenses2'][:, t]
+
+            if year < 2026 or t == 0:
+                sched['taxFreeAmount'][:, t] = conf.taxFreeAmount
+                sched['basicRateAmount'][:, t] = conf.basicRateAmount
+            else:
+                sched['taxFreeAmount'][:, t] = sched['taxFreeAmount'][:, t-1] * (1 + self._cpi[:, t])
+                sched['basicRateAmount'][:, t] = sched['basicRateAmount'][:, t-1] * (1 + self._cpi[:, t])
+
+        return sched
+
+    # Fraction of a year's state and TUI pension payable in each year for each person
+    def pension_schedules(self):
+        shape = (self._nYears, len(self._ids))
+        spFraction  = np.zeros(shape)
+        tuiFraction = np.zeros(shape)
+        spDates  = [self._persons[id].spDate() for id in self._ids]
+        tuiDates = [self._persons[id].tuiDate() for id in self._ids]
+        for t, year in enumerate(self.years()):
+            start, end = tax_year_bounds(year)
+            for i in range(len(self._ids)):
+                spFraction[t, i] = pension_fraction(spDates[i], start, end)
+                if tuiDates[i] is not None:
+                    tuiFraction[t, i] = pension_fraction(tuiDates[i], start, end)
+        return spFraction, tuiFraction
+
+    def incomeTax(self, grossAmount, taxFreeAmount, basicRateAmount):
+        return income_tax(grossAmount, taxFreeAmount, basicRateAmount, self._config.taxrateBasic, self._config.taxrateHigh)
+
+    #--- Run all paths
+
+    def run(self):
+        nPaths, nYears, nPersons = self._nPaths, self._nYears, len(self._ids)
+        sched = self.year_schedules()
+        spFraction, tuiFraction = self.pension_schedules()
+
+        fin = {k: np.zeros((nPaths, nYears, nPersons)) for k in MC_FIELDS}
+        shortfall = np.zeros((nPaths, nYears))
+        failed = np.zeros(nPaths, dtype=bool)
+
+        # Assets at the start of the simulation
+        assets = {}
+        for ptype, atype in zip(MC_POTS, ('Pens', 'ISA', 'Trd', 'Sav')):
+            assets[ptype] = np.tile([self._persons[id].assets()[atype] for id in self._ids], (nPaths, 1)).astype(float)
+
+        for t in range(nYears):
+            fullSP = sched['fullStatePension'][:, t]
+            requiredIncome = sched['livingExpenses'][:, t] * self._expenseScale
+
+            for i, id in enumerate(self._ids):
+                person = self._persons[id]
+                aPn, aISA, aTrd, aSav = (assets[p][:, i] for p in MC_POTS)
+
+                # Taxable income from state, DB and DC pensions
+                spAmount = fullSP * person.spRatio() * spFraction[t, i]
+                dbPens   = sched['tuiPension'][:, t] * tuiFraction[t, i]
+
+                drawdownAmount = person.drawdownPens() * self._drawdownScale * aPn
+                spTopUp = np.zeros(nPaths)
+                if person.spShortfall() == "Yes":
+                    spTopUp = np.where(spAmount < fullSP, fullSP - spAmount, 0.0)
+                dcPens = drawdownAmount + spTopUp
+                aPn = aPn - dcPens
+
+                taxableIncome = spAmount + dbPens + dcPens
+                taxPayable = self.incomeTax(taxableIncome, sched['taxFreeAmount'][:, t], sched['basicRateAmount'][:, t])
+                targetIncome = requiredIncome - (taxableIncome - taxPayable)
+
+                # Tax-free income from ISA and trading accounts, savings for any shortfall
+                isaAmount = person.drawdownISA() * self._drawdownScale * aISA
+                aISA = aISA - isaAmount
+                targetIncome = targetIncome - isaAmount
+
+                trdAmount = person.drawdownTrd() * self._drawdownScale * aTrd
+                aTrd = aTrd - trdAmount
+                targetIncome = targetIncome - trdAmount
+
+                savAmount = np.zeros(nPaths)
+                if person.savShortfall() == "Yes":
+                    savAmount = np.where(targetIncome > 0, np.where(targetIncome < aSav, targetIncome, aSav), 0.0)
+                    aSav = aSav - savAmount
+
+                taxfreeIncome = isaAmount + trdAmount + savAmount
+
+                # Allow for growth of each portfolio type to give year-end total
+                aPn  = aPn * (1 + self._growth[:, t])
+                aISA = aISA * (1 + self._growth[:, t])
+
+                income = taxfreeIncome + taxableIncome - taxPayable
+                requiredIncome = requiredIncome - income
+
+                for k, v in (('aPn', aPn), ('aISA', aISA), ('aTrd', aTrd), ('aSav', aSav),
+                             ('pensSP', spAmount), ('pensDB', dbPens), ('pensDC', dcPens),
+                             ('pensDC.DD', drawdownAmount), ('pensDC.spTU', spTopUp),
+                             ('taxable', taxableIncome), ('tax', taxPayable),
+                             ('iISA', isaAmount), ('iTrd', trdAmount), ('iSav', savAmount),
+                             ('taxfree', taxfreeIncome), ('_income', income)):
+                    fin[k][:, t, i] = v
+
+                for p, v in zip(MC_POTS, (aPn, aISA, aTrd, aSav)):
+                    assets[p][:, i] = v
+
+            shortfall[:, t] = requiredIncome
+
+            if self._stopTolerance is not None:
+                failed |= (requiredIncome > self._stopTolerance) | np.any([assets[p] < 0 for p in MC_POTS], axis=(0, 2))
+                if failed.all():
+                    for v in fin.values():
+                        v[:, t+1:] = np.nan
+                    shortfall[:, t+1:] = np.nan
+                    break
+
+        self._sched = sched
+        self._spFraction = spFraction
+        self._tuiFraction = tuiFraction
+        self._fin = fin
+        self._shortfall = shortfall
+
+    #--- Results
+
+    # Per path/year values (living expenses, thresholds, pensions) and the
+    # per year/person state and TUI pension fractions used by run()
+    def schedules(self):
+        return self._sched, self._spFraction, self._tuiFraction
+
+    # Array shaped (paths, years, persons) for one of MC_FIELDS
+    def values(self, field):
+        return self._fin[field]
+
+    # Income still required after all persons' income, shaped (paths, years)
+    def shortfall(self):
+        return self._shortfall
+
+    def living_expenses(self):
+        return self._sched['livingExpenses']
+
+    # Paths where every year's living expenses were met
+    def successful_paths(self, tolerance=MC_SHORTFALL_TOLERANCE):
+        return np.all(self._shortfall <= tolerance, axis=1)
+
+    def success_probability(self, tolerance=MC_SHORTFALL_TOLERANCE):
+        return float(np.mean(self.successful_paths(tolerance)))
+
+    # Years in which living expenses weren't met or a pot was overdrawn at the
+    # end of the year, shaped (paths, years)
+    def failures(self, tolerance=MC_SHORTFALL_TOLERANCE):
+        overdrawn = np.any([self._fin[p] < 0 for p in MC_POTS], axis=(0, 3))
+        return (self._shortfall > tolerance) | overdrawn
+
+    # Year-end value of a pot summed over persons ('Total' for all pots), shaped (paths, years)
+    def pot_values(self, pot):
+        if pot == 'Total':
+            return sum(self._fin[p].sum(axis=2) for p in MC_POTS)
+        return self._fin[pot].sum(axis=2)
+
+    # Percentiles of each pot across paths by year, one row per year and pot
+    def percentile_bands(self, percentiles=MC_PERCENTILES):
+        rows = []
+        for pot in MC_POTS + ('Total',):
+            bands = np.percentile(self.pot_values(pot), percentiles, axis=0)
+            for t, year in enumerate(self.years()):
+                row = {'Year': year, 'Pot': pot}
+                for pc, band in zip(percentiles, bands):
+                    row[f"P{pc}"] = band[t]
+                rows.append(row)
+        return pd.DataFrame(rows)
+
+    def __repr__(self):
+        s = "MonteCarloSimulation(paths=%d years=%d-%d success=%.1f%%)\n" % (
+            self._nPaths, self.firstYear(), self.lastYear(), 100 * self.success_probability())
+        s += self.percentile_bands().to_string(index=False, float_format=lambda x: "%.0f" % x)
+        return s
+
+
+if __name__ == '__main__':
+
+    from SecurityClasses import SecurityUniverse
+    from PortfolioClasses import UserPortfolioGroup
+    from SimulationClasses import sim_persons
+    from config import SECURITYINFO, ACCOUNTINFO
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    secu = SecurityUniverse(SECURITYINFO)
+    pgrp = UserPortfolioGroup(secu, ACCOUNTINFO)
+
+    persons = sim_persons(pgrp)
+
+    # 5000 paths over 30 years, 12% growth and 1.5% inflation volatility
+    sim = MonteCarloSimulation(2022, 30, persons, nPaths=5000, growthVol=0.12, inflationVol=0.015, seed=1)
+
+    print(sim)
@@ -0,0 +1,98 @@
+# Cache of rendered report pages
+#
+# A report page only depends on the data loaded, the session filters and
+# the page requested, so once rendered it can be served again without
+# building the report or rendering the template. Pages are kept in memory
+# (least recently used first out, up to a total size in bytes) and, if a
+# directory is given, saved there so they survive a restart. Pages saved on
+# disk are grouped by the signature of the data files they were built
+# from, and those for older data are removed when pages for new data are
+# saved.
+
+import os
+import re
+import shutil
+import logging
+import threading
+from cachetools import LRUCache
+
+from atomicfile import atomic_write
+
+# Total size of the pages kept in memory (bytes)
+PAGE_CACHE_BYTES = 32 * 1024 * 1024
+
+
+class PageCache:
+    def __init__(self, directory=None, maxbytes=PAGE_CACHE_BYTES):
+        self._dirname = directory
+        self._cache = LRUCache(maxsize=maxbytes, getsizeof=lambda html: len(html.encode('utf-8')))
+        self._lock = threading.Lock()
+        self._current = None
+
+    def path(self, signature, key):
+        if self._dirname is None or signature is None:
+            return None
+        return os.path.join(self._dirname, signature[:16], f"{key}.html")
+
+    # Page from memory or disk, None if it isn't cached
+    def get(self, signature, key):
+        with self._lock:
+            html = self._cache.get((signature, key))
+        if html is not None:
+            return html
+
+        path = self.path(signature, key)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            with open(path, 'r', encoding='utf-8') as fp:
+                html = fp.read()
+        except OSError as e:
+            logging.debug(f"PageCache.get({path}) {e}")
+            return None
+
+        self.remember(signature, key, html)
+        return html
+
+    def remember(self, signature, key, html):
+        with self._lock:
+            try:
+                self._cache[(signature, key)] = html
+            except ValueError:
+                # Page bigger than the whole cache
+                pass
+
+    # Save a page built from the data with the given signature. current is the
+    # signature of the data loaded now (if known): pages for older data are
+    # only removed from disk when saving pages for the current data, so a
+    # request which started before a refresh can't remove the newer pages.
+    def put(self, signature, key, html, current=None):
+        self.remember(signature, key, html)
+
+        path = self.path(signature, key)
+        if path is None:
+            return
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with self._lock:
+                if signature != self._current and (current is None or signature == current):
+                    self._current = signature
+                    self.prune(os.path.basename(os.path.dirname(path)))
+            with atomic_write(path, encoding='utf-8') as fp:
+                fp.write(html)
+        except OSError as e:
+            logging.warning(f"PageCache.put({path}) {e}")
+
+    # Remove pages saved for data other than that in subdirectory 'keep'
+    def prune(self, keep):
+        for name in os.listdir(self._dirname):
+            full_path = os.path.join(self._dirname, name)
+            if name != keep and os.path.isdir(full_path) and re.fullmatch(r'[0-9a-f]{16}', name):
+                shutil.rmtree(full_path, ignore_errors=True)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._cache)
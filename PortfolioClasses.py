@@ -8,6 +8,8 @@ import logging
 from SecurityClasses import SecurityUniverse
 from AccountClasses import Account, AccountGroup
 from Breakdown import parent_sector_list
+from TaxCalendar import date_buckets, month_abbr
+from metrics import timed
 
 class UserPortfolio():
     def __init__(self, secu, username, defn):
@@ -123,6 +125,7 @@ class UserPortfolioGroup():
         self._rootdir = AccountInfo
         self.refresh(secu)
 
+    @timed('uport.refresh')
     def refresh(self, secu):
         self._portfolios = {}
 
@@ -503,29 +506,33 @@ class UserPortfolioGroup():
         ythis = datetime.datetime.today().strftime('%Y')
         total = 0.0
 
+        # Calendar buckets for all event dates in one lookup
+        dates = sorted(events.keys(), reverse=False)
+        buckets = date_buckets(dates)
+        years  = buckets['year'].astype(str).tolist()
+        months = buckets['month_abbr'].tolist()
+        mkeys  = buckets['yyyymm'].astype(str).tolist()
+        vdates = ["%02d-%s-%s" % (d, m, y) for d, m, y in zip(buckets['day'], months, years)]
+
         currentYear = currentMonth = None
-        for dt in sorted(events.keys(), reverse=False):
+        for i, dt in enumerate(dates):
             dispYear = dispMonth = None
-            try:
-                divYear = datetime.datetime.strptime(dt, '%Y%m%d').strftime('%Y')
-            except:
-                logging.error("Bad Date '%s'", dt)
-                divYear = datetime.datetime.strptime(dt, '%Y%m%d').strftime('%Y')
+            divYear = years[i]
             if currentYear is None or currentYear != divYear:
                 dispYear = currentYear = divYear
-            divMonth = datetime.datetime.strptime(dt, '%Y%m%d').strftime('%b')
+            divMonth = months[i]
             if currentMonth is None or currentMonth != divMonth:
                 dispMonth = currentMonth = divMonth
 
             # Total for YYYYMM
-            mkey = datetime.datetime.strptime(dt, '%Y%m%d').strftime('%Y%m')
+            mkey = mkeys[i]
             if mkey not in ymtotals.keys():
                 ymtotals[mkey] = 0.0
             if currentMonth not in mtotals.keys():
                 mtotals[currentMonth] = {'yprev': 0.0, 'ythis': 0.0, 'ynext': 0.0, 'total': 0.0}
 
             for p in events[dt]:
-                vdate = datetime.datetime.strptime(dt, '%Y%m%d').strftime('%d-%b-%Y')
+                vdate = vdates[i]
                 strvalue = "£ %12s" % ("{0:,.2f}".format(p['amount']))
                 ymtotals[mkey] += p['amount']
                 mtotals[currentMonth]['total'] += p['amount']
@@ -566,8 +573,8 @@ class UserPortfolioGroup():
             currentYear = None
             mdisplayed = {}
             for mkey in sorted(ymtotals.keys(), reverse=False):
-                dispMonth = datetime.datetime.strptime(mkey, '%Y%m').strftime('%b')
-                dispYear  = datetime.datetime.strptime(mkey, '%Y%m').strftime('%Y')
+                dispMonth = str(month_abbr(int(mkey)))
+                dispYear  = mkey[:4]
                 if currentYear is None or dispYear != currentYear:
                     currentYear = dispYear
                 else:
@@ -603,50 +610,62 @@ class UserPortfolioGroup():
 
 
     # Asset value for each account meeting the filter criteria
+    @timed
     def tdl_account_asset_value(self, user=None, account_type=None, platform_name=None):
         return self.tdl_account_general("value", user, account_type, platform_name)
 
     # Annual income for each account meeting the filter criteria
+    @timed
     def tdl_account_annual_income(self, user=None, account_type=None, platform_name=None):
         return self.tdl_account_general("income", user, account_type, platform_name)
 
     # Asset value at position level
+    @timed
     def tdl_position_asset_value(self, username=None, account_type=None, platform_name=None):
         return self.tdl_position_general("value", username, account_type, platform_name)
 
     # Asset class value at position level
+    @timed
     def tdl_position_assetclass_value(self, username=None, account_type=None, platform_name=None, asset_class=None):
         return self.tdl_position_general("value", username, account_type, platform_name, asset_class)
 
     # Asset risk value at position level
+    @timed
     def tdl_position_riskbucket_value(self, username=None, account_type=None, platform_name=None, risk_bucket=None):
         return self.tdl_position_general("risk", username, account_type, platform_name, risk_bucket)
 
     # Asset value at position level without a total
+    @timed
     def tdl_position_list(self, username=None, account_type=None, platform_name=None):
         return self.tdl_position_general("value2", username, account_type, platform_name)
 
     # Asset value at position level
+    @timed
     def tdl_position_annual_income(self, username=None, account_type=None, platform_name=None):
         return self.tdl_position_general("income", username, account_type, platform_name)
 
     # Dividend payments
+    @timed
     def tdl_dividend_projections(self, username=None, account_type=None, platform_name=None):
         return self.tdl_dividend_general("projections", username, account_type, platform_name)
     
     # Dividend payments
+    @timed
     def tdl_dividend_payments(self, username=None, account_type=None, platform_name=None):
         return self.tdl_dividend_general("payments", username, account_type, platform_name)
 
     # Dividend declarations
+    @timed
     def tdl_dividend_declarations(self, username=None, account_type=None, platform_name=None):
         return self.tdl_dividend_general("declarations", username, account_type, platform_name)
 
     # Dividend payments (monthly)
+    @timed
     def tdl_dividend_mpayments(self, username=None, account_type=None, platform_name=None):
         return self.tdl_dividend_general("mpayments", username, account_type, platform_name)
 
     # Dividend declarations (monthly)
+    @timed
     def tdl_dividend_mdeclarations(self, username=None, account_type=None, platform_name=None):
         return self.tdl_dividend_general("mdeclarations", username, account_type, platform_name)
 
@@ -1,12 +1,14 @@
 # Define classes for handling the different types of securities
 
-import os, logging
+import os, re, logging
 from datetime import datetime, timedelta
 import time
 import json, shutil
+import numpy as np
 
 from Breakdown import AssetAllocation, Breakdown, RiskAllocation
 from Breakdown import truncate_decimal, income_payments_per_year
+from TaxCalendar import to_datetime64, to_yyyymmdd, add_years, datetime64, date_buckets, format_days
 
 from wb import GspreadAuth, WbIncome, WbSecMaster
 from wb import WS_SECURITY_INFO, WS_SECURITY_URLS
@@ -14,6 +16,11 @@ from wb import WS_SECURITY_INFO, WS_SECURITY_URLS
 from wb_bysecurity import WsDividendsBySecurity
 
 from config import SECURITYINFO
+from atomicfile import atomic_write
+from metrics import timed
+
+# Number of timestamped versions of each security file kept in 'Archive'
+ARCHIVE_RETENTION = 10
 
 
 class SecurityUniverse():
@@ -22,14 +29,24 @@ class SecurityUniverse():
         logging.debug("SecurityUniverse(%s)"%(SecurityInfoDir))
         self.refresh()
 
+    @timed('secu.refresh')
     def refresh(self):
+        # Definitions from the previous load, kept if a file can't be read now
+        previous = getattr(self, '_files', {})
+        self._files = {}
         self._securities = {}
         self._aliases = {}
         for filename in os.listdir(self._rootdir):
             full_path = os.path.join(self._rootdir, filename)
-            if os.path.isdir(full_path):
+            # Skip directories and temporary files of writes in progress
+            if os.path.isdir(full_path) or filename.startswith('.'):
                 continue
             sec = self.load_security(full_path)
+            if sec is None:
+                sec = previous.get(filename)
+                if sec is None:
+                    continue
+            self._files[filename] = sec
             self.add_security(sec.sname(), sec)
             if sec.ISIN():
                 self.add_alias(sec.ISIN(), sec.sname())
@@ -56,16 +73,17 @@ class SecurityUniverse():
     def alias_names(self):
         return self._aliases.keys()
 
+    # Returns None if the file can't be read as a security definition
     def load_security(self, full_path):
-        with open(full_path, 'r', encoding='utf-8-sig') as fp:
-            try:
+        try:
+            with open(full_path, 'r', encoding='utf-8-sig') as fp:
                 data = json.load(fp)
-                file_mtime = time.localtime(os.path.getmtime(full_path))
-                data['mdate'] = time.strftime('%Y%m%d', file_mtime )
-                data['dmdate'] = time.strftime('%d-%b-%Y', file_mtime)
-            except:
-                print("ERROR:%s" % (full_path))
-                exit(1)
+            file_mtime = time.localtime(os.path.getmtime(full_path))
+            data['mdate'] = time.strftime('%Y%m%d', file_mtime )
+            data['dmdate'] = time.strftime('%d-%b-%Y', file_mtime)
+        except (OSError, ValueError) as e:
+            logging.error("load_security(%s): %s" % (full_path, e))
+            return None
 
         if data["structure"] == "EQ":
             security = Equity(data)
@@ -110,6 +128,35 @@ class SecurityUniverse():
         return seclist
 
 
+# (index, YYYYMMDD) of the records with a date
+def dated_records(dates):
+    dated = np.flatnonzero(~np.isnat(dates))
+    return zip(dated.tolist(), to_yyyymmdd(dates[dated]).tolist())
+
+# Pay date (paydate day of the month, or the last day if shorter) in the
+# month of each date
+def pay_day(dates, paydate):
+    months = np.asarray(dates).astype('datetime64[M]')
+    length = ((months + 1).astype('datetime64[D]') - months.astype('datetime64[D]')).astype(np.int64)
+    return months.astype('datetime64[D]') + (np.minimum(paydate, length) - 1)
+
+
+# Dividend dates for a security held as datetime64[D] arrays alongside the
+# original list of dicts, which is still what recent_divis() returns.
+# Missing dates are NaT. The arrays may be given if already known.
+class DividendRecords():
+    def __init__(self, prev, payment=None, exdiv=None):
+        self._prev   = prev
+        self.payment = to_datetime64([d.get('payment') for d in prev]) if payment is None else payment
+        self.exdiv   = to_datetime64([d.get('ex-div') for d in prev]) if exdiv is None else exdiv
+
+    def view(self):
+        return self._prev
+
+    def __len__(self):
+        return len(self._prev)
+
+
 class Security:
     def __init__(self, data):
         self._data = data
@@ -119,14 +166,17 @@ class Security:
         self._price = 0.0
         self._stale = False
 
+        # Dividend dates converted once here, generated ones on demand
         try:
-            now = datetime.now()
-            one_year_ago = "%04d%02d%02d" % (now.year-1, now.month, now.day)
-            for d in self._data['divis']['prev']:
-                if d['payment'] < one_year_ago or d['ex-div'] < one_year_ago:
-                    self._stale = True
-        except:
-            pass
+            self._divis = DividendRecords(self._data['divis']['prev'])
+        except (KeyError, TypeError):
+            self._divis = None
+        self._generated = (None, None)
+
+        if self._divis is not None:
+            one_year_ago = add_years([datetime64(datetime.now())], -1)[0]
+            self._stale = bool(np.any(self._divis.payment < one_year_ago) or
+                               np.any(self._divis.exdiv < one_year_ago))
 
         logging.debug("Security(%s)"%(self.sname()))
 
@@ -140,81 +190,43 @@ class Security:
     # Return list of recent dividend details. Could be empty.
     # Dummy payments are only generated for monthly frequency
     def recent_divis(self):
-        try:
-            return self._data['divis']['prev']
-        except:
-            pass
+        return self.dividend_records().view()
+
+    # Dividend records, with dummy payments regenerated once per day
+    def dividend_records(self):
+        if self._divis is not None:
+            return self._divis
 
-        # Genenate dummy payments for this month and 11 previous months
-        prev = []
+        today = datetime.today().date()
+        if self._generated[0] != today:
+            self._generated = (today, self.generate_divis())
+        return self._generated[1]
+
+    # Dummy monthly payments (as DividendRecords) for this month and up to
+    # 11 more, from no more than a year ago and before the end date
+    def generate_divis(self):
         freq = self.payout_frequency()
         paydate = self.divi_paydate()
         if freq != 'M' or paydate == 0:
-            return prev
-        
-        startdate = f"{self.divi_startdate()}"
-        lastdate  = f"{self.divi_lastdate()}"
-
-        start_obj = datetime.strptime(startdate, "%Y%m%d").replace(day=paydate)
-        last_obj  = datetime.strptime(lastdate, "%Y%m%d").replace(day=paydate)
-
-        # logging.debug(f"recent_divis({self.sname()}): init start_obj={start_obj} last_obj={last_obj}")
-
-        # Reset start to be no more than 12 months ago (Avoid 29-Feb issue)
-        yearago_obj = datetime.today().replace(day=paydate)
-        try:
-            yearago_obj = yearago_obj.replace(year=yearago_obj.year - 1)
-        except ValueError:
-            yearago_obj = yearago_obj.replace(month=2, day=28, year=yearago_obj.year - 1)
-
-        if start_obj < yearago_obj:
-            start_obj = yearago_obj
-
-        # The window goes out to the end date, but no more than 1 year ahead
-        yearahead_obj = start_obj
-        try:
-            yearahead_obj = yearahead_obj.replace(year=yearahead_obj.year + 1)
-        except ValueError:
-            yearahead_obj = yearahead_obj.replace(month=2, day=28, year=yearahead_obj.year + 1)
-
-        if last_obj > yearahead_obj:
-            last_obj = yearahead_obj
-
-        startdate = start_obj.strftime("%Y%m%d")
-        lastdate  = last_obj.strftime("%Y%m%d")
-
-        # logging.debug(f"recent_divis({self.sname()}): start={startdate} last={lastdate}")
+            return DividendRecords([])
 
-        # Step forward from the start date, one month at a time, not to exceed end date
-        
-        dt_obj = start_obj
-        for i in range(12):
-            # Get paydate and advance date if Sat or Sun
-            dt_obj = dt_obj.replace(day=paydate)
-            while dt_obj.weekday() >= 5:
-                dt_obj = dt_obj + timedelta(days=1)
-
-            year  = dt_obj.year
-            month = dt_obj.month
-            dt = dt_obj.strftime("%Y%m%d")
-
-            # Include payment in list if not before startdate
-            if dt >= lastdate:
-                continue
+        start = to_datetime64([self.divi_startdate()])[0]
+        last  = to_datetime64([self.divi_lastdate()])[0]
 
-            tag = "month%02d"%(month)
-            prev.append({'tag':tag, 'ex-div':dt, 'payment':dt})
+        # Start no more than 12 months ago, and the window goes out to the end
+        # date but no more than 1 year ahead (add_years avoids the 29-Feb issue)
+        start = max(pay_day(start, paydate), add_years([pay_day(datetime64(datetime.today()), paydate)], -1)[0])
+        last  = min(pay_day(last, paydate), add_years([start])[0])
 
-            # Step forward one month
-            month += 1
-            if month > 12:
-                month = 1
-                year += 1
-            dt_obj = dt_obj.replace(year=year,month=month,day=paydate)
+        # Pay date in each month from the start, moved forward if Sat or Sun,
+        # and only included if before the end date
+        months = start.astype('datetime64[M]') + np.arange(12)
+        dates  = np.busday_offset(pay_day(months, paydate), 0, roll='forward')
+        dates  = dates[dates < last]
 
-        # logging.debug(f"recent_divis({self.sname()}): prev={prev}")
-
-        return prev
+        prev = [{'tag': "month%02d" % (month), 'ex-div': dt, 'payment': dt}
+                for month, dt in zip(date_buckets(dates)['month'].tolist(), to_yyyymmdd(dates).tolist())]
+        return DividendRecords(prev, payment=dates, exdiv=dates)
 
     # Return payout frequency if specified otherwise None
     def payout_frequency(self):
@@ -259,31 +271,31 @@ class Security:
     # Return dict of payment dates with amounts
     def dividend_payments(self):
         payments = {}
-        for d in self.recent_divis():
-            if 'payment' in d.keys():
-                dt = d['payment']
-                if dt not in payments.keys():
-                    payments[dt] = []
-                if 'amount' in d.keys():
-                    payments[dt].append(d['amount'])
-                else:
-                    try:
-                        # Securities with 'annual-income' are defined benefit.
-                        # Positions in these securities have quantity=100, so need to allow for this
-                        # However, dividend payments assumed in pence, so need to allow for this too
-                        annual_payout = float(self._data['annual-income']) * 100.0
-                        npayments = income_payments_per_year(self.payout_frequency())
-
-                        # add a fraction of a panny before the division to allow for rounding errors
-                        # as the number is rounded down by truncate_decimal
-                        amount = float((annual_payout + 0.1)/npayments)
-                    except:
-                        logging.debug("Security.price(%s)=%s"%(self.sname(),self.price()))
-                        logging.debug("Security.fund_period_yield(%s)=%s"%(self.sname(),self.fund_period_yield()))
-                        amount = self.price() * self.fund_period_yield()
-
-                    # Convert from p to £
-                    payments[dt].append(truncate_decimal(amount / 100.0))
+        records = self.dividend_records()
+        for i, dt in dated_records(records.payment):
+            d = records.view()[i]
+            if dt not in payments.keys():
+                payments[dt] = []
+            if 'amount' in d.keys():
+                payments[dt].append(d['amount'])
+            else:
+                try:
+                    # Securities with 'annual-income' are defined benefit.
+                    # Positions in these securities have quantity=100, so need to allow for this
+                    # However, dividend payments assumed in pence, so need to allow for this too
+                    annual_payout = float(self._data['annual-income']) * 100.0
+                    npayments = income_payments_per_year(self.payout_frequency())
+
+                    # add a fraction of a panny before the division to allow for rounding errors
+                    # as the number is rounded down by truncate_decimal
+                    amount = float((annual_payout + 0.1)/npayments)
+                except:
+                    logging.debug("Security.price(%s)=%s"%(self.sname(),self.price()))
+                    logging.debug("Security.fund_period_yield(%s)=%s"%(self.sname(),self.fund_period_yield()))
+                    amount = self.price() * self.fund_period_yield()
+
+                # Convert from p to £
+                payments[dt].append(truncate_decimal(amount / 100.0))
 
         logging.debug("Security.dividend_payments(%s)=%s"%(self.sname(),payments))
 
@@ -301,30 +313,29 @@ class Security:
         end_projection   = end_projection.replace(hour=0, minute=0, second=0, microsecond=0)
         logging.debug(f"dividend_projections start={start_projection} end={end_projection}")
 
+        start = datetime64(start_projection)
+        end   = datetime64(end_projection)
+
+        # Payments already made are assumed to be repeated a year later (avoiding
+        # the 29-Feb issue), moved forward to a weekday
+        records = self.dividend_records()
+        future  = records.payment >= start
+        dates   = records.payment.copy()
+        past    = ~future & ~np.isnat(dates)
+        if np.any(past):
+            dates[past] = np.busday_offset(add_years(dates[past]), 0, roll='forward')
+        window  = (dates >= start) & (dates <= end)
+
+        inwindow = np.flatnonzero(window)
         projected = {}
-        for divi in self.recent_divis():
-            dt = divi['payment']
-            # logging.debug(f"dividend_projections dt={dt}")
-            dt_obj = datetime.strptime(dt, "%Y%m%d")
-            if dt_obj >= start_projection:
+        for i, est_date in zip(inwindow, to_yyyymmdd(dates[inwindow]).tolist()):
+            divi = records.view()[i]
+            if future[i]:
                 div_status = " * "
-                div_date = dt
+                div_date = divi['payment']
             else:
-                # Assume same dividend will be paid in a year (avoid 29-Feb issue)
-                try:
-                    dt_obj = dt_obj.replace(year=dt_obj.year + 1)
-                except ValueError:
-                    dt_obj = dt_obj.replace(month=2, day=28, year=dt_obj.year + 1)
-                
-                # Advance date if Sat or Sun
-                while dt_obj.weekday() >= 5:
-                    dt_obj = dt_obj + timedelta(days=1)
-
                 div_status = "Est"
-                div_date = dt_obj.strftime("%Y%m%d")
-
-            if dt_obj < start_projection or dt_obj > end_projection:
-                continue
+                div_date = est_date
 
             # At this point we have a projected date, so what about the amount?
 
@@ -370,15 +381,15 @@ class Security:
     # Return dict of ex-div dates with amounts
     def dividend_declarations(self):
         payments = {}
-        for d in self.recent_divis():
-            if 'ex-div' in d.keys():
-                dt = d['ex-div']
-                if dt not in payments.keys():
-                    payments[dt] = []
-                if 'amount' in d.keys():
-                    payments[dt].append(d['amount'])
-                else:
-                    payments[dt].append(self.price() * self.fund_period_yield() / 100.0)
+        records = self.dividend_records()
+        for i, dt in dated_records(records.exdiv):
+            d = records.view()[i]
+            if dt not in payments.keys():
+                payments[dt] = []
+            if 'amount' in d.keys():
+                payments[dt].append(d['amount'])
+            else:
+                payments[dt].append(self.price() * self.fund_period_yield() / 100.0)
 
         return payments
 
@@ -566,11 +577,12 @@ class Security:
             detail.append({'tag': 'Annual Dividend', 'value': divi_str})
 
         # List of recent dividends if specified
-        if self.recent_divis():
-            for d in self.recent_divis():
+        records = self.dividend_records()
+        if len(records):
+            xdates = format_days(records.exdiv, '%d-%b-%Y')
+            pdates = format_days(records.payment, '%d-%b-%Y')
+            for d, xdate, pdate in zip(records.view(), xdates, pdates):
                 tag = "%s" % (d['tag'])
-                xdate = datetime.strptime(d['ex-div'], '%Y%m%d').strftime('%d-%b-%Y')
-                pdate = datetime.strptime(d['payment'], '%Y%m%d').strftime('%d-%b-%Y')
                 if 'amount' in d.keys():
                     value = "Ex-Dividend %s Payment %s Amount %.3f%s" % (xdate, pdate, d['amount'], d['unit'])
                 else:
@@ -666,20 +678,48 @@ class Cash(Security):
 
 
 #------------------------------------------------------------------------------
-# Update a json security file from SecurityMaster workbook
+# Update json security files from SecurityMaster workbook
 #------------------------------------------------------------------------------
 
 def security_update_json(ForeverIncome, SecurityMaster, SecurityId):
     logging.debug(f"security_update_json({SecurityId})")
+    return security_update_json_many(ForeverIncome, SecurityMaster, [SecurityId])
 
-    # Base security definition
+# Source sheets are fetched and normalised once, then grouped by SecurityId,
+# so updating the whole universe costs the same API calls as one security
+def security_update_json_many(ForeverIncome, SecurityMaster, SecurityIds):
+    logging.debug(f"security_update_json_many({SecurityIds})")
+
+    # Base security definitions, first row for each security
     df = SecurityMaster.worksheet_to_df(WS_SECURITY_INFO)
-    records = df[(df['sname'] == SecurityId)].to_dict('records')
-    if len(records) < 1:
-        logging.debug(f"security_update_json: '{SecurityId}' not found")
-        return
-        
-    sec_info = records[0]
+    df = df[df['sname'].isin(SecurityIds)].drop_duplicates('sname')
+    sec_infos = {r['sname']: r for r in df.to_dict('records')}
+
+    # Previous dividends
+    bySecurity = WsDividendsBySecurity(ForeverIncome, SecurityMaster)
+
+    # Url information
+    df = SecurityMaster.worksheet_to_df(WS_SECURITY_URLS)
+    df = df[df['SecurityId'].isin(SecurityIds)]
+    sec_urls = {sid: g.to_dict('records') for sid, g in df.groupby('SecurityId')}
+
+    updated = []
+    for SecurityId in SecurityIds:
+        if SecurityId not in sec_infos:
+            logging.debug(f"security_update_json: '{SecurityId}' not found")
+            continue
+
+        prev = bySecurity.json_prev_divis(SecurityId)
+        defn = security_definition(sec_infos[SecurityId], prev, sec_urls.get(SecurityId, []))
+        security_write_json(SecurityId, defn)
+        updated.append(SecurityId)
+
+    return updated
+
+# Construct the json definition from a 'Security Information' row,
+# previous dividends and 'Detailed Information' rows for one security
+def security_definition(sec_info, prev, sec_urls):
+    sec_info = dict(sec_info)
     freq = sec_info['div-freq']
     sec_info.pop('div-freq')
     for tag in ['alias', 'SEDOL', 'fund-class']:
@@ -691,28 +731,43 @@ def security_update_json(ForeverIncome, SecurityMaster, SecurityId):
     defn['divis'] = {}
     defn['divis']['freq'] = freq
 
-    bySecurity = WsDividendsBySecurity(ForeverIncome, SecurityMaster)
-    prev = bySecurity.json_prev_divis(SecurityId)
     if len(prev) > 0:
         defn['divis']['prev'] = prev
 
     # Add url information if present
-    df = SecurityMaster.worksheet_to_df(WS_SECURITY_URLS)
-    sec_urls = df[(df['SecurityId'] == SecurityId)].to_dict('records')
     if len(sec_urls) > 0:
         defn['info'] = {}
         for u in sec_urls:
             defn['info'][u['Platform']] = u['Url']
 
-    # Copy existing file in the Archive directory then recreate original
+    return defn
+
+# Replace the json file atomically: readers see either the old or the new
+# definition, never a partial one. The old file is kept as a timestamped
+# version in 'Archive', with the oldest versions beyond 'retain' removed.
+def security_write_json(SecurityId, defn, retain=ARCHIVE_RETENTION):
     sec_dir = SECURITYINFO
     arc_dir = os.path.join(sec_dir, "Archive")
     sec_file = os.path.join(sec_dir, f"{SecurityId}.json")
-    arc_file = os.path.join(arc_dir, f"{SecurityId}.json")
 
-    shutil.copy(sec_file, arc_file)
-    with open(sec_file, 'w') as fp:
-        json.dump(defn, fp, indent=2)
+    if os.path.isfile(sec_file):
+        os.makedirs(arc_dir, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d%H%M%S%f")
+        arc_file = os.path.join(arc_dir, f"{SecurityId}.{stamp}.json")
+        shutil.copy2(sec_file, arc_file)
+        security_rotate_archive(arc_dir, SecurityId, retain)
+
+    # The temporary file starts with '.' so SecurityUniverse.refresh() ignores it
+    with atomic_write(sec_file, durable=True) as fp:
+        json.dump(defn, fp, separators=(',', ':'))
+
+def security_rotate_archive(arc_dir, SecurityId, retain):
+    # Stamps are to the microsecond (to the second in older versions, which
+    # sort before any newer stamp from the same second)
+    pattern = re.compile(re.escape(SecurityId) + r'\.\d{14}(\d{6})?\.json$')
+    versions = sorted(f for f in os.listdir(arc_dir) if pattern.match(f))
+    for f in versions[:-retain] if retain > 0 else versions:
+        os.unlink(os.path.join(arc_dir, f))
 
 
 # =========================================================================================
@@ -733,8 +788,7 @@ if __name__ == '__main__':
         ForeverIncome = WbIncome(gsauth)
         SecurityMaster = WbSecMaster(gsauth)
 
-        for SecurityId in ["BNKR","JCH"]:
-            security_update_json(ForeverIncome, SecurityMaster, SecurityId)
+        security_update_json_many(ForeverIncome, SecurityMaster, ["BNKR","JCH"])
 
     #---------------------------------------------------------------------------------------------
     # Print information from all securities
@@ -1,24 +1,118 @@
 # Classes for retirement simulation
 
-import pandas as pd
-import re
-import sys
-import os
 import logging
 import datetime
-from dateutil.relativedelta import relativedelta
+import functools
+import numpy as np
+from enum import IntEnum
+
+from TaxCalendar import tax_year_bounds
+
+from SimulationConfig import SimConfig
+
+# Fraction of a full year's pension paid in a tax year for a pension starting on
+# start_date: nothing if it starts after the tax year, all if before, otherwise
+# the proportion of the year remaining
+def pension_fraction(start_date, taxyearStart, taxyearEnd):
+    if start_date > taxyearEnd:
+        return 0.0
+    elif start_date < taxyearStart:
+        return 1.0
+    else:
+        return (taxyearEnd - start_date).days/365
+
+# Tax on gross income given the thresholds, for a single value or arrays
+def income_tax(grossAmount, taxFreeAmount, basicRateAmount, taxrateBasic, taxrateHigh):
+    taxableAmount = np.maximum(grossAmount - taxFreeAmount, 0.0)
+    basicTax = np.minimum(taxableAmount, basicRateAmount) * taxrateBasic
+    highTax  = np.maximum(taxableAmount - basicRateAmount, 0.0) * taxrateHigh
+    return basicTax + highTax
+
+# TUI pension is payable from this date
+TUI_PENSION_DATE = "25/10/2024"
+
+
+# Number of (config, start year, length) schedules kept
+SIM_SCHEDULE_CACHE_SIZE = 256
+
+# The configuration values which the yearly schedules depend on
+def config_key(config):
+    return (config.get_CPI(), config.get_RPI(),
+            config.get_livingExpenses1(), config.get_livingExpenses2(), config.get_expensiveYears(),
+            config.fullStatePension, config.tuiPension, config.taxFreeAmount, config.basicRateAmount)
+
+def sim_schedules(config, startYear, nYears):
+    return cached_schedules(config_key(config), startYear, nYears)
+
+# Living expenses, pensions and tax thresholds for each year of a simulation.
+# These only depend on the configuration, so are worked out once for each
+# distinct config and shared (read-only) by every simulation which uses it.
+@functools.lru_cache(maxsize=SIM_SCHEDULE_CACHE_SIZE)
+def cached_schedules(key, startYear, nYears):
+    CPI, RPI, livingExpenses1, livingExpenses2, expensiveYears, fullStatePension, tuiPension, taxFreeAmount, basicRateAmount = key
+
+    names = ('livingExpenses', 'livingExpenses1', 'livingExpenses2', 'fullStatePension',
+             'tuiPension', 'taxFreeAmount', 'basicRateAmount')
+    sched = {name: np.zeros(nYears) for name in names}
+    sched['taxyearStart'] = []
+    sched['taxyearEnd'] = []
+
+    for t in range(nYears):
+        year = startYear + t
 
-from AccountClasses import AccountGroup
+        # Start and end of tax year
+        start, end = tax_year_bounds(year)
+        sched['taxyearStart'].append(start)
+        sched['taxyearEnd'].append(end)
+
+        #--- Living expenses and full state pension
+
+        if t == 0:
+            sched['livingExpenses1'][t] = livingExpenses1
+            sched['livingExpenses2'][t] = livingExpenses2
+            sched['fullStatePension'][t] = fullStatePension
+        else:
+            sched['livingExpenses1'][t] = sched['livingExpenses1'][t-1] * (1 + RPI)
+            sched['livingExpenses2'][t] = sched['livingExpenses2'][t-1] * (1 + RPI)
+            sched['fullStatePension'][t] = sched['fullStatePension'][t-1] * (1 + CPI)
+
+        if year < 2024:
+            sched['tuiPension'][t] = 0.0
+        elif year == 2024 or t == 0:
+            sched['tuiPension'][t] = tuiPension
+        else:
+            sched['tuiPension'][t] = sched['tuiPension'][t-1] * 1.025
+
+        if year < startYear + expensiveYears:
+            sched['livingExpenses'][t] = sched['livingExpenses1'][t]
+        else:
+            sched['livingExpenses'][t] = sched['livingExpenses2'][t]
+
+        #--- Tax thresholds frozen for a few years then assume increase with CPI
+
+        if year < 2026 or t == 0:
+            sched['taxFreeAmount'][t] = taxFreeAmount
+            sched['basicRateAmount'][t] = basicRateAmount
+        else:
+            sched['taxFreeAmount'][t] = sched['taxFreeAmount'][t-1] * (1 + CPI)
+            sched['basicRateAmount'][t] = sched['basicRateAmount'][t-1] * (1 + CPI)
+
+    for name in names:
+        sched[name].flags.writeable = False
+    sched['taxyearStart'] = tuple(sched['taxyearStart'])
+    sched['taxyearEnd'] = tuple(sched['taxyearEnd'])
+
+    return sched
 
-from app import sim_conf
 
 class Simulation:
-    def __init__(self, startYear, nYears, persons):
+    def __init__(self, startYear, nYears, persons, config=None):
         self._startYear = startYear
         self._nYears = nYears
         self._persons = persons
         self._years = []
-        self._config = sim_conf
+        self._config = SimConfig() if config is None else config
+        self._schedules = sim_schedules(self._config, startYear, nYears)
 
         for i in range(0, nYears):
             self._years.append(SimYear(self, startYear + i))
@@ -32,6 +126,9 @@ class Simulation:
     def persons(self):
         return self._persons
 
+    def schedules(self):
+        return self._schedules
+
     def CPI(self):
         return self._config.get_CPI()
 
@@ -95,82 +192,49 @@ class Simulation:
 class SimYear:
     def __init__(self, simulation, year):
 
-        prev = simulation.yearData(year-1)
-
-        # Start and end of tax year
-        dt_start = "06/04/%d" % (year);
-        dt_end   = "05/04/%d" % (year + 1);
-
         self.simulation = simulation
         self.year = year
-        self.taxyearStart = datetime.datetime.strptime(dt_start, "%d/%m/%Y").date()
-        self.taxyearEnd   = datetime.datetime.strptime(dt_end, "%d/%m/%Y").date()
 
-        #--- Calculate living expenses and full state pension
+        # Values for this year from the precomputed schedules
+        t = year - simulation.firstYear()
+        sched = simulation.schedules()
 
-        if year == simulation.firstYear():
-            self.livingExpenses1 = simulation.livingExpenses1()
-            self.livingExpenses2 = simulation.livingExpenses2()
-            self.fullStatePension = simulation.fullStatePension()
-        else:
-            self.livingExpenses1 = prev.livingExpenses1 * (1 + simulation.RPI())
-            self.livingExpenses2 = prev.livingExpenses2 * (1 + simulation.RPI())
-            self.fullStatePension = prev.fullStatePension * (1 + simulation.CPI())
+        # Start and end of tax year
+        self.taxyearStart = sched['taxyearStart'][t]
+        self.taxyearEnd   = sched['taxyearEnd'][t]
 
-        if year < 2024:
-            self.tuiPension = 0.0
-        elif year == 2024:
-            self.tuiPension = simulation.tuiPension()
-        else:
-            self.tuiPension = prev.tuiPension * 1.025
+        #--- Living expenses and full state pension
 
-        if year < simulation.firstYear() + simulation.expensiveYears():
-            self.livingExpenses = self.livingExpenses1
-        else:
-            self.livingExpenses = self.livingExpenses2
+        self.livingExpenses1 = sched['livingExpenses1'].item(t)
+        self.livingExpenses2 = sched['livingExpenses2'].item(t)
+        self.fullStatePension = sched['fullStatePension'].item(t)
+        self.tuiPension = sched['tuiPension'].item(t)
+        self.livingExpenses = sched['livingExpenses'].item(t)
 
         logging.debug("living expenses %.2f %.2f %.2f"%(self.livingExpenses,self.livingExpenses1,self.livingExpenses2))
 
         #--- Tax thresholds frozen for a few years then assume increase with CPI
 
-        if year < 2026:
-            self.taxFreeAmount = simulation.taxFreeAmount()
-            self.basicRateAmount = simulation.basicRateAmount()
-        else:
-            self.taxFreeAmount = prev.taxFreeAmount * (1 + simulation.CPI())
-            self.basicRateAmount = prev.basicRateAmount * (1 + simulation.CPI())
+        self.taxFreeAmount = sched['taxFreeAmount'].item(t)
+        self.basicRateAmount = sched['basicRateAmount'].item(t)
 
         #--- Determine income for each person
         persons = simulation.persons()
         requiredIncome = self.livingExpenses
         for id in sorted(persons.keys()):
             person = persons[id]
-            person.init_simyear(year)
+            person.init_simyear(year, simulation.firstYear())
             income = person.netIncome(self, requiredIncome)
             requiredIncome = requiredIncome - income
             logging.debug("--- Income=%.2f leaving required income=%.2f" % (income, requiredIncome))
 
     def incomePensSP(self, sp_date, spRatio):
-        if sp_date > self.taxyearEnd:  # Doesn't reach state pension age until after this year
-            amount = 0.0
-        elif sp_date < self.taxyearStart:  # Reached state pension age before this year
-            amount = self.fullStatePension * spRatio
-        else:       # Return a portion of the amount
-            d2 = self.taxyearEnd
-            d1 = sp_date
-            amount = self.fullStatePension * spRatio * (d2-d1).days/365
+        amount = self.fullStatePension * spRatio * pension_fraction(sp_date, self.taxyearStart, self.taxyearEnd)
         logging.debug("incomePensSP(sp_date=%s) end=%s full=%.2f amount=%.2f", sp_date, self.taxyearEnd, self.fullStatePension, amount)
         return amount
 
     def incomePensTUI(self, tui_date):
-        if tui_date > self.taxyearEnd:  # Doesn't reach TUI pension age until after this year
-            amount = 0.0
-        elif tui_date < self.taxyearStart:  # Reached TUI pension age before this year
-            amount = self.tuiPension
-        else:       # Return a portion of the amount
-            d2 = self.taxyearEnd
-            d1 = tui_date
-            amount = self.tuiPension * (d2-d1).days/365
+        amount = self.tuiPension * pension_fraction(tui_date, self.taxyearStart, self.taxyearEnd)
         logging.debug("incomePensTUI(tui_date=%s) end=%s full=%.2f amount=%.2f", tui_date, self.taxyearEnd, self.tuiPension, amount)
         return amount
 
@@ -195,15 +259,100 @@ class SimYear:
         return s
 
 
+# Snapshot of the simulation settings of a UserPortfolio, without the accounts,
+# so that it can be copied to other processes. Any setting can be overridden.
+class SimPortfolio:
+    def __init__(self, portfolio, **overrides):
+        self._defn = {
+            'id':           portfolio.id(),
+            'username':     portfolio.username(),
+            'dob':          portfolio.dob(),
+            'rtDate':       portfolio.rtDate(),
+            'spDate':       portfolio.spDate(),
+            'spRatio':      portfolio.spRatio(),
+            'drawdownPens': portfolio.drawdownPens(),
+            'drawdownISA':  portfolio.drawdownISA(),
+            'drawdownTrd':  portfolio.drawdownTrd(),
+            'spShortfall':  portfolio.spShortfall(),
+            'savShortfall': portfolio.savShortfall()
+        }
+        self._defn.update(overrides)
+
+    def id(self):
+        return self._defn['id']
+
+    def username(self):
+        return self._defn['username']
+
+    def dob(self):
+        return self._defn['dob']
+
+    def rtDate(self):
+        return self._defn['rtDate']
+
+    def spDate(self):
+        return self._defn['spDate']
+
+    def spRatio(self):
+        return self._defn['spRatio']
+
+    def drawdownPens(self):
+        return self._defn['drawdownPens']
+
+    def drawdownISA(self):
+        return self._defn['drawdownISA']
+
+    def drawdownTrd(self):
+        return self._defn['drawdownTrd']
+
+    def spShortfall(self):
+        return self._defn['spShortfall']
+
+    def savShortfall(self):
+        return self._defn['savShortfall']
+
+
+# Asset pots held by each person
+SIM_POTS = ('aPn', 'aISA', 'aTrd', 'aSav')
+
+# Values recorded for each person in each simulation year
+SIM_FIELDS = ('aPn', 'aISA', 'aTrd', 'aSav', 'pensSP', 'pensDB', 'pensDC', 'pensDC.DD', 'pensDC.spTU',
+              'taxable', 'tax', 'iISA', 'iTrd', 'iSav', 'taxfree', '_income')
+
+# Column of each field in the SimPerson ledger, named as in SIM_FIELDS
+# without the leading '_' and with '.' as '_' (e.g. SimField.pensDC_DD)
+SimField = IntEnum('SimField', [(name.lstrip('_').replace('.', '_'), i) for i, name in enumerate(SIM_FIELDS)])
+
+SIM_FIELD_INDEX = {name: SimField(i) for i, name in enumerate(SIM_FIELDS)}
+
+# Initial number of years allocated in a ledger (grows if needed)
+SIM_LEDGER_YEARS = 64
+
+
 class SimPerson:
     def __init__(self, portfolio, assets):
         self._portfolio = portfolio
         self._assets = assets.copy()     # Assets at the start of the simulation
-        self._simyears = {}
 
-    def init_simyear(self, year):
-        ystr = "%d" % (year)
-        self._simyears[ystr] = {}
+        # Ledger of values by (year - first year, field), NaN where not set
+        self._year0 = None
+        self._nyears = 0
+        self._ledger = np.full((SIM_LEDGER_YEARS, len(SIM_FIELDS)), np.nan)
+
+    # Clear the ledger row for a year, or the whole ledger for the first year
+    # of a simulation, so a person can be reused for another simulation
+    def init_simyear(self, year, firstYear):
+        if year == firstYear:
+            self._year0 = year
+            self._nyears = 0
+            self._ledger[:] = np.nan
+        row = self.row(year)
+        if row >= len(self._ledger):
+            ledger = np.full((max(2 * len(self._ledger), row + 1), len(SIM_FIELDS)), np.nan)
+            ledger[:len(self._ledger)] = self._ledger
+            self._ledger = ledger
+        self._ledger[row] = np.nan
+        self._nyears = max(self._nyears, row + 1)
 
     #--- Configuration
 
@@ -243,23 +392,60 @@ class SimPerson:
     def savShortfall(self):
         return self._portfolio.savShortfall()
 
+    # Only the first person has a DB (TUI) pension
+    def tuiDate(self):
+        if self.id() == "1":
+            return datetime.datetime.strptime(TUI_PENSION_DATE, "%d/%m/%Y").date()
+        return None
+
+    def assets(self):
+        return self._assets
+
+    # Copy of this person, with no simulation results, that can be pickled
+    def snapshot(self, **overrides):
+        return SimPerson(SimPortfolio(self._portfolio, **overrides), self._assets)
+
     #--- Amend assets for this year
 
+    # Ledger row of a year (a negative index would silently wrap round)
+    def row(self, year):
+        if self._year0 is None or year < self._year0:
+            raise ValueError(f"SimPerson({self.id()}) year {year} is before the simulation")
+        return year - self._year0
+
+    # The current year has been initialised, so its row is only checked
+    # here rather than through row()
     def get_fin(self, simyear, assetType):
-        ystr = "%d" % (simyear.year)
-        return self._simyears[ystr][assetType]
+        row = simyear.year - self._year0
+        if row < 0:
+            self.row(simyear.year)
+        return self._ledger.item(row, SIM_FIELD_INDEX[assetType])
 
     def set_fin(self, simyear, assetType, value):
-        ystr = "%d" % (simyear.year)
-        self._simyears[ystr][assetType] = value
+        row = simyear.year - self._year0
+        if row < 0:
+            self.row(simyear.year)
+        self._ledger[row, SIM_FIELD_INDEX[assetType]] = value
+
+    # Value of a field for a year (NaN if not set)
+    def fin(self, year, assetType):
+        return self._ledger.item(self.row(year), SIM_FIELD_INDEX[assetType])
+
+    # Ledger rows for the simulated years, shaped (years, fields)
+    def ledger(self):
+        return self._ledger[:self._nyears]
+
+    # Fields set for a year, as the original per-year dict
+    def year_values(self, year):
+        row = self._ledger[self.row(year)]
+        return {name: row[i] for i, name in enumerate(SIM_FIELDS) if not np.isnan(row[i])}
 
     #--- Income (from drawing down)
 
     def incomePensDB(self, simyear):
         total = 0.0
-        if self.id() == "1":
-            tuiDate = "25/10/2024"
-            dt = datetime.datetime.strptime(tuiDate, "%d/%m/%Y").date()
+        dt = self.tuiDate()
+        if dt is not None:
             total = simyear.incomePensTUI(dt)
         return total
 
@@ -356,8 +542,7 @@ class SimPerson:
 
     def netIncome(self, simyear, targetIncome):
         # print("netIncome({%s},{%s},%.2f"%(self, simyear, targetIncome))
-        thisYear = "%d" % (simyear.year)
-        prevYear = "%d" % (simyear.year - 1)
+        row = self.row(simyear.year)
 
         # assets at start of simulation year
         if simyear.year == simyear.simulation.firstYear():
@@ -366,10 +551,8 @@ class SimPerson:
             self.set_fin(simyear,'aTrd',self._assets['Trd'])
             self.set_fin(simyear,'aSav',self._assets['Sav'])
         else:
-            self.set_fin(simyear,'aPn', self._simyears[prevYear]['aPn'])
-            self.set_fin(simyear,'aISA',self._simyears[prevYear]['aISA'])
-            self.set_fin(simyear,'aTrd',self._simyears[prevYear]['aTrd'])
-            self.set_fin(simyear,'aSav',self._simyears[prevYear]['aSav'])
+            pots = [SimField.aPn, SimField.aISA, SimField.aTrd, SimField.aSav]
+            self._ledger[row, pots] = self._ledger[row - 1, pots]
 
         # Taxable income from pensions
         taxableIncome = self.taxableIncome(simyear)
@@ -384,7 +567,8 @@ class SimPerson:
         logging.debug("%s %d taxfree=%.2f taxable=%.2f tax=%.2f"%(self.username(), simyear.year, taxfreeIncome, taxableIncome, taxPayable))
 
         # Save the assets at the end of the current year
-        logging.debug("%s %d assets=%s"%(self.username(), simyear.year, self._simyears[thisYear]))
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("%s %d assets=%s"%(self.username(), simyear.year, self.year_values(simyear.year)))
 
         # Allow for growth of each portfolio type to give year-end total
         for ptype in ('aPn','aISA','aTrd','aSav'):
@@ -397,15 +581,27 @@ class SimPerson:
     # assets at the end of the previous year of the simulation
     def __repr__(self):
         s = "SimPerson(%s,%s,%s,%s,%.2f)" % (self.id(),self.username(), self.dob(), self.spDate(), self.spRatio())
-        for y in sorted(self._simyears.keys()):
-            a = self._simyears[y]
-            s += "\n%s {" % (y)
+        for row in range(self._nyears):
+            a = self.year_values(self._year0 + row)
+            s += "\n%d {" % (self._year0 + row)
             for k in sorted(a.keys()):
                 s += "%s: %.2f "%(k, a[k])
             s += "}"
         return s
 
 
+# A SimPerson for each user in a UserPortfolioGroup, with their current assets
+def sim_persons(pgrp):
+    persons = {}
+    for name in pgrp.users():
+        p = pgrp.portfolio(name)
+        assets = {}
+        for accountType in ['Pens','ISA','Trd','Sav']:
+            assets[accountType] = pgrp.value(name, accountType)
+        persons[p.id()] = SimPerson(p, assets)
+    return persons
+
+
 if __name__ == '__main__':
 
     from SecurityClasses import SecurityUniverse
@@ -420,19 +616,7 @@ if __name__ == '__main__':
     simYear0  = 2022    # Start year of simulation
     simLength = 12      # Number of years
 
-    persons = {}
-    for name in pgrp.users():
-        p = pgrp.portfolio(name)
-        id = p.id()
-        logging.debug("PERSON(%s)=%s"%(id,name))
-
-        assets= {}
-        for accountType in ['Pens','ISA','Trd','Sav']:
-            assets[accountType] = pgrp.value(name, accountType)
-
-        persons[id] = SimPerson(p, assets)
-
-    # print(persons)
+    persons = sim_persons(pgrp)
 
     # Simulate N years starting from a nominated year
     sim = Simulation(simYear0, simLength, persons)
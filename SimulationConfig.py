@@ -0,0 +1,56 @@
+# Settings for the retirement simulation
+#
+# HMRC thresholds and the growth, inflation and living expenses assumptions,
+# initialised from config.py. Kept apart from the web app so simulations (and
+# the worker processes running them) only need numpy and this module.
+
+from config import HMRC_PARAMS, SIM_PARAMS
+
+class SimConfig:
+    def __init__(self):
+
+        # HMRC Configuration
+        self.taxrateBasic = HMRC_PARAMS['taxrateBasic']
+        self.taxrateHigh = HMRC_PARAMS['taxrateHigh']
+        self.taxFreeAmount = HMRC_PARAMS['personalAllowance']
+        self.basicRateAmount = HMRC_PARAMS['basicRateLimit']
+        self.dividendAllowance = HMRC_PARAMS['dividendAllowance']
+        self.fullStatePension = HMRC_PARAMS['fullStatePension']
+
+        self.tuiPension = 1700.0 # Amount age 60
+
+        # Growth rates and inflation
+        self._CPI = SIM_PARAMS['CPI']
+        self._RPI = SIM_PARAMS['RPI']
+        self._portfolioGrowth = SIM_PARAMS['portfolioGrowth']
+
+        # Income required in retirement
+        self._livingExpenses1 = SIM_PARAMS['livingExpenses1']     # Net amount needed per annum for first N years of retirement
+        self._livingExpenses2 = SIM_PARAMS['livingExpenses2']     # Net amount needed in second stage of retirement
+        self._expensiveYears  = SIM_PARAMS['expensiveYears']      # Number of years for which higher living expenses are needed
+
+    def get_CPI(self):
+        return self._CPI
+    def get_RPI(self):
+        return self._RPI
+    def get_portfolioGrowth(self):
+        return self._portfolioGrowth
+    def get_livingExpenses1(self):
+        return self._livingExpenses1
+    def get_livingExpenses2(self):
+        return self._livingExpenses2
+    def get_expensiveYears(self):
+        return self._expensiveYears
+
+    def set_CPI(self,amount):
+        self._CPI = amount
+    def set_RPI(self,amount):
+        self._RPI = amount
+    def set_portfolioGrowth(self,amount):
+        self._portfolioGrowth = amount
+    def set_livingExpenses1(self,amount):
+        self._livingExpenses1 = amount
+    def set_livingExpenses2(self,amount):
+        self._livingExpenses2 = amount
+    def set_expensiveYears(self,amount):
+        self._expensiveYears = amount
@@ -0,0 +1,248 @@
+# Monthly version of the retirement simulation
+#
+# Works in months (April to March within each tax year) rather than whole tax
+# years, so state/TUI pensions start in the month they are due and ISA and
+# trading account income can follow the dividends the portfolio actually pays
+# through the year.
+#
+# The same drawdown rules as SimPerson are used. ISA and trading account
+# income is the year's drawdown as in SimPerson, spread over the months by
+# the dividend profile (evenly without one), so each tax year's totals are
+# those of Simulation. The DC pension is drawn with a monthly rate. Each pot's
+# balance follows a linear recurrence (a fixed fraction drawn, then growth),
+# so every month is worked out at once with cumulative products rather than
+# stepping month by month. Tax is income_tax() on the cumulative taxable
+# income within each tax year, and the savings top-up is a capped cumulative
+# sum, so only the loop over persons remains.
+
+import logging
+import numpy as np
+from datetime import datetime, timedelta
+
+from SimulationClasses import income_tax, sim_schedules, SIM_FIELDS
+from TaxCalendar import date_buckets
+
+from SimulationConfig import SimConfig
+
+MONTHS = 12
+
+# Month of the tax year (April=0 ... March=11) for a calendar month (1-12)
+def tax_month(month):
+    return (np.asarray(month) - 4) % MONTHS
+
+
+# Monthly income yield of an account type (by month of the tax year) from the
+# dividend projections of its positions over the next year. Only its shape is
+# used, to spread the year's drawdown over the months.
+def dividend_profile(portfolio, account_type, start=None):
+    if start is None:
+        start = datetime.today().replace(day=1)
+    end = start + timedelta(weeks=52)
+
+    profile = np.zeros(MONTHS)
+    value = 0.0
+    for pos in portfolio.positions(account_type):
+        value += pos.value()
+        projections = pos.dividend_projections(start, end)
+        if not projections:
+            continue
+        dates = sorted(projections.keys())
+        months = tax_month(date_buckets(dates)['month'])
+        for m, dt in zip(months, dates):
+            profile[m] += sum(p['amount'] for p in projections[dt])
+
+    if value <= 0:
+        return profile
+    return profile / value
+
+# Profiles for the ISA and trading accounts of each person
+def dividend_profiles(portfolios, start=None):
+    return {id: {'ISA': dividend_profile(p, 'ISA', start), 'Trd': dividend_profile(p, 'Trd', start)}
+            for id, p in portfolios.items()}
+
+
+class MonthlySimulation:
+    def __init__(self, startYear, nYears, persons, dividendProfiles=None, config=None):
+        self._startYear = startYear
+        self._nYears = nYears
+        self._nMonths = nYears * MONTHS
+        self._persons = persons
+        self._ids = sorted(persons.keys())
+        self._profiles = {} if dividendProfiles is None else dividendProfiles
+        self._config = SimConfig() if config is None else config
+
+        self.run()
+
+    def firstYear(self):
+        return self._startYear
+
+    def lastYear(self):
+        return self._startYear + self._nYears - 1
+
+    def persons(self):
+        return self._persons
+
+    # First day of each month and number of days in it
+    def month_dates(self):
+        first = np.datetime64(f"{self._startYear}-04", 'M') + np.arange(self._nMonths + 1)
+        days = first.astype('datetime64[D]')
+        return days[:-1], np.diff(days).astype(float)
+
+    # Fraction of each month for which a pension starting on start_date is paid
+    def month_fractions(self, start_date, monthStart, monthDays):
+        start = np.datetime64(start_date, 'D')
+        remaining = (monthStart + monthDays.astype('timedelta64[D]') - start).astype(float)
+        return np.clip(remaining / monthDays, 0.0, 1.0)
+
+    # Balance of a pot each month where a_{m+1} = keep_m * a_m - out_m, along
+    # with the balance at the start of each month
+    def pot_balances(self, a0, keep, out=None):
+        growth = np.concatenate(([1.0], np.cumprod(keep)))
+        if out is None:
+            return growth * a0
+        paid = np.concatenate(([0.0], np.cumsum(out / growth[1:])))
+        return growth * (a0 - paid)
+
+    # Balance of a pot at the end of each month, and the amount drawn each
+    # month, where a fraction of the balance at the start of each tax year is
+    # drawn (as in SimPerson) and spread over the months by weights
+    def year_drawdown(self, a0, rate, yearGrowth, weights):
+        yearStart = a0 * ((1 - rate) * yearGrowth) ** np.arange(self._nYears)
+        drawn = np.outer(rate * yearStart, weights)
+        growth = yearGrowth ** (np.arange(1, MONTHS + 1) / MONTHS)
+        balance = (yearStart[:, None] - np.cumsum(drawn, axis=1)) * growth
+        return balance.ravel(), drawn.ravel()
+
+    # Weights of the months in the year from a dividend profile
+    def month_weights(self, profile):
+        if profile is None or not np.sum(profile) > 0:
+            return np.full(MONTHS, 1 / MONTHS)
+        return np.asarray(profile) / np.sum(profile)
+
+    def run(self):
+        conf = self._config
+        nMonths = self._nMonths
+        sched = sim_schedules(conf, self._startYear, self._nYears)
+
+        # Yearly values spread over months
+        year = np.repeat(np.arange(self._nYears), MONTHS)
+        expenses = sched['livingExpenses'][year] / MONTHS
+        fullSP = sched['fullStatePension'][year] / MONTHS
+        tuiPension = sched['tuiPension'][year] / MONTHS
+        taxFree = sched['taxFreeAmount'][year]
+        basicRate = sched['basicRateAmount'][year]
+
+        yearGrowth = 1 + conf.get_portfolioGrowth()
+        growth = np.full(nMonths, yearGrowth ** (1 / MONTHS))
+        monthStart, monthDays = self.month_dates()
+
+        fin = {k: np.zeros((nMonths, len(self._ids))) for k in SIM_FIELDS}
+        requiredIncome = expenses.copy()
+
+        for i, id in enumerate(self._ids):
+            person = self._persons[id]
+            assets = person.assets()
+            profiles = self._profiles.get(id, {})
+
+            # State and DB pensions
+            spAmount = fullSP * person.spRatio() * self.month_fractions(person.spDate(), monthStart, monthDays)
+            dbPens = np.zeros(nMonths)
+            if person.tuiDate() is not None:
+                dbPens = tuiPension * self.month_fractions(person.tuiDate(), monthStart, monthDays)
+
+            # DC pension: a fraction drawn each month plus any state pension top up
+            ddPens = person.drawdownPens() / MONTHS
+            spTopUp = np.zeros(nMonths)
+            if person.spShortfall() == "Yes":
+                spTopUp = np.where(spAmount < fullSP, fullSP - spAmount, 0.0)
+            aPn = self.pot_balances(assets['Pens'], (1 - ddPens) * growth, spTopUp * growth)
+            drawdownAmount = ddPens * aPn[:-1]
+            dcPens = drawdownAmount + spTopUp
+
+            # ISA and trading income are the year's drawdown, paid as the
+            # dividends are if there is a profile (the trading account doesn't grow)
+            aISA, isaAmount = self.year_drawdown(assets['ISA'], person.drawdownISA(), yearGrowth, self.month_weights(profiles.get('ISA')))
+            aTrd, trdAmount = self.year_drawdown(assets['Trd'], person.drawdownTrd(), 1.0, self.month_weights(profiles.get('Trd')))
+
+            # Tax on the cumulative taxable income within each tax year
+            taxableIncome = spAmount + dbPens + dcPens
+            cumTaxable = np.cumsum(taxableIncome.reshape(self._nYears, MONTHS), axis=1).ravel()
+            cumTax = income_tax(cumTaxable, taxFree, basicRate, conf.taxrateBasic, conf.taxrateHigh)
+            cumTax = cumTax.reshape(self._nYears, MONTHS)
+            taxPayable = np.diff(cumTax, axis=1, prepend=0.0).ravel()
+
+            # Savings make up any shortfall until they run out (they don't grow)
+            targetIncome = requiredIncome - (taxableIncome - taxPayable) - isaAmount - trdAmount
+            savAmount = np.zeros(nMonths)
+            if person.savShortfall() == "Yes":
+                drawn = np.minimum(np.cumsum(np.maximum(targetIncome, 0.0)), assets['Sav'])
+                savAmount = np.diff(drawn, prepend=0.0)
+            aSav = assets['Sav'] - np.cumsum(savAmount)
+
+            taxfreeIncome = isaAmount + trdAmount + savAmount
+            income = taxfreeIncome + taxableIncome - taxPayable
+            requiredIncome = requiredIncome - income
+
+            # Balances at the end of each month
+            for k, v in (('aPn', aPn[1:]), ('aISA', aISA), ('aTrd', aTrd), ('aSav', aSav),
+                         ('pensSP', spAmount), ('pensDB', dbPens), ('pensDC', dcPens),
+                         ('pensDC.DD', drawdownAmount), ('pensDC.spTU', spTopUp),
+                         ('taxable', taxableIncome), ('tax', taxPayable),
+                         ('iISA', isaAmount), ('iTrd', trdAmount), ('iSav', savAmount),
+                         ('taxfree', taxfreeIncome), ('_income', income)):
+                fin[k][:, i] = v
+
+        self._fin = fin
+        self._shortfall = requiredIncome
+        self._monthStart = monthStart
+
+    #--- Results
+
+    # Array shaped (months, persons) for one of SIM_FIELDS
+    def values(self, field):
+        return self._fin[field]
+
+    def months(self):
+        return self._monthStart
+
+    # Income still required each month after all persons' income
+    def shortfall(self):
+        return self._shortfall
+
+    # Yearly totals (pots at the end of the tax year), shaped (years, persons)
+    def annual(self, field):
+        v = self._fin[field].reshape(self._nYears, MONTHS, len(self._ids))
+        if field in ('aPn', 'aISA', 'aTrd', 'aSav'):
+            return v[:, -1, :]
+        return v.sum(axis=1)
+
+    def __repr__(self):
+        s = "MonthlySimulation(%d-%d)\nYear,Person,Income,Tax,Pens,ISA,Trd,Sav\n" % (self.firstYear(), self.lastYear())
+        for t in range(self._nYears):
+            for i, id in enumerate(self._ids):
+                s += "%d,%s,%.0f,%.0f,%.0f,%.0f,%.0f,%.0f\n" % (
+                    self._startYear + t, id, self.annual('_income')[t, i], self.annual('tax')[t, i],
+                    self.annual('aPn')[t, i], self.annual('aISA')[t, i], self.annual('aTrd')[t, i], self.annual('aSav')[t, i])
+        return s
+
+
+if __name__ == '__main__':
+
+    import time
+    from SecurityClasses import SecurityUniverse
+    from PortfolioClasses import UserPortfolioGroup
+    from SimulationClasses import sim_persons
+    from config import SECURITYINFO, ACCOUNTINFO
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    secu = SecurityUniverse(SECURITYINFO)
+    pgrp = UserPortfolioGroup(secu, ACCOUNTINFO)
+
+    persons = sim_persons(pgrp)
+    portfolios = {pgrp.portfolio(name).id(): pgrp.portfolio(name) for name in pgrp.users()}
+
+    t0 = time.perf_counter()
+    sim = MonthlySimulation(2024, 40, persons, dividend_profiles(portfolios))
+    print(sim)
+    print(f"40 years monthly in {time.perf_counter()-t0:.3f}s")
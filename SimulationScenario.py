@@ -0,0 +1,70 @@
+# One scenario of a simulation sweep
+#
+# A scenario is a dict of parameter values, either simulation settings (see
+# SWEEP_CONFIG_PARAMS) or per-person drawdown rates (SWEEP_PERSON_PARAMS). A
+# person parameter applies to everyone unless it is qualified with the
+# person's id, e.g. 'drawdownPens.1'.
+#
+# run_scenario() is what the sweep's worker processes run. Workers started
+# with spawn (the default on Windows) import this module afresh, so it only
+# needs the simulation itself and not pandas.
+
+import copy
+
+from SimulationClasses import Simulation, SIM_POTS
+
+SWEEP_CONFIG_PARAMS = ('CPI', 'RPI', 'portfolioGrowth', 'livingExpenses1', 'livingExpenses2', 'expensiveYears')
+SWEEP_PERSON_PARAMS = ('drawdownPens', 'drawdownISA', 'drawdownTrd')
+
+# Values recorded for each simulation year after the scenario parameters
+SWEEP_COLUMNS = ('Year', 'LivingExpenses', 'Income', 'Shortfall', 'Tax', 'Assets', 'MinPot')
+
+
+# Copy of the configuration with the scenario settings applied
+def scenario_config(config, scenario):
+    conf = copy.copy(config)
+    for name, value in scenario.items():
+        if name in SWEEP_CONFIG_PARAMS:
+            getattr(conf, f"set_{name}")(value)
+    return conf
+
+# Snapshot of each person with any drawdown rates from the scenario
+def scenario_persons(persons, scenario):
+    sim_persons = {}
+    for id, person in persons.items():
+        overrides = {}
+        for name, value in scenario.items():
+            param, _, person_id = name.partition('.')
+            if param in SWEEP_PERSON_PARAMS and person_id in ('', id):
+                overrides[param] = value
+        sim_persons[id] = person.snapshot(**overrides)
+    return sim_persons
+
+# Run one scenario and summarise each year (runs in a worker process)
+def run_scenario(startYear, nYears, persons, config, scenario):
+    sim = Simulation(startYear, nYears, scenario_persons(persons, scenario), scenario_config(config, scenario))
+
+    rows = []
+    for year in range(sim.firstYear(), sim.lastYear() + 1):
+        simyear = sim.yearData(year)
+        income = assets = tax = 0.0
+        minPot = None
+        for person in sim.persons().values():
+            income += person.fin(year, '_income')
+            tax += person.fin(year, 'tax')
+            pots = [person.fin(year, pot) for pot in SIM_POTS]
+            assets += sum(pots)
+            minPot = min(pots) if minPot is None else min(minPot, *pots)
+
+        row = dict(scenario)
+        row.update({
+            'Year':             year,
+            'LivingExpenses':   simyear.livingExpenses,
+            'Income':           income,
+            'Shortfall':        simyear.livingExpenses - income,
+            'Tax':              tax,
+            'Assets':           assets,
+            'MinPot':           minPot
+        })
+        rows.append(row)
+    return rows
@@ -0,0 +1,162 @@
+# Solve for sustainable living expenses or drawdown rates
+#
+# Rather than guessing livingExpenses/drawdown rates and re-running the
+# simulation until the pots last, search on a scale factor applied to them.
+# Each trial is a zero-volatility MonteCarloSimulation with one path per
+# candidate scale, so the same rules as Simulation are applied to all the
+# candidates at once, and each round of the search narrows the bracket to
+# the gap between two neighbouring candidates.
+#
+# A year fails if any pot goes negative or the living expenses can't be met.
+# A trial stops at the first year in which every candidate has failed.
+
+import logging
+import numpy as np
+
+from MonteCarloClasses import MonteCarloSimulation, MC_SHORTFALL_TOLERANCE
+
+from SimulationConfig import SimConfig
+
+SOLVER_MAX_ITERATIONS = 100
+
+# Scales tried in each round of the search
+SOLVER_CANDIDATES = 64
+
+
+# Boundary in [lo, hi] between ok(x) being True and False, given ok(lo) is True
+# and ok(hi) is False, where ok() takes an array of values. Returns the last
+# True and first False values found and the number of rounds.
+def bracket(ok, lo, hi, tol, maxIter=SOLVER_MAX_ITERATIONS):
+    n = 0
+    while hi - lo > tol and n < maxIter:
+        x = np.linspace(lo, hi, SOLVER_CANDIDATES + 2)[1:-1]
+        good = ok(x)
+        j = len(x) if good.all() else int(np.argmin(good))
+        if j > 0:
+            lo = x[j - 1].item()
+        if j < len(x):
+            hi = x[j].item()
+        n += 1
+    return lo, hi, n
+
+# First of the candidates for which ok() is False, None if there isn't one
+def first_false(ok, candidates):
+    good = ok(np.asarray(candidates, dtype=float))
+    return None if good.all() else candidates[int(np.argmin(good))]
+
+
+class SimulationSolver:
+    def __init__(self, startYear, nYears, persons, config=None):
+        self._startYear = startYear
+        self._nYears = nYears
+        self._persons = persons
+        self._ids = sorted(persons.keys())
+        self._config = SimConfig() if config is None else config
+        self._rates = [(p.drawdownPens(), p.drawdownISA(), p.drawdownTrd()) for p in (persons[id] for id in self._ids)]
+
+        # Number of simulations run
+        self.trials = 0
+
+    def firstYear(self):
+        return self._startYear
+
+    def lastYear(self):
+        return self._startYear + self._nYears - 1
+
+    # Simulation to targetYear with a path for each pair of scales, stopping
+    # once all have failed
+    def trial(self, expenseScales, drawdownScales, targetYear=None, tolerance=MC_SHORTFALL_TOLERANCE):
+        nYears = self._nYears if targetYear is None else min(self._nYears, targetYear - self._startYear + 1)
+        expenseScales, drawdownScales = np.broadcast_arrays(np.atleast_1d(np.asarray(expenseScales, dtype=float)),
+                                                            np.atleast_1d(np.asarray(drawdownScales, dtype=float)))
+        self.trials += 1
+        return MonteCarloSimulation(self._startYear, nYears, self._persons, nPaths=len(expenseScales), config=self._config,
+                                    expenseScale=expenseScales, drawdownScale=drawdownScales, stopTolerance=tolerance)
+
+    # First year up to targetYear which fails with living expenses and all
+    # drawdown rates scaled, for each pair of scales (None if every year is
+    # funded)
+    def first_failures(self, expenseScales=1.0, drawdownScales=1.0, targetYear=None, tolerance=MC_SHORTFALL_TOLERANCE):
+        failed = self.trial(expenseScales, drawdownScales, targetYear, tolerance).failures(tolerance)
+        first = np.argmax(failed, axis=1)
+        return [self._startYear + int(t) if failed[i, t] else None for i, t in enumerate(first)]
+
+    def first_failure(self, expenseScale=1.0, drawdownScale=1.0, targetYear=None, tolerance=MC_SHORTFALL_TOLERANCE):
+        return self.first_failures(expenseScale, drawdownScale, targetYear, tolerance)[0]
+
+    # Whether every year to targetYear is funded, for each pair of scales
+    def sustainable_paths(self, expenseScales=1.0, drawdownScales=1.0, targetYear=None, tolerance=MC_SHORTFALL_TOLERANCE):
+        return ~self.trial(expenseScales, drawdownScales, targetYear, tolerance).failures(tolerance).any(axis=1)
+
+    def sustainable(self, expenseScale=1.0, drawdownScale=1.0, targetYear=None, tolerance=MC_SHORTFALL_TOLERANCE):
+        return bool(self.sustainable_paths(expenseScale, drawdownScale, targetYear, tolerance)[0])
+
+    # Highest living expenses (both stages scaled together, so still growing
+    # with RPI) which are funded every year to targetYear
+    def max_living_expenses(self, targetYear=None, tol=1.0, maxIter=SOLVER_MAX_ITERATIONS):
+        le1 = self._config.get_livingExpenses1()
+        le2 = self._config.get_livingExpenses2()
+        if max(le1, le2) <= 0:
+            raise ValueError("max_living_expenses: no living expenses to scale")
+        ok = lambda scales: self.sustainable_paths(expenseScales=scales, targetYear=targetYear)
+
+        # Nothing is sustainable, otherwise find a failing upper bound
+        candidates = [0.0] + [2.0 ** k for k in range(11)]
+        hi = first_false(ok, candidates)
+        if hi == 0.0:
+            return None
+        if hi is None:
+            hi = candidates[-1]
+
+        scale, _, n = bracket(ok, 0.0, hi, tol / max(le1, le2), maxIter)
+        logging.debug(f"max_living_expenses: scale={scale:.4f} after {n} rounds")
+        return {'scale': scale, 'livingExpenses1': le1 * scale, 'livingExpenses2': le2 * scale, 'iterations': n}
+
+    # Lowest common multiple of everyone's drawdown rates (none above 100%)
+    # which funds the current living expenses every year to targetYear.
+    # Drawing down too much also fails (the pots run out), so the search
+    # starts from the current rates and only goes up far enough to succeed.
+    def min_drawdown_scale(self, targetYear=None, tol=1e-4, maxIter=SOLVER_MAX_ITERATIONS):
+        top = max(max(rates) for rates in self._rates)
+        if top <= 0:
+            return None
+        fails = lambda scales: ~self.sustainable_paths(drawdownScales=scales, targetYear=targetYear)
+
+        # Sustainable without drawing down, otherwise find a sustainable
+        # upper bound no more than 1/top
+        candidates = [0.0, 1.0]
+        while candidates[-1] * 2 <= 1.0 / top:
+            candidates.append(candidates[-1] * 2)
+        hi = first_false(fails, candidates)
+        if hi == 0.0:
+            return {'scale': 0.0, 'iterations': 0}
+        if hi is None:
+            return None
+
+        # The boundary is the first sustainable scale
+        _, scale, n = bracket(fails, 0.0, hi, tol, maxIter)
+        rates = {id: tuple(r * scale for r in rates) for id, rates in zip(self._ids, self._rates)}
+        logging.debug(f"min_drawdown_scale: scale={scale:.4f} after {n} rounds")
+        return {'scale': scale, 'rates': rates, 'iterations': n}
+
+
+if __name__ == '__main__':
+
+    import time
+    from SecurityClasses import SecurityUniverse
+    from PortfolioClasses import UserPortfolioGroup
+    from SimulationClasses import sim_persons
+    from config import SECURITYINFO, ACCOUNTINFO
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    secu = SecurityUniverse(SECURITYINFO)
+    pgrp = UserPortfolioGroup(secu, ACCOUNTINFO)
+
+    persons = sim_persons(pgrp)
+
+    t0 = time.perf_counter()
+    solver = SimulationSolver(2022, 30, persons)
+    print(solver.max_living_expenses())
+    print(solver.min_drawdown_scale())
+    print(f"{solver.trials} trials in {time.perf_counter()-t0:.3f}s")
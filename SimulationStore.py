@@ -0,0 +1,154 @@
+# Store of finished simulation runs
+#
+# A run is keyed by a hash of everything its results depend on: the simulation
+# settings, each person's drawdown settings and starting assets, and the
+# horizon. Results are a tidy DataFrame (one row per year and person) kept in
+# memory for the most recently used runs and saved as Parquet under SIMRESULTS,
+# so the web UI and notebooks can reuse a run rather than simulating it again.
+
+import os
+import json
+import hashlib
+import logging
+import threading
+import pandas as pd
+from cachetools import LRUCache
+
+from SimulationClasses import Simulation, SIM_FIELDS
+from config import SIMRESULTS
+from atomicfile import atomic_write
+
+from SimulationConfig import SimConfig
+
+# Number of runs kept in memory
+SIM_STORE_SIZE = 32
+
+# Person settings which affect the results
+SIM_PERSON_SETTINGS = ('id', 'spDate', 'spRatio', 'drawdownPens', 'drawdownISA', 'drawdownTrd',
+                       'spShortfall', 'savShortfall', 'tuiDate')
+
+
+# Everything a run depends on, as plain values
+def simulation_inputs(config, persons, startYear, nYears):
+    return {
+        'startYear':    startYear,
+        'nYears':       nYears,
+        'config':       {k: v for k, v in sorted(vars(config).items())},
+        'persons':      [dict({s: getattr(persons[id], s)() for s in SIM_PERSON_SETTINGS},
+                              assets=persons[id].assets())
+                         for id in sorted(persons.keys())]
+    }
+
+def simulation_key(config, persons, startYear, nYears):
+    inputs = json.dumps(simulation_inputs(config, persons, startYear, nYears), sort_keys=True, default=str)
+    return hashlib.sha256(inputs.encode('utf-8')).hexdigest()[:32]
+
+# Results of a finished Simulation, one row per year and person
+def simulation_frame(sim):
+    years = list(range(sim.firstYear(), sim.lastYear() + 1))
+    expenses = sim.schedules()['livingExpenses']
+
+    frames = []
+    for id in sorted(sim.persons().keys()):
+        person = sim.persons()[id]
+        df = pd.DataFrame(person.ledger(), columns=list(SIM_FIELDS))
+        df.insert(0, 'Year', years)
+        df.insert(1, 'Person', id)
+        df.insert(2, 'Username', person.username())
+        df.insert(3, 'LivingExpenses', expenses)
+        frames.append(df)
+
+    if not frames:
+        return pd.DataFrame(columns=['Year', 'Person', 'Username', 'LivingExpenses'] + list(SIM_FIELDS))
+    return pd.concat(frames, ignore_index=True).sort_values(['Year', 'Person'], kind='stable').reset_index(drop=True)
+
+# Rows of a results frame for JSON, with missing values as None
+def frame_records(df):
+    return df.astype(object).where(df.notna(), None).to_dict(orient='records')
+
+
+class SimulationStore:
+    def __init__(self, directory=SIMRESULTS, maxsize=SIM_STORE_SIZE):
+        self._dirname = directory
+        self._cache = LRUCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    def path(self, key):
+        if self._dirname is None:
+            return None
+        return os.path.join(self._dirname, f"{key}.parquet")
+
+    # Results for a key from memory or disk, None if the run isn't stored
+    def get(self, key):
+        with self._lock:
+            df = self._cache.get(key)
+        if df is not None:
+            return df
+
+        path = self.path(key)
+        if path is None or not os.path.exists(path):
+            return None
+        try:
+            df = pd.read_parquet(path)
+        except Exception as e:
+            logging.debug(f"SimulationStore.get({path}) {e}")
+            return None
+
+        with self._lock:
+            self._cache[key] = df
+        return df
+
+    # Keep the results of a run. Failing to save them only loses them from
+    # the store on disk, so the error is logged rather than raised.
+    def put(self, key, df):
+        with self._lock:
+            self._cache[key] = df
+
+        path = self.path(key)
+        if path is None:
+            return
+        try:
+            os.makedirs(self._dirname, exist_ok=True)
+            with atomic_write(path, 'wb') as fp:
+                df.to_parquet(fp, index=False)
+        except OSError as e:
+            logging.warning(f"SimulationStore.put({path}) {e}")
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    # Key and results of a run, simulating it only if it isn't already stored
+    def run(self, startYear, nYears, persons, config=None):
+        config = SimConfig() if config is None else config
+        key = simulation_key(config, persons, startYear, nYears)
+
+        df = self.get(key)
+        if df is None:
+            logging.debug(f"SimulationStore.run: simulating {key} {startYear}+{nYears}")
+            sim = Simulation(startYear, nYears, {id: p.snapshot() for id, p in persons.items()}, config)
+            df = simulation_frame(sim)
+            self.put(key, df)
+        return key, df
+
+
+if __name__ == '__main__':
+
+    import time
+    from SecurityClasses import SecurityUniverse
+    from PortfolioClasses import UserPortfolioGroup
+    from SimulationClasses import sim_persons
+    from config import SECURITYINFO, ACCOUNTINFO
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    secu = SecurityUniverse(SECURITYINFO)
+    pgrp = UserPortfolioGroup(secu, ACCOUNTINFO)
+
+    persons = sim_persons(pgrp)
+
+    store = SimulationStore()
+    for n in range(2):
+        t0 = time.perf_counter()
+        key, df = store.run(2022, 30, persons)
+        print(f"{key} {len(df)} rows in {time.perf_counter()-t0:.3f}s")
+    print(df.head(10).to_string(index=False))
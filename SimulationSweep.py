@@ -0,0 +1,99 @@
+# Run the retirement simulation over grids of parameters
+#
+# Each combination of the parameter values is a separate scenario (see
+# SimulationScenario). Scenarios are independent so they are run in parallel
+# over a process pool, and the results come back as a single tidy DataFrame
+# with one row per scenario and simulation year.
+
+import os
+import logging
+import itertools
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from SimulationScenario import run_scenario, SWEEP_CONFIG_PARAMS, SWEEP_PERSON_PARAMS, SWEEP_COLUMNS
+
+from SimulationConfig import SimConfig
+
+from MonteCarloClasses import MC_SHORTFALL_TOLERANCE
+
+SWEEP_MAX_WORKERS = os.cpu_count()
+
+
+# All combinations of the values in grid, e.g. {'CPI': [0.02, 0.03], 'RPI': [0.03]}
+def sweep_scenarios(grid):
+    for name in grid.keys():
+        param = name.split('.')[0]
+        if param not in SWEEP_CONFIG_PARAMS + SWEEP_PERSON_PARAMS:
+            raise ValueError(f"Unknown sweep parameter '{name}'")
+
+    names = list(grid.keys())
+    return [dict(zip(names, values)) for values in itertools.product(*[grid[n] for n in names])]
+
+# Keep the workers quiet, the simulation logs a lot at debug level
+def sweep_worker_init():
+    logging.getLogger().setLevel(logging.WARNING)
+
+
+# Simulate every combination of the parameter values in grid
+def simulation_sweep(startYear, nYears, persons, grid, config=None, max_workers=SWEEP_MAX_WORKERS):
+    config = SimConfig() if config is None else config
+    scenarios = sweep_scenarios(grid)
+    logging.debug(f"simulation_sweep: {len(scenarios)} scenarios over {list(grid.keys())}")
+
+    # Snapshots don't carry accounts/securities, so are cheap to send to workers
+    snapshots = {id: person.snapshot() for id, person in persons.items()}
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=sweep_worker_init) as pool:
+        futures = [pool.submit(run_scenario, startYear, nYears, snapshots, config, scenario)
+                   for scenario in scenarios]
+        for n, future in enumerate(futures):
+            for row in future.result():
+                row['Scenario'] = n
+                rows.append(row)
+
+    columns = ['Scenario'] + list(grid.keys()) + list(SWEEP_COLUMNS)
+    return pd.DataFrame(rows, columns=columns)
+
+# One row per scenario: whether every year was funded, first unfunded year and
+# assets. As in MonteCarloSimulation.failures(), a year isn't funded if the
+# living expenses can't be met or any pot is overdrawn.
+def sweep_summary(df, tolerance=MC_SHORTFALL_TOLERANCE):
+    params = [c for c in df.columns if c not in ('Scenario',) + SWEEP_COLUMNS]
+    unfunded = df[(df['Shortfall'] > tolerance) | (df['MinPot'] < 0)].groupby('Scenario')['Year'].min()
+
+    summary = df.groupby('Scenario').agg(
+        **{p: (p, 'first') for p in params},
+        TotalTax=('Tax', 'sum'),
+        MinAssets=('Assets', 'min'),
+        FinalAssets=('Assets', 'last')
+    )
+    summary['FirstUnfundedYear'] = unfunded.reindex(summary.index)
+    summary['Funded'] = summary['FirstUnfundedYear'].isna()
+    return summary.reset_index()
+
+
+if __name__ == '__main__':
+
+    from SecurityClasses import SecurityUniverse
+    from PortfolioClasses import UserPortfolioGroup
+    from SimulationClasses import sim_persons
+    from config import SECURITYINFO, ACCOUNTINFO
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.INFO)
+
+    secu = SecurityUniverse(SECURITYINFO)
+    pgrp = UserPortfolioGroup(secu, ACCOUNTINFO)
+
+    persons = sim_persons(pgrp)
+
+    grid = {
+        'portfolioGrowth':  [0.02, 0.03, 0.04, 0.05, 0.06],
+        'RPI':              [0.02, 0.03, 0.04, 0.05],
+        'livingExpenses1':  [50000.0, 55000.0, 60000.0, 65000.0],
+        'drawdownPens':     [0.03, 0.04, 0.05]
+    }
+
+    df = simulation_sweep(2022, 30, persons, grid)
+    print(sweep_summary(df).to_string(index=False))
@@ -0,0 +1,147 @@
+#------------------------------------------------------------------------------
+# Calendar tables for UK tax years, months and business days
+#
+# Every day from CAL_FIRST_YEAR to CAL_LAST_YEAR is laid out once as numpy
+# arrays, so mapping dates to buckets (calendar year, YYYYMM, tax year, etc.)
+# is an array lookup rather than a strptime per date. Dates may be given as
+# YYYYMMDD strings/ints, datetime64 values or datetime.date objects.
+#------------------------------------------------------------------------------
+
+import datetime
+import numpy as np
+
+CAL_FIRST_YEAR = 1990
+CAL_LAST_YEAR  = 2100
+
+MONTH_ABBR = np.array(['Jan','Feb','Mar','Apr','May','Jun','Jul','Aug','Sep','Oct','Nov','Dec'])
+
+# UK tax year starts on 6th April
+TAX_YEAR_START_MONTH = 4
+TAX_YEAR_START_DAY   = 6
+
+#--- Day table
+
+CAL_START = np.datetime64(f"{CAL_FIRST_YEAR}-01-01", 'D')
+CAL_END   = np.datetime64(f"{CAL_LAST_YEAR}-12-31", 'D')
+
+CAL_DAYS     = np.arange(CAL_START, CAL_END + 1, dtype='datetime64[D]')
+CAL_YEAR     = CAL_DAYS.astype('datetime64[Y]').astype(np.int64) + 1970
+CAL_MONTH    = CAL_DAYS.astype('datetime64[M]').astype(np.int64) % 12 + 1
+CAL_DAY      = (CAL_DAYS - CAL_DAYS.astype('datetime64[M]')).astype(np.int64) + 1
+CAL_YYYYMMDD = CAL_YEAR * 10000 + CAL_MONTH * 100 + CAL_DAY
+CAL_YYYYMM   = CAL_YEAR * 100 + CAL_MONTH
+CAL_WEEKDAY  = (CAL_DAYS.astype(np.int64) + 3) % 7           # Mon=0 (1970-01-01 was a Thursday)
+CAL_BUSDAY   = CAL_WEEKDAY < 5
+CAL_TAX_YEAR = CAL_YEAR - ((CAL_MONTH < TAX_YEAR_START_MONTH) |
+                           ((CAL_MONTH == TAX_YEAR_START_MONTH) & (CAL_DAY < TAX_YEAR_START_DAY)))
+
+#--- Tax year table, indexed by tax year - TAX_YEAR_FIRST
+
+TAX_YEAR_FIRST  = CAL_FIRST_YEAR - 1
+TAX_YEARS       = np.arange(TAX_YEAR_FIRST, CAL_LAST_YEAR + 1)
+TAX_YEAR_LABELS = np.array([f"{y}/{y-2000+1}" for y in TAX_YEARS])
+TAX_YEAR_STARTS = np.array([f"{y}-04-06" for y in TAX_YEARS], dtype='datetime64[D]')
+TAX_YEAR_ENDS   = np.array([f"{y+1}-04-05" for y in TAX_YEARS], dtype='datetime64[D]')
+
+
+# Position of each date in the day table
+def day_index(dates):
+    arr = np.asarray(dates)
+    if arr.dtype == object and arr.size > 0 and isinstance(arr.flat[0], datetime.date):
+        arr = arr.astype('datetime64[D]')
+
+    idx, bad = lookup_days(arr)
+    if np.any(bad):
+        raise ValueError(f"Date(s) not in calendar {CAL_FIRST_YEAR}-{CAL_LAST_YEAR}: {arr[bad][:5]}")
+    return idx
+
+# Day table positions plus a mask of dates which aren't in the table
+def lookup_days(arr):
+    if np.issubdtype(arr.dtype, np.datetime64):
+        idx = (arr.astype('datetime64[D]') - CAL_START).astype(np.int64)
+        bad = np.isnat(arr) | (idx < 0) | (idx >= len(CAL_DAYS))
+    else:
+        ymd = arr.astype(np.int64)
+        idx = np.searchsorted(CAL_YYYYMMDD, ymd)
+        bad = (idx >= len(CAL_DAYS)) | (CAL_YYYYMMDD[np.minimum(idx, len(CAL_DAYS)-1)] != ymd)
+    return np.where(bad, 0, idx), bad
+
+# YYYYMMDD strings (or None) to datetime64[D], with NaT for missing/bad dates
+def to_datetime64(dates):
+    arr = np.asarray(dates, dtype=object)
+    out = np.full(arr.shape, np.datetime64('NaT'), dtype='datetime64[D]')
+    ok  = np.array([isinstance(d, (str, int)) and str(d).isdigit() for d in arr.flat], dtype=bool).reshape(arr.shape)
+    if np.any(ok):
+        idx, bad = lookup_days(arr[ok])
+        out[ok] = np.where(bad, np.datetime64('NaT'), CAL_DAYS[idx])
+    return out
+
+# datetime64[D] back to YYYYMMDD strings
+def to_yyyymmdd(days):
+    return CAL_YYYYMMDD[day_index(np.asarray(days, dtype='datetime64[D]'))].astype(str)
+
+# datetime64[D] to strings in a strftime format for display, '' for NaT
+def format_days(days, fmt):
+    return ['' if d is None else d.strftime(fmt) for d in np.asarray(days, dtype='datetime64[D]').tolist()]
+
+# Same day and month a number of years later, 29th February becoming the 28th
+def add_years(days, years=1):
+    b = date_buckets(days)
+    day = np.where((b['month'] == 2) & (b['day'] == 29), 28, b['day'])
+    months = (b['year'] + years - 1970) * 12 + b['month'] - 1
+    return months.astype('datetime64[M]').astype('datetime64[D]') + (day - 1)
+
+def tax_year_index(tax_years):
+    ty = np.asarray(tax_years, dtype=np.int64)
+    if np.any((ty < TAX_YEAR_FIRST) | (ty > CAL_LAST_YEAR)):
+        raise ValueError(f"Tax year(s) not in calendar: {ty}")
+    return ty - TAX_YEAR_FIRST
+
+
+# All of the buckets for a set of dates from one lookup
+def date_buckets(dates):
+    idx = day_index(dates)
+    ty  = CAL_TAX_YEAR[idx]
+    return {
+        'date':         CAL_DAYS[idx],
+        'year':         CAL_YEAR[idx],
+        'month':        CAL_MONTH[idx],
+        'day':          CAL_DAY[idx],
+        'yyyymm':       CAL_YYYYMM[idx],
+        'month_abbr':   MONTH_ABBR[CAL_MONTH[idx] - 1],
+        'tax_year':     ty,
+        'tax_year_label': TAX_YEAR_LABELS[ty - TAX_YEAR_FIRST],
+        'busday':       CAL_BUSDAY[idx]
+    }
+
+def tax_year(dates):
+    return CAL_TAX_YEAR[day_index(dates)]
+
+def tax_year_label(tax_years):
+    return TAX_YEAR_LABELS[tax_year_index(tax_years)]
+
+# First and last day of a tax year (6th April to 5th April) as dates
+def tax_year_bounds(year):
+    i = tax_year_index(year)
+    return TAX_YEAR_STARTS[i].astype(datetime.date), TAX_YEAR_ENDS[i].astype(datetime.date)
+
+def month_abbr(yyyymm):
+    return MONTH_ABBR[np.asarray(yyyymm, dtype=np.int64) % 100 - 1]
+
+def is_business_day(dates):
+    return CAL_BUSDAY[day_index(dates)]
+
+# Move any weekend dates forward to the following Monday
+def next_business_day(dates):
+    return np.busday_offset(CAL_DAYS[day_index(dates)], 0, roll='forward')
+
+# Start of day as datetime64[D]
+def datetime64(dt):
+    return np.datetime64(dt.date() if isinstance(dt, datetime.datetime) else dt, 'D')
+
+
+if __name__ == '__main__':
+
+    print(date_buckets(['20240405', '20240406', '20241231']))
+    print(tax_year_bounds(2024))
+    print(next_business_day(['20240406', '20240407', '20240408']))
@@ -1,10 +1,12 @@
-import logging, re, datetime
+import logging, re, datetime, time
+import functools, hashlib, json
 
-from flask import render_template, flash, session, redirect, url_for, request, jsonify, send_from_directory, g
+import flask
+from flask import flash, session, redirect, url_for, request, jsonify, send_from_directory, g
 from werkzeug.utils import secure_filename
 
 from . import app
-from . import uport, secu, sim_conf
+from . import uport, secu, sim_conf, data_gen
 
 from .forms import PieChartForm, AccountNameForm, AccountTypeForm, PlatformNameForm
 from .forms import FileDownloadCashForm, FileDownloadForm, CashForm, getPositionsForm
@@ -17,6 +19,152 @@ from SecurityClasses import security_update_json
 
 from wb import GspreadAuth, WbIncome, WbSecMaster, WsByPosition
 from wb_bysecurity import WsDividendsBySecurity, WsEstimatedIncome
+from wb_refresh import refresh_all
+from SimulationClasses import sim_persons
+from SimulationStore import SimulationStore, simulation_inputs, frame_records
+from SimulationScenario import scenario_config
+from TaxCalendar import tax_year
+from metrics import span, start_request, finish_request, observe_request, timing_header, metrics_text
+from profiling import RequestProfile, profiled_route, profile_name, PROFILE_ENGINES
+from PageCache import PageCache, PAGE_CACHE_BYTES
+
+# Finished simulation runs, shared by all requests
+sim_store = SimulationStore(app.config['SIMRESULTS'])
+
+# Rendered report pages, shared by all requests
+page_cache = PageCache(app.config.get('PAGECACHE'), app.config.get('PAGE_CACHE_BYTES', PAGE_CACHE_BYTES))
+
+# ---------------------------------------------------------------------------------------
+# Timing of each request by route, and of the steps within it (see metrics.py)
+# ---------------------------------------------------------------------------------------
+
+@app.before_request
+def start_timing():
+    g.request_start = time.perf_counter()
+    start_request()
+
+@app.after_request
+def record_timing(response):
+    elapsed = time.perf_counter() - g.get('request_start', time.perf_counter())
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    observe_request(route, request.method, response.status_code, elapsed)
+    spans = finish_request()
+    if app.config.get('METRICS_TIMING_HEADER'):
+        response.headers['X-Timing'] = timing_header(spans, elapsed)
+    return response
+
+def render_template(html, **kwargs):
+    with span('render_template', template=html):
+        return flask.render_template(html, **kwargs)
+
+@app.route('/metrics')
+def metrics():
+    return app.response_class(metrics_text(), mimetype='text/plain; version=0.0.4')
+
+# ---------------------------------------------------------------------------------------
+# Profile of a request with ?profile=1 (or =cprofile, =pyinstrument, =text)
+# when enabled in config (see profiling.py)
+# ---------------------------------------------------------------------------------------
+
+@app.before_request
+def start_profile():
+    mode = request.args.get('profile')
+    if not mode or not app.config.get('PROFILE_ENABLED') or not profiled_route(request.path, app.config['PROFILE_ROUTES']):
+        return
+    g.profile = RequestProfile(mode if mode in PROFILE_ENGINES else app.config['PROFILE_ENGINE'])
+    g.profile.start()
+
+@app.after_request
+def finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return response
+    profile.stop()
+    filename = profile.save(app.config['PROFILEDIR'], profile_name(request.path))
+    if request.args.get('profile') == 'text':
+        response = app.response_class(profile.text(), mimetype='text/plain')
+    response.headers['X-Profile'] = url_for('profile_file', filename=filename)
+    return response
+
+@app.route('/profiles/<filename>')
+def profile_file(filename):
+    if not app.config.get('PROFILE_ENABLED'):
+        return jsonify({'error': 'profiling is not enabled'}), 404
+    return send_from_directory(app.config['PROFILEDIR'], secure_filename(filename), as_attachment=True)
+
+# ---------------------------------------------------------------------------------------
+# Reload the securities and portfolios, moving on the data generation if the
+# files have changed (see DataGeneration.py)
+# ---------------------------------------------------------------------------------------
+
+def refresh_data():
+    def reload():
+        secu.refresh()
+        uport.refresh(secu)
+    return data_gen.update(reload)
+
+# ---------------------------------------------------------------------------------------
+# Caching of report pages. A report only depends on the data loaded (the
+# signature of its files, see DataGeneration.py), the session filters, the
+# page requested and (for dividend windows) today's date. So a browser
+# revalidating a page it already has gets a 304, and a page rendered before
+# is served from page_cache, without the report being built or rendered.
+# ---------------------------------------------------------------------------------------
+
+REPORT_SESSION_KEYS = ('ACCOUNT_NAME', 'ACCOUNT_TYPE', 'PLATFORM_NAME', 'ACCOUNT_ID', 'ASSET_CLASS', 'ASSET_RISK', 'SECURITY_ID')
+
+def report_inputs():
+    return {
+        'data':         data_gen.signature(),
+        'path':         request.full_path,
+        'session':      {k: session.get(k) for k in REPORT_SESSION_KEYS},
+        'date':         datetime.date.today().isoformat()
+    }
+
+def report_etag():
+    return hashlib.sha1(json.dumps(report_inputs(), sort_keys=True, default=str).encode('utf-8')).hexdigest()[:20]
+
+# Only the ETag is checked: If-Modified-Since can't tell pages for other
+# filters or another day apart, so Last-Modified is just for information
+def report_not_modified(etag):
+    return bool(request.if_none_match) and request.if_none_match.contains_weak(etag)
+
+def conditional_report(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        # Pages showing flashed messages are always built
+        if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+            return view(*args, **kwargs)
+
+        etag = report_etag()
+        if report_not_modified(etag):
+            response = app.response_class(status=304)
+        else:
+            response = flask.make_response(view(*args, **kwargs))
+
+        response.set_etag(etag, weak=True)
+        last_modified = data_gen.last_modified()
+        if last_modified is not None:
+            response.last_modified = int(last_modified)
+        response.cache_control.no_cache = True
+        response.vary.add('Cookie')
+        return response
+    return wrapper
+
+def cached_report(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+            return view(*args, **kwargs)
+
+        signature, key = data_gen.signature(), report_etag()
+        html = page_cache.get(signature, key)
+        if html is None:
+            html = view(*args, **kwargs)
+            if isinstance(html, str):
+                page_cache.put(signature, key, html, data_gen.signature())
+        return html
+    return wrapper
 
 # ---------------------------------------------------------------------------------------
 # Function to render a paginated list on screen
@@ -75,8 +223,7 @@ def render_paginated_listn(html, all, endpoint, nitems, **kwargs):
 def index():
 
     # Refresh accounts (after picking up any security updates)
-    secu.refresh()
-    uport.refresh(secu)
+    refresh_data()
 
     # Remove 'webreport' keys to aid debugging
     for key in ('COB','COB2','DOMAIN','DOMAIN2','ENV','ENV2','sn','givenName','userId','name'):
@@ -101,6 +248,8 @@ def index():
 # ----------------------------------------------------------------------------------------------
 
 @app.route('/assets/account', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def assets_by_account():
     title = "Portfolio Summary"
     all = uport.tdl_account_asset_value(session.get('ACCOUNT_NAME'), session.get('ACCOUNT_TYPE'))
@@ -112,6 +261,8 @@ def assets_by_account():
 # ----------------------------------------------------------------------------------------------
 
 @app.route('/income/account', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def income_by_account():
     title = "Annual Income"
     all = uport.tdl_account_annual_income(session.get('ACCOUNT_NAME'), session.get('ACCOUNT_TYPE'))
@@ -123,30 +274,40 @@ def income_by_account():
 # ----------------------------------------------------------------------------------------------
 
 @app.route('/dividend/declarations', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def dividend_declarations():
     title = "Dividend Declarations"
     all = uport.tdl_dividend_declarations(session.get('ACCOUNT_NAME'), session.get('ACCOUNT_TYPE'))
     return render_paginated_list('dividends.html', all, 'dividend_declarations', title=title)
 
 @app.route('/dividend/projections', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def dividend_projections():
     title = "Projected Dividend Payments"
     all = uport.tdl_dividend_projections(session.get('ACCOUNT_NAME'), session.get('ACCOUNT_TYPE'))
     return render_paginated_list('dividends.html', all, 'dividend_projections', title=title)
 
 @app.route('/dividend/payments', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def dividend_payments():
     title = "Dividend Payments"
     all = uport.tdl_dividend_payments(session.get('ACCOUNT_NAME'), session.get('ACCOUNT_TYPE'))
     return render_paginated_list('dividends.html', all, 'dividend_payments', title=title)
 
 @app.route('/dividend/mdeclarations', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def dividend_mdeclarations():
     title = "Monthly Declarations"
     all = uport.tdl_dividend_mdeclarations(session.get('ACCOUNT_NAME'), session.get('ACCOUNT_TYPE'))
     return render_paginated_listn('dividends-m.html', all, 'dividend_mdeclarations', 50, title=title)
 
 @app.route('/dividend/mpayments', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def dividend_mpayments():
     title = "Monthly Payments"
     all = uport.tdl_dividend_mpayments(session.get('ACCOUNT_NAME'), session.get('ACCOUNT_TYPE'))
@@ -165,6 +326,8 @@ def assets_by_position(id):
     return assets_by_position2()
 
 @app.route('/assets/position', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def assets_by_position2():
     logging.debug("assets_by_position2: session=%s"%(session))
 
@@ -191,6 +354,8 @@ def income_by_position(id):
     return income_by_position2()
 
 @app.route('/income/position', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def income_by_position2():
     logging.debug("income_by_position2: session=%s"%(session))
 
@@ -262,6 +427,20 @@ def wb_estimated_income(nWeeks):
 
     return dividend_projections()
 
+@app.route('/wbincome/all', methods=['GET','POST'])
+def wb_income_all():
+    logging.debug("wb_income_all() request=%s"%(request))
+
+    ag = AccountGroup(uport.accounts(),None,None)
+
+    gsauth = GspreadAuth()
+    ForeverIncome = WbIncome(gsauth)
+    SecurityMaster = WbSecMaster(gsauth)
+
+    refresh_all(ForeverIncome, SecurityMaster, secu, ag.positions(), 52)
+
+    return redirect(url_for('index'))
+
     
 # ---------------------------------------------------------------------------------------
 # Breakdown of assets
@@ -306,6 +485,8 @@ def assets_by_class(id):
     return assets_by_class2()
 
 @app.route('/assets/class', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def assets_by_class2():
     logging.debug("assets_by_class2: session=%s"%(session))
 
@@ -334,6 +515,8 @@ def assets_by_risk(id):
     return assets_by_risk2()
 
 @app.route('/assets/risk', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def assets_by_risk2():
     logging.debug("assets_by_risk2: session=%s"%(session))
 
@@ -394,24 +577,32 @@ def parent_sector_breakdown():
 # ----------------------------------------------------------------------------------------------
 
 @app.route('/securities', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def securities():
     title = 'Invested Securities'
     all = secu.list_securities(None)
     return render_paginated_list('securities.html', all, 'securities', title=title)
 
 @app.route('/securities/IT', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def securities_IT():
     title = 'Invested Investment Trusts'
     all = secu.list_securities('IT')
     return render_paginated_list('securities.html', all, 'securities_IT', title=title)
 
 @app.route('/securities/OEIC', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def securities_OEIC():
     title = 'Invested OEICs'
     all = secu.list_securities('OEIC')
     return render_paginated_list('securities.html', all, 'securities_OEIC', title=title)
 
 @app.route('/securities/ETF', methods=['GET','POST'])
+@conditional_report
+@cached_report
 def securities_ETF():
     title = 'Invested ETFs'
     all = secu.list_securities('ETF')
@@ -423,6 +614,8 @@ def security(id):
     return security_detail()
 
 @app.route('/security', methods=['GET', 'POST'])
+@conditional_report
+@cached_report
 def security_detail():
     id = session['SECURITY_ID']
     s = secu.find_security(id)
@@ -443,7 +636,7 @@ def update_security(id):
     security_update_json(ForeverIncome, SecurityMaster, id)
     
     # Update in memory definition from new json file
-    secu.refresh()
+    data_gen.update(secu.refresh)
 
     # Show details of updated security
     s = secu.find_security(id)
@@ -705,3 +898,46 @@ def simulationScenario():
         form.simYears.data = int(session.get('SIM_YEARS'))
 
     return render_template('simulation.html', form=form)
+
+
+# ----------------------------------------------------------------------------------------------
+# Simulation results as JSON or Parquet, from the store when the same scenario has been run
+# ----------------------------------------------------------------------------------------------
+
+# Simulation settings from the session (as set on the simulation form)
+def session_sim_config():
+    scenario = {}
+    for name, key, conv in (('CPI', 'SIM_CPI', float), ('RPI', 'SIM_RPI', float), ('portfolioGrowth', 'SIM_GROWTH', float),
+                            ('livingExpenses1', 'SIM_EXPENSES1', float), ('livingExpenses2', 'SIM_EXPENSES2', float),
+                            ('expensiveYears', 'SIM_EXPYEARS', int)):
+        if session.get(key) is not None:
+            scenario[name] = conv(session.get(key))
+    return scenario_config(sim_conf, scenario)
+
+@app.route('/simulation/results', methods=['GET'])
+def simulation_results():
+    startYear = request.args.get('start', int(tax_year(datetime.date.today())), type=int)
+    nYears = request.args.get('years', int(session.get('SIM_YEARS', 20)), type=int)
+    config = session_sim_config()
+    persons = sim_persons(uport)
+
+    key, df = sim_store.run(startYear, nYears, persons, config)
+    return jsonify({
+        'key':      key,
+        'inputs':   simulation_inputs(config, persons, startYear, nYears),
+        'parquet':  url_for('simulation_results_parquet', key=key, _external=True),
+        'results':  frame_records(df)
+    })
+
+@app.route('/simulation/results/<key>', methods=['GET'])
+def simulation_results_key(key):
+    df = sim_store.get(key)
+    if df is None:
+        return jsonify({'error': f"No simulation results for {key}"}), 404
+    return jsonify({'key': key, 'results': frame_records(df)})
+
+@app.route('/simulation/results/<key>/parquet', methods=['GET'])
+def simulation_results_parquet(key):
+    if sim_store.get(key) is None:
+        return jsonify({'error': f"No simulation results for {key}"}), 404
+    return send_from_directory(app.config['SIMRESULTS'], f"{key}.parquet", as_attachment=True)
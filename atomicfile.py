@@ -0,0 +1,53 @@
+# Atomic replacement of files
+#
+# atomic_write(path) gives a file to write in place of 'path'. It is a
+# temporary file in the same directory (so the rename is atomic), with a name
+# unique to this writer and a leading '.' (so directory scans ignore it),
+# which replaces 'path' only once it has been written in full. Readers see
+# either the old or the new file, never a partial one, and concurrent writers
+# of the same file can't collide. If writing fails the temporary file is
+# removed and the error raised.
+
+import os
+import tempfile
+import contextlib
+
+# Mode given to a new file (mkstemp creates it private to the owner)
+ATOMIC_FILE_MODE = 0o644
+
+
+# With durable=True the data and the rename are flushed to disk as well
+@contextlib.contextmanager
+def atomic_write(path, mode='w', encoding=None, durable=False):
+    dirname = os.path.dirname(path) or '.'
+    fd, tmpfile = tempfile.mkstemp(prefix=f".{os.path.basename(path)}.", suffix=".tmp", dir=dirname)
+    try:
+        with os.fdopen(fd, mode, encoding=encoding) as fp:
+            yield fp
+            if durable:
+                fp.flush()
+                os.fsync(fp.fileno())
+        # Keep the permissions of the file being replaced
+        if os.path.isfile(path):
+            os.chmod(tmpfile, os.stat(path).st_mode & 0o7777)
+        else:
+            os.chmod(tmpfile, ATOMIC_FILE_MODE)
+        os.replace(tmpfile, path)
+    except BaseException:
+        with contextlib.suppress(OSError):
+            os.unlink(tmpfile)
+        raise
+
+    if durable:
+        sync_directory(dirname)
+
+# Make renames in a directory durable
+def sync_directory(dirname):
+    try:
+        dirfd = os.open(dirname, os.O_RDONLY)
+        try:
+            os.fsync(dirfd)
+        finally:
+            os.close(dirfd)
+    except OSError:
+        pass    # Directories can't be opened/synced on Windows
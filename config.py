@@ -21,6 +21,19 @@ ACCOUNT_NAME = 'ALL'    # Or something like 'User1'
 ACCOUNT_TYPE = 'ALL'    # Or something like 'ISA'
 PLATFORM_NAME = 'ALL'   # Or something like 'AJB'
 
+# Add an X-Timing header to each response with the time spent in each step
+METRICS_TIMING_HEADER = False
+
+# Allow ?profile=1 on these routes (those ending '/' are prefixes) to profile
+# the request with PROFILE_ENGINE ('cprofile' or 'pyinstrument'). Only turn
+# this on for admin use, as profiles show how the app works
+PROFILE_ENABLED = False
+PROFILE_ENGINE = 'cprofile'
+PROFILE_ROUTES = ('/dividend/', '/assets/', '/wbincome/', '/simulation')
+
+# Total size in bytes of the rendered report pages kept in memory (0 for none)
+PAGE_CACHE_BYTES = 32 * 1024 * 1024
+
 LOGLEVEL = 'DEBUG'
 # LOGLEVEL = 'INFO'
 
@@ -31,6 +44,10 @@ if HOME is None:
 USERDATA     = os.path.join(HOME, 'UserData')
 SECURITYINFO = os.path.join(HOME, 'SecurityInfo')
 ACCOUNTINFO  = os.path.join(HOME, 'AccountInfo')
+SHEETCACHE   = os.path.join(HOME, 'SheetCache')     # Local copies of Google Sheets source tabs
+SIMRESULTS   = os.path.join(HOME, 'SimResults')     # Saved simulation runs (Parquet)
+PROFILEDIR   = os.path.join(HOME, 'Profiles')       # Profiles of requests (?profile=1)
+PAGECACHE    = None                                 # Rendered reports saved on disk, e.g. os.path.join(HOME, 'PageCache')
 
 # 2022-23
 HMRC_PARAMS = {
@@ -1,9 +1,359 @@
+import os, sys
+import time
+import logging
+import subprocess
+import functools
+import pandas as pd
 
-from flask_script import Manager
+from flask import Flask
+from flask_script import Manager, Command, Option, Server, Shell
 
-from app import app
+from config import SECURITYINFO, ACCOUNTINFO
+
+# Output formats for reports
+CLI_FORMATS = ('csv', 'json', 'parquet')
+
+
+# Commands run with a bare Flask app, so batch jobs don't load the web app
+# (and all its data) just to produce a report
+def create_app(loglevel='WARNING'):
+    logging.basicConfig(stream=sys.stderr, format='%(levelname)s:%(message)s', level=getattr(logging, loglevel.upper()))
+    cliapp = Flask('foreverFund')
+    cliapp.config.from_object('config')
+    return cliapp
+
+# The server and shell load the web app when they start
+class WebServer(Server):
+    def __call__(self, app, *args, **kwargs):
+        from app import app as webapp
+        return Server.__call__(self, webapp, *args, **kwargs)
+
+class WebShell(Shell):
+    def __call__(self, app, *args, **kwargs):
+        from app import app as webapp
+        return Shell.__call__(self, webapp, *args, **kwargs)
+
+manager = Manager(create_app, with_default_commands=False)
+manager.add_option('-l', '--loglevel', dest='loglevel', default='WARNING', help='Logging level')
+manager.add_command('runserver', WebServer())
+manager.add_command('shell', WebShell())
+
+report = Manager(usage='Reports of portfolio positions')
+manager.add_command('report', report)
+
+
+# Securities and portfolios, loaded once for all the commands in a run
+@functools.lru_cache(maxsize=None)
+def portfolio_data():
+    from SecurityClasses import SecurityUniverse
+    from PortfolioClasses import UserPortfolioGroup
+
+    secu = SecurityUniverse(SECURITYINFO)
+    uport = UserPortfolioGroup(secu, ACCOUNTINFO)
+    return secu, uport
+
+def selected_positions(user=None, account_type=None, platform=None):
+    secu, uport = portfolio_data()
+    return uport.positions(user, account_type, platform)
+
+def write_frame(df, fmt, output=None):
+    if fmt == 'csv':
+        df.to_csv(output if output else sys.stdout, index=False)
+    elif fmt == 'json':
+        text = df.to_json(orient='records', date_format='iso', indent=2)
+        if output:
+            with open(output, 'w') as fp:
+                fp.write(text)
+        else:
+            print(text)
+    elif fmt == 'parquet':
+        if not output:
+            print("Parquet output needs a file (--output)", file=sys.stderr)
+            return 2
+        df.to_parquet(output, index=False)
+    else:
+        print(f"Unknown format '{fmt}', use one of {', '.join(CLI_FORMATS)}", file=sys.stderr)
+        return 2
+    return 0
+
+def position_details(pos):
+    acc = pos.account()
+    return {
+        'Who':          pos.username(),
+        'AccType':      pos.account_type(),
+        'Platform':     pos.platform(),
+        'AccountId':    "%s_%s_%s" % (acc.usercode(), pos.platform(), pos.account_type()),
+        'SecurityId':   pos.sname(),
+        'Name':         pos.lname()
+    }
+
+def assets_frame(positions):
+    rows = []
+    for pos in positions:
+        row = position_details(pos)
+        row.update({
+            'Quantity':         pos.quantity(),
+            'Price':            pos.price(),
+            'BookCost':         pos.cost(),
+            'Value':            pos.value(),
+            'ValueDate':        pos.vdate(),
+            'Equity':           pos.equity_value(),
+            'Bond':             pos.bond_value(),
+            'Infrastructure':   pos.infrastructure_value(),
+            'Property':         pos.property_value(),
+            'Commodity':        pos.commodity_value(),
+            'Cash':             pos.cash_value()
+        })
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+def income_frame(positions):
+    rows = []
+    for pos in positions:
+        row = position_details(pos)
+        income = pos.annual_income()
+        row.update({
+            'Value':        pos.value(),
+            'PayoutFreq':   pos.payout_frequency(),
+            'AnnualIncome': income,
+            'Yield':        income / pos.value() if pos.value() else None
+        })
+        rows.append(row)
+    return pd.DataFrame(rows)
+
+# Options shared by the reports
+REPORT_OPTIONS = (
+    Option('-u', '--user', dest='user', default=None, help='User name'),
+    Option('-t', '--type', dest='account_type', default=None, help='Account type, e.g. ISA'),
+    Option('-p', '--platform', dest='platform', default=None, help='Platform, e.g. AJB'),
+    Option('-f', '--format', dest='fmt', default='csv', choices=CLI_FORMATS),
+    Option('-o', '--output', dest='output', default=None, help='Output file (default stdout)')
+)
+
+class AssetsReport(Command):
+    "Value and asset allocation of each position"
+    option_list = REPORT_OPTIONS
+
+    def run(self, user, account_type, platform, fmt, output):
+        df = assets_frame(selected_positions(user, account_type, platform))
+        return write_frame(df, fmt, output)
+
+class IncomeReport(Command):
+    "Annual income and yield of each position"
+    option_list = REPORT_OPTIONS
+
+    def run(self, user, account_type, platform, fmt, output):
+        df = income_frame(selected_positions(user, account_type, platform))
+        return write_frame(df, fmt, output)
+
+report.add_command('assets', AssetsReport())
+report.add_command('income', IncomeReport())
+
+
+class Load(Command):
+    "Load securities and portfolios and summarise them"
+
+    def run(self):
+        t0 = time.perf_counter()
+        secu, uport = portfolio_data()
+        elapsed = time.perf_counter() - t0
+
+        print(f"Users:      {', '.join(uport.users())}")
+        print(f"Accounts:   {len(uport.accounts())}")
+        print(f"Positions:  {len(uport.positions())}")
+        print(f"Value:      £{uport.value():,.2f}")
+        print(f"Loaded in {elapsed:.3f}s")
+        return 0
+
+manager.add_command('load', Load())
+
+
+class SyncSheets(Command):
+    "Rebuild the Google Sheets income and security worksheets"
+    option_list = (
+        Option('-w', '--weeks', dest='nWeeks', default=52, type=int, help='Weeks of estimated income'),
+    )
+
+    def run(self, nWeeks):
+        from wb import GspreadAuth, WbIncome, WbSecMaster
+        from wb_refresh import refresh_all
+
+        secu, uport = portfolio_data()
+        gsauth = GspreadAuth()
+        refresh_all(WbIncome(gsauth), WbSecMaster(gsauth), secu, uport.positions(), nWeeks)
+        return 0
+
+manager.add_command('sync-sheets', SyncSheets())
+
+
+class Simulate(Command):
+    "Run the retirement simulation (reusing stored results) and write one row per year and person"
+    option_list = (
+        Option('-s', '--start', dest='startYear', default=None, type=int, help='First tax year (default current)'),
+        Option('-y', '--years', dest='nYears', default=30, type=int),
+        Option('--set', dest='settings', action='append', default=[], help='Simulation setting, e.g. RPI=0.03'),
+        Option('-f', '--format', dest='fmt', default='csv', choices=CLI_FORMATS),
+        Option('-o', '--output', dest='output', default=None, help='Output file (default stdout)')
+    )
+
+    def run(self, startYear, nYears, settings, fmt, output):
+        import datetime
+        from TaxCalendar import tax_year
+        from SimulationClasses import sim_persons
+        from SimulationConfig import SimConfig
+        from SimulationStore import SimulationStore
+        from SimulationScenario import scenario_config, SWEEP_CONFIG_PARAMS
+
+        scenario = {}
+        for setting in settings:
+            name, _, value = setting.partition('=')
+            if name not in SWEEP_CONFIG_PARAMS:
+                print(f"Unknown setting '{name}', use one of {', '.join(SWEEP_CONFIG_PARAMS)}", file=sys.stderr)
+                return 2
+            scenario[name] = int(value) if name == 'expensiveYears' else float(value)
+
+        if startYear is None:
+            startYear = int(tax_year(datetime.date.today()))
+
+        secu, uport = portfolio_data()
+        key, df = SimulationStore().run(startYear, nYears, sim_persons(uport), scenario_config(SimConfig(), scenario))
+        logging.info(f"simulate: results {key}")
+        return write_frame(df, fmt, output)
+
+manager.add_command('simulate', Simulate())
+
+
+class Drawdown(Command):
+    "Sustainable annual drawdown of everyone's portfolios, allowing for their state pensions"
+    option_list = (
+        Option('-s', '--start', dest='startYear', default=None, type=int, help='First tax year (default current)'),
+        Option('-y', '--years', dest='nYears', default=30, type=int, help='Years the portfolios must last'),
+        Option('-g', '--growth', dest='growth', default=None, type=float, help='Portfolio growth (default as simulation)'),
+        Option('-i', '--inflation', dest='inflation', default=None, type=float, help='Inflation (default simulation CPI)'),
+        Option('-a', '--advance', dest='inAdvance', action='store_true', help='Payments at the start of each year')
+    )
+
+    def run(self, startYear, nYears, growth, inflation, inAdvance):
+        import datetime
+        from TaxCalendar import tax_year
+        from SimulationConfig import SimConfig
+        from AnnuityFactor import r_real, household_payment, state_pension_phases
+
+        config = SimConfig()
+        growth = config.get_portfolioGrowth() if growth is None else growth
+        inflation = config.get_CPI() if inflation is None else inflation
+        if startYear is None:
+            startYear = int(tax_year(datetime.date.today()))
+
+        secu, uport = portfolio_data()
+        portfolios = [uport.portfolio(user) for user in uport.users()]
+        pot = uport.value()
+        rate = r_real(growth, inflation)
+
+        # State pensions rise with CPI, so are level in real terms like the payment
+        phases = state_pension_phases([p.spDate() for p in portfolios], [p.spRatio() for p in portfolios],
+                                      startYear, nYears, config.fullStatePension)
+        for start, end, income in phases:
+            print(f"Years {startYear+start-1}-{startYear+end-1}: state pensions £{income:,.2f}")
+        payment = household_payment(portfolios, startYear, nYears, rate, pot, inAdvance, config.fullStatePension)
+        print(f"Portfolios £{pot:,.2f} at {100*rate:.2f}% real growth: £{payment:,.2f} a year for {nYears} years")
+        return 0
+
+manager.add_command('drawdown', Drawdown())
+
+
+class BenchData(Command):
+    "Write synthetic securities, accounts and platform files for benchmarking"
+    option_list = (
+        Option('-d', '--directory', dest='directory', required=True, help='Directory to use as HOME'),
+        Option('-s', '--securities', dest='nSecurities', default=200, type=int),
+        Option('-u', '--users', dest='nUsers', default=2, type=int),
+        Option('-p', '--positions', dest='nPositions', default=15, type=int, help='Positions in each platform account'),
+        Option('--seed', dest='seed', default=1, type=int)
+    )
+
+    def run(self, directory, nSecurities, nUsers, nPositions, seed):
+        from Benchmark import write_synthetic_data
+
+        summary = write_synthetic_data(directory, nSecurities, nUsers, nPositions, seed)
+        print(", ".join(f"{n} {k}" for k, n in summary.items()))
+        print(f"Benchmark with: HOME={directory} python main.py bench")
+        return 0
+
+manager.add_command('bench-data', BenchData())
+
+
+class Bench(Command):
+    "Time loading the data, every report and the simulation"
+    option_list = (
+        Option('-n', '--repeat', dest='repeat', default=5, type=int, help='Times to run each step'),
+        Option('-o', '--output', dest='output', default=None, help='Save results as JSON'),
+        Option('-c', '--compare', dest='baseline', default=None, help='JSON results to compare with'),
+        Option('-t', '--threshold', dest='threshold', default=None, type=float, help='Slowdown counted as a regression, e.g. 0.2')
+    )
+
+    def run(self, repeat, output, baseline, threshold):
+        from Benchmark import benchmark_steps, benchmark_results, compare_results, save_results, load_results, BENCH_THRESHOLD
+
+        secu, uport = portfolio_data()
+        data = {'securities': len(secu.securities()), 'users': len(uport.users()),
+                'accounts': len(uport.accounts()), 'positions': len(uport.positions())}
+        steps = benchmark_steps(secu, uport, SECURITYINFO, ACCOUNTINFO)
+
+        print(", ".join(f"{n} {k}" for k, n in data.items()))
+        print(f"{'Step':<32} {'Best ms':>9} {'Mean ms':>9}")
+        results = benchmark_results(steps, data, repeat,
+                                    lambda name, r: print(f"{name:<32} {r['best_ms']:>9.1f} {r['mean_ms']:>9.1f}"))
+        if output:
+            save_results(results, output)
+
+        if baseline is None:
+            return 0
+
+        rows = compare_results(results, load_results(baseline), BENCH_THRESHOLD if threshold is None else threshold)
+        print(f"\n{'Step':<32} {'Base ms':>9} {'Now ms':>9} {'Change':>8}")
+        for name, before, after, change, regressed in rows:
+            print(f"{name:<32} {before:>9.1f} {after:>9.1f} {100*change:>+7.1f}%{'  SLOWER' if regressed else ''}")
+        return 1 if any(row[4] for row in rows) else 0
+
+manager.add_command('bench', Bench())
+
+
+# Slowest imports (by cumulative time) when a module is imported in a fresh
+# interpreter, from python -X importtime. Returns 1 if the total import time
+# goes over budget (in ms, 0 for no budget) so it can be used to catch
+# startup regressions.
+@manager.option('-m', '--module', dest='module', default='app', help='Module to import')
+@manager.option('-n', '--top', dest='top', default=25, type=int, help='Number of imports to list')
+@manager.option('-b', '--budget', dest='budget', default=0.0, type=float, help='Fail if total ms exceeds this')
+def importtime(module, top, budget):
+    "Profile the imports made when importing a module"
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', f"import {module}"],
+                            capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    # Lines are "import time: self [us] | cumulative | imported package"
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        imports.append((fields[2].strip(), int(fields[0]), int(fields[1]), (len(fields[2]) - len(fields[2].lstrip()) - 1) // 2))
+
+    total = sum(cumulative for name, own, cumulative, depth in imports if depth == 0)
+
+    print(f"{'Module':<50} {'Self ms':>9} {'Total ms':>9}")
+    for name, own, cumulative, depth in sorted(imports, key=lambda i: -i[2])[:top]:
+        print(f"{'  '*depth + name:<50} {own/1000:>9.1f} {cumulative/1000:>9.1f}")
+    print(f"{len(imports)} modules imported in {total/1000:.1f} ms")
+
+    if result.returncode != 0:
+        print(result.stderr.splitlines()[-1])
+        return result.returncode
+    if budget and total/1000 > budget:
+        print(f"Import time {total/1000:.1f} ms is over budget of {budget:.1f} ms")
+        return 1
+    return 0
 
-manager = Manager(app)
 
 if __name__ == '__main__':
     manager.run()
@@ -0,0 +1,162 @@
+# Timing of requests and the work done for them
+#
+# span(name) times a block of code, and timed() a function, into a histogram
+# of durations for that name. The web app also times each request by route
+# (see the hooks in app/views.py) and serves all the histograms at /metrics
+# in the Prometheus text format. Spans within a request are also collected
+# for the optional X-Timing response header.
+#
+# Nothing here depends on Flask, so spans are recorded the same way when the
+# classes are used from the command line.
+
+import time
+import bisect
+import threading
+import functools
+import contextlib
+
+METRICS_PREFIX = 'foreverfund'
+
+# Upper bounds (in seconds) of the histogram buckets
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+METRICS_HELP = {
+    'request_seconds':  'Time to handle a request, by route',
+    'span_seconds':     'Time spent in each instrumented step'
+}
+
+
+class Histogram:
+    def __init__(self, buckets=METRICS_BUCKETS):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self._sum = 0.0
+
+    def observe(self, value):
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    def count(self):
+        return sum(self._counts)
+
+    def sum(self):
+        return self._sum
+
+    # (upper bound, number of observations no greater than it), ending with +Inf
+    def cumulative(self):
+        total = 0
+        rows = []
+        for le, n in zip(self._buckets + (float('inf'),), self._counts):
+            total += n
+            rows.append((le, total))
+        return rows
+
+
+class MetricsRegistry:
+    def __init__(self, prefix=METRICS_PREFIX, buckets=METRICS_BUCKETS):
+        self._prefix = prefix
+        self._buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            hist = self._histograms.get(key)
+            if hist is None:
+                hist = self._histograms[key] = Histogram(self._buckets)
+            hist.observe(value)
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+
+    # All histograms in the Prometheus text exposition format
+    def prometheus_text(self):
+        with self._lock:
+            items = sorted((key, (hist.cumulative(), hist.sum(), hist.count())) for key, hist in self._histograms.items())
+
+        lines = []
+        current = None
+        for (name, labels), (buckets, total, count) in items:
+            metric = f"{self._prefix}_{name}"
+            if name != current:
+                lines.append(f"# HELP {metric} {METRICS_HELP.get(name, name)}")
+                lines.append(f"# TYPE {metric} histogram")
+                current = name
+            for le, n in buckets:
+                lines.append(f"{metric}_bucket{label_text(labels + (('le', format_bound(le)),))} {n}")
+            lines.append(f"{metric}_sum{label_text(labels)} {total:.6f}")
+            lines.append(f"{metric}_count{label_text(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_bound(le):
+    return '+Inf' if le == float('inf') else repr(le)
+
+def label_text(labels):
+    if not labels:
+        return ''
+    escape = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{escape(v)}"' for k, v in labels) + '}'
+
+
+# Histograms for the whole process, and the spans of the request being
+# handled by each thread
+registry = MetricsRegistry()
+_local = threading.local()
+
+def start_request():
+    _local.spans = []
+
+# Spans recorded since start_request(), as (name, seconds)
+def finish_request():
+    spans = getattr(_local, 'spans', None)
+    _local.spans = None
+    return spans if spans is not None else []
+
+def observe_request(route, method, status, seconds):
+    registry.observe('request_seconds', {'route': route, 'method': method, 'status': status}, seconds)
+
+@contextlib.contextmanager
+def span(name, **labels):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        registry.observe('span_seconds', dict(labels, span=name), elapsed)
+        spans = getattr(_local, 'spans', None)
+        if spans is not None:
+            spans.append((name, elapsed))
+
+# Decorator timing each call of a function as a span (named after the
+# function unless a name is given)
+def timed(name=None):
+    if callable(name):
+        return timed()(name)
+
+    def decorator(fn):
+        spanname = fn.__name__ if name is None else name
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(spanname):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+# X-Timing header value: total time of each span name (with the number of
+# calls if more than one) in the order first seen, then the whole request
+def timing_header(spans, total):
+    totals = {}
+    for name, seconds in spans:
+        n, t = totals.get(name, (0, 0.0))
+        totals[name] = (n + 1, t + seconds)
+
+    parts = [f"{name}={1000*t:.1f}ms" + (f"(x{n})" if n > 1 else "") for name, (n, t) in totals.items()]
+    parts.append(f"total={1000*total:.1f}ms")
+    return "; ".join(parts)
+
+def metrics_text():
+    return registry.prometheus_text()
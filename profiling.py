@@ -0,0 +1,85 @@
+# Profiles of single requests
+#
+# With PROFILE_ENABLED set in config, adding ?profile=1 to a request for one
+# of the PROFILE_ROUTES runs it under a profiler and saves the profile in
+# PROFILEDIR (see the hooks in app/views.py):
+#   cProfile        pstats file (.prof) for snakeviz, flameprof, gprof2dot etc.
+#   pyinstrument    speedscope JSON (.speedscope.json) for speedscope.app
+# pyinstrument is optional and only imported when asked for. ?profile=text
+# returns a text summary in place of the page.
+
+import os
+import io
+import re
+import time
+import pstats
+import cProfile
+import logging
+
+PROFILE_ENGINES = ('cprofile', 'pyinstrument')
+
+# Functions listed in the text summary of a cProfile run
+PROFILE_TEXT_LIMIT = 40
+
+
+# True if a request path is one of the routes (or under one of the route
+# prefixes ending in '/') that may be profiled
+def profiled_route(path, routes):
+    return any(path.startswith(r) if r.endswith('/') else path == r for r in routes)
+
+# Name for the profile of a request, from the time and path
+def profile_name(path):
+    stamp = time.strftime('%Y%m%d-%H%M%S') + "%03d" % (int(time.time() * 1000) % 1000)
+    return "%s_%s" % (stamp, re.sub(r'[^A-Za-z0-9]+', '_', path).strip('_') or 'index')
+
+
+class RequestProfile:
+    def __init__(self, engine='cprofile'):
+        self._profiler = None
+        if engine == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+                self._profiler = Profiler()
+            except ImportError:
+                logging.warning("RequestProfile: pyinstrument is not installed, using cProfile")
+                engine = 'cprofile'
+        if engine != 'pyinstrument':
+            engine = 'cprofile'
+            self._profiler = cProfile.Profile()
+        self._engine = engine
+
+    def engine(self):
+        return self._engine
+
+    def start(self):
+        if self._engine == 'pyinstrument':
+            self._profiler.start()
+        else:
+            self._profiler.enable()
+
+    def stop(self):
+        if self._engine == 'pyinstrument':
+            self._profiler.stop()
+        else:
+            self._profiler.disable()
+
+    # Save the profile under dirname and return its file name
+    def save(self, dirname, name):
+        os.makedirs(dirname, exist_ok=True)
+        if self._engine == 'pyinstrument':
+            from pyinstrument.renderers import SpeedscopeRenderer
+            filename = name + ".speedscope.json"
+            with open(os.path.join(dirname, filename), 'w') as fp:
+                fp.write(self._profiler.output(renderer=SpeedscopeRenderer()))
+        else:
+            filename = name + ".prof"
+            self._profiler.dump_stats(os.path.join(dirname, filename))
+        logging.debug(f"RequestProfile.save({filename})")
+        return filename
+
+    def text(self, limit=PROFILE_TEXT_LIMIT):
+        if self._engine == 'pyinstrument':
+            return self._profiler.output_text()
+        stream = io.StringIO()
+        pstats.Stats(self._profiler, stream=stream).sort_stats('cumulative').print_stats(limit)
+        return stream.getvalue()
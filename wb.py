@@ -2,12 +2,11 @@
 # Main processing for the Google Sheets workbook
 #-----------------------------------------------------------------------
 
-import os, logging
+import os, re, json, logging
+import time, random, threading
 import pandas as pd
 import csv
-import gspread
-from google.oauth2.service_account import Credentials
-from googleapiclient.discovery import build
+import functools
 
 from wb_format import fmt_req_font, fmt_req_autofilter
 from wb_format import fmt_req_autoresize, fmt_hdr_bgcolor
@@ -15,6 +14,10 @@ from wb_format import fmt_columns_decimal, fmt_columns_percentage
 from wb_format import fmt_columns_currency, fmt_columns_hjustify
 from wb_format import RGB_GREY
 
+from config import SHEETCACHE
+from atomicfile import atomic_write
+from metrics import span, timed
+
 
 # Worksheets used as source information
 WS_HL_DIVIDENDS     = "hl"             # Hargreaves Lansdown dividend information
@@ -33,6 +36,23 @@ WS_SEC_DIVIDENDS_FE = "By SecurityFE"  # Temporary
 WS_SEC_DIVIDENDS    = "By Security"
 WS_EST_INCOME       = "Estimated Income"
 
+# Retry/backoff for requests rejected by the Sheets API rate limit (HTTP 429)
+GS_NUM_RETRIES      = 6                # Attempts after the first before giving up
+GS_BACKOFF_BASE     = 1.0              # Seconds, doubled on each retry
+GS_BACKOFF_MAX      = 64.0             # Upper limit on a single wait
+HTTP_TOO_MANY_REQUESTS = 429
+
+
+# Seconds to wait before retry number 'attempt' (0 based), honouring any
+# Retry-After header sent back with the rejected request
+def gs_backoff_delay(attempt, retry_after=None):
+    try:
+        return min(float(retry_after), GS_BACKOFF_MAX)
+    except (TypeError, ValueError):
+        pass
+    wait = min(GS_BACKOFF_BASE * (2 ** attempt), GS_BACKOFF_MAX)
+    return wait + random.uniform(0, wait / 2)
+
 
 #-----------------------------------------------------------------------
 # Base class for a worksheet within a workbook
@@ -41,7 +61,6 @@ WS_EST_INCOME       = "Estimated Income"
 class Ws:
     def __init__(self, wbInstance, wsname):
         self._wbinstance = wbInstance
-        self._workbook   = wbInstance.workbook()
         self._wsname     = wsname
         self._df         = None
     
@@ -52,7 +71,7 @@ class Ws:
         return self.wbinstance().spreadsheet_id()
       
     def workbook(self):
-        return self._workbook
+        return self.wbinstance().workbook()
     
     def wsname(self):
         return self._wsname
@@ -104,7 +123,8 @@ class WsSecInfo(Ws):
         # Read json files and create one row for each
         lst = []
         for sec in secu.securities():
-            defn = secu.find_security(sec).data()
+            # Work on a copy so the in-memory security definition is untouched
+            defn = dict(secu.find_security(sec).data())
             try:
                 freq = defn['divis']['freq']
             except:
@@ -122,6 +142,7 @@ class WsSecInfo(Ws):
 
 
     # Apply formatting to newly created/updated sheet
+    @timed('sheets.apply_formatting')
     def apply_formatting(self):
         # Retrieve worksheet details for formatting requests
         worksheet = self.workbook().worksheet(self.wsname())
@@ -143,19 +164,26 @@ class WsSecInfo(Ws):
         response = self.wbinstance().service().spreadsheets().batchUpdate(
                 spreadsheetId=self.spreadsheet_id(), 
                 body={'requests': requests}
-            ).execute()
+            ).execute(num_retries=GS_NUM_RETRIES)
         
         logging.debug(f"service request response {response}")
 
 
-    def refresh(self):
+    def build(self):
         # Create dataframe from individual security definitions
         self._df = self.create_security_info(self._secu)
+        return self._df
+
+    def push(self):
         # Create/update worksheet with dataframe
         self.wbinstance().df_to_worksheet(self.df(), self.wsname())
         # Apply formatting to this worksheet
         self.apply_formatting()
 
+    def refresh(self):
+        self.build()
+        self.push()
+
     def __repr__(self):
         return self.df()
 
@@ -200,6 +228,7 @@ class WsSecUrls(Ws):
         return df
     
     # Apply formatting to newly created/updated sheet
+    @timed('sheets.apply_formatting')
     def apply_formatting(self):
         # Retrieve worksheet details for formatting requests
         worksheet = self.workbook().worksheet(self.wsname())
@@ -219,19 +248,26 @@ class WsSecUrls(Ws):
         response = self.wbinstance().service().spreadsheets().batchUpdate(
                 spreadsheetId=self.spreadsheet_id(), 
                 body={'requests': requests}
-            ).execute()
+            ).execute(num_retries=GS_NUM_RETRIES)
         
         logging.debug(f"service request response {response}")
 
 
-    def refresh(self):
+    def build(self):
         # Create dataframe from individual security definitions
         self._df = self.create_security_urls(self._secu)
+        return self._df
+
+    def push(self):
         # Create/update worksheet with dataframe
         self.wbinstance().df_to_worksheet(self.df(), self.wsname())
         # Apply formatting to this worksheet
         self.apply_formatting()
 
+    def refresh(self):
+        self.build()
+        self.push()
+
     def __repr__(self):
         return self.df()
 
@@ -303,6 +339,7 @@ class WsByPosition(Ws):
         return self._df
 
     # Apply formatting to newly created/updated sheet
+    @timed('sheets.apply_formatting')
     def apply_formatting(self):
         # Retrieve worksheet details for formatting requests
         worksheet = self.workbook().worksheet(self.wsname())
@@ -332,16 +369,18 @@ class WsByPosition(Ws):
         response = self.wbinstance().service().spreadsheets().batchUpdate(
                 spreadsheetId=self.spreadsheet_id(), 
                 body={'requests': requests}
-            ).execute()
+            ).execute(num_retries=GS_NUM_RETRIES)
         
         logging.debug(f"service request response {response}")
         
 
-    # Create or update the worksheet using a list of Position instances
-    def refresh(self, positions):
+    # Create a dataframe from the positions
+    def build(self, positions):
+        return self.create_position_info(positions)
 
-        # Create a dataframe from the positions
-        df = self.create_position_info(positions)
+    # Create or update the worksheet from the dataframe already built
+    def push(self):
+        df = self.df()
 
         # Use new df to add/update position income sheet
         # Allow 4 additional columns for formulas to be added later
@@ -375,27 +414,110 @@ class WsByPosition(Ws):
         # Apply other formatting to this sheet
         self.apply_formatting()
 
+    # Create or update the worksheet using a list of Position instances
+    def refresh(self, positions):
+        self.build(positions)
+        self.push()
+
+
+#-----------------------------------------------------------------------
+# gspread HTTP client which backs off and retries when rate limited
+#
+# The Google client libraries are slow to import, so they are only loaded
+# when a workbook is first opened rather than whenever wb is imported
+#-----------------------------------------------------------------------
+
+@functools.lru_cache(maxsize=None)
+def gs_backoff_http_client():
+    import gspread
+
+    class GsBackoffHTTPClient(gspread.HTTPClient):
+        def request(self, *args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    with span('sheets.request'):
+                        return gspread.HTTPClient.request(self, *args, **kwargs)
+                except gspread.exceptions.APIError as e:
+                    if e.code != HTTP_TOO_MANY_REQUESTS or attempt >= GS_NUM_RETRIES:
+                        raise
+                    wait = gs_backoff_delay(attempt, e.response.headers.get('Retry-After'))
+                    logging.debug(f"Sheets API rate limited, retry {attempt+1} in {wait:.1f}s")
+                    time.sleep(wait)
+                    attempt += 1
+
+    return GsBackoffHTTPClient
+
 
 class GspreadAuth:
     def __init__(self):
-        scopes = ["https://www.googleapis.com/auth/spreadsheets"]
+        import gspread
+        from google.oauth2.service_account import Credentials
+
+        scopes = [
+            "https://www.googleapis.com/auth/spreadsheets",
+            "https://www.googleapis.com/auth/drive.metadata.readonly"   # Revision checks
+        ]
         creds  = Credentials.from_service_account_file("credentials.json", scopes=scopes)
 
-        self._client  = gspread.authorize(creds)
-        self._service = build('sheets', 'v4', credentials=creds)
+        self._creds   = creds
+        self._client  = gspread.authorize(creds, http_client=gs_backoff_http_client())
+        self._local   = threading.local()
 
     def client(self):
         return self._client
     
+    # The discovery service uses httplib2, which is not thread safe, so
+    # each thread pushing sheets concurrently is given its own instance
     def service(self):
-        return self._service
+        service = getattr(self._local, 'service', None)
+        if service is None:
+            from googleapiclient.discovery import build
+            service = build('sheets', 'v4', credentials=self._creds)
+            self._local.service = service
+        return service
+
+
+#-----------------------------------------------------------------------
+# Local copy of a source worksheet, saved as Feather under SHEETCACHE
+# with the revision (Drive modifiedTime) of the workbook it came from
+#-----------------------------------------------------------------------
+
+class SheetCache:
+    def __init__(self, spreadsheet_id, worksheet_name, cachedir=SHEETCACHE):
+        basename = re.sub(r'[^A-Za-z0-9_-]', '_', worksheet_name)
+        self._dirname  = os.path.join(cachedir, spreadsheet_id)
+        self._datafile = os.path.join(self._dirname, f"{basename}.feather")
+        self._metafile = os.path.join(self._dirname, f"{basename}.json")
+
+    def revision(self):
+        try:
+            with open(self._metafile, 'r') as fp:
+                return json.load(fp)['revision']
+        except (OSError, ValueError, KeyError):
+            return None
+
+    def load(self):
+        try:
+            return pd.read_feather(self._datafile)
+        except Exception as e:
+            logging.debug(f"SheetCache.load({self._datafile}) {e}")
+            return None
+
+    def save(self, df, revision):
+        os.makedirs(self._dirname, exist_ok=True)
+        with atomic_write(self._datafile, 'wb') as fp:
+            df.reset_index(drop=True).to_feather(fp)
+        with atomic_write(self._metafile) as fp:
+            json.dump({'revision': revision, 'saved': time.strftime('%Y%m%d%H%M%S')}, fp)
 
 
 class GsWorkbook:
     def __init__(self, gsauth, spreadsheet_id):
         self._gsauth = gsauth
         self._spreadsheet_id = spreadsheet_id
-        self._workbook = self.client().open_by_key(spreadsheet_id)
+        self._workbook = None
+        self._lock = threading.Lock()
 
     def client(self):
         return self._gsauth.client()
@@ -403,7 +525,11 @@ class GsWorkbook:
     def service(self):
         return self._gsauth.service()
     
+    # Opened on first use so cached source sheets can be read when offline
     def workbook(self):
+        with self._lock:
+            if self._workbook is None:
+                self._workbook = self.client().open_by_key(self._spreadsheet_id)
         return self._workbook
     
     def spreadsheet_id(self):
@@ -418,11 +544,47 @@ class GsWorkbook:
 
     def worksheet_list(self):
         ws_list = []
-        for ws_name in map(lambda x: x.title, self._workbook.worksheets()):
+        for ws_name in map(lambda x: x.title, self.workbook().worksheets()):
             ws_list.append(ws_name)
         return ws_list
     
-    def worksheet_to_df(self, worksheet_name):
+    # Revision of the workbook from a cheap Drive metadata fetch
+    @timed('sheets.revision')
+    def revision(self):
+        return self.client().get_file_drive_metadata(self.spreadsheet_id())['modifiedTime']
+
+    # Contents of a worksheet, served from the local cache when the workbook
+    # has not changed since it was saved, or when the API can't be reached
+    @timed('sheets.worksheet_to_df')
+    def worksheet_to_df(self, worksheet_name, use_cache=True):
+        if not use_cache:
+            return self.download_worksheet(worksheet_name)
+
+        cache = SheetCache(self.spreadsheet_id(), worksheet_name)
+        try:
+            revision = self.revision()
+        except Exception as e:
+            df = cache.load()
+            if df is None:
+                raise
+            logging.warning(f"worksheet_to_df({worksheet_name}): using cached copy ({cache.revision()}) {e}")
+            return df
+
+        if cache.revision() == revision:
+            df = cache.load()
+            if df is not None:
+                logging.debug(f"worksheet_to_df({worksheet_name}): unchanged since {revision}")
+                return df
+
+        df = self.download_worksheet(worksheet_name)
+        try:
+            cache.save(df, revision)
+        except Exception as e:
+            logging.warning(f"worksheet_to_df({worksheet_name}): not cached {e}")
+        return df
+
+    @timed('sheets.download_worksheet')
+    def download_worksheet(self, worksheet_name):
         # Get the worksheet by name
         worksheet = self.workbook().worksheet(worksheet_name)
         
@@ -437,6 +599,7 @@ class GsWorkbook:
 
         return df
     
+    @timed('sheets.df_to_worksheet')
     def df_to_worksheet(self, df, worksheet_name, add_rows=0, add_cols=0):
         # Convert DataFrame to list of lists
         values = df.values.tolist()
@@ -2,7 +2,8 @@
 # Create/Update the 'By Security' income sheet
 #------------------------------------------------------------------------------
 
-import logging
+import re, logging
+import numpy as np
 import pandas as pd
 from datetime import datetime, timedelta
 
@@ -10,7 +11,7 @@ from datetime import datetime, timedelta
 # Worksheets names
 
 # Base worksheet class
-from wb import Ws
+from wb import Ws, GS_NUM_RETRIES
 # Source dividend information
 from wb import WS_HL_DIVIDENDS, WS_FE_DIVIDENDS, WS_OTHER_DIVIDENDS
 
@@ -24,8 +25,52 @@ from wb_format import fmt_columns_bgcolor, fmt_columns_decimal
 from wb_format import fmt_columns_currency, fmt_columns_hjustify
 from wb_format import RGB_GREY, RGB_BLUE, RGB_YELLOW
 
+from Breakdown import truncate_decimal_array
+from TaxCalendar import date_buckets
+from metrics import timed
+
+
+#------------------------------------------------------------------------------
+# Normalised dividend information
+#
+# Each source sheet is converted in a single pass to these columns, with
+# dates as YYYYMMDD strings and SecurityId/Unit held as categoricals.
+
+NORM_DIVI_COLS = ['SecurityId','Name','Type','ExDivDate','PaymentDate','Amount','Unit']
+
+# HL payment such as '1.23p' split into amount and unit
+HL_PAYMENT_RE = re.compile(r'([0-9\.]+)([a-zA-Z]+)')
+
+# Parse dates once with a fixed format and return them as YYYYMMDD strings.
+# Anything which isn't a date in that format is passed through unchanged.
+def yyyymmdd(dates, date_format):
+    dates = dates.astype(str)
+    parsed = pd.to_datetime(dates, format=date_format, errors='coerce')
+    return parsed.dt.strftime('%Y%m%d').fillna(dates)
+
+def normalised_divis(SecurityId, Name, Type, ExDivDate, PaymentDate, Amount, Unit):
+    df = pd.DataFrame({
+        'SecurityId':   SecurityId,
+        'Name':         Name,
+        'Type':         Type,
+        'ExDivDate':    ExDivDate,
+        'PaymentDate':  PaymentDate,
+        'Amount':       Amount,
+        'Unit':         Unit
+    }, columns=NORM_DIVI_COLS)
+    return categorise_divis(df)
+
+# Categoricals for the repeated keys. Unit is ordered so that it can be
+# aggregated with 'min' in the same way as the original strings.
+def categorise_divis(df):
+    units = sorted(df['Unit'].dropna().unique())
+    df['SecurityId'] = df['SecurityId'].astype('category')
+    df['Unit'] = df['Unit'].astype(pd.CategoricalDtype(units, ordered=True))
+    return df
+
 
 # Apply formatting to newly created/updated sheet
+@timed('sheets.apply_formatting')
 def apply_formatting(forever_income, worksheet_name):
     # Retrieve worksheet details for formatting requests
     workbook  = forever_income.workbook()
@@ -52,7 +97,7 @@ def apply_formatting(forever_income, worksheet_name):
     response = forever_income.service().spreadsheets().batchUpdate(
             spreadsheetId=forever_income.spreadsheet_id(),
             body={'requests': requests}
-        ).execute()
+        ).execute(num_retries=GS_NUM_RETRIES)
         
     logging.debug(f"service request response {response}")
 
@@ -86,28 +131,23 @@ class WsDividendsHL(Ws):
     def normalise_divis(self):
         df = self.rawdata()
 
-        # Use str.extract() to split the 'value' column
-        df[['Amount', 'Unit']] = df['Payment'].str.extract(r'([0-9\.]+)([a-zA-Z]+)')
-
-        # Treat 'Amount' as float and date columns as strings
-        df['Amount'] = df['Amount'].astype(float)
-        df['ExDivDate'] = df['ExDivDate'].astype(str)
-        df['PaymentDate'] = df['PaymentDate'].astype(str)
+        # Split 'Payment' into amount and unit, e.g. '1.23p'
+        payment = df['Payment'].str.extract(HL_PAYMENT_RE)
 
         # Convert date columns from DD/MM/YYYY to YYYYMMDD as strings
-        df['ExDivDate'] = df['ExDivDate'].str.replace(r'(\d{2})/(\d{2})/(\d{4})', r'\3\2\1', regex=True)
-        df['PaymentDate'] = df['PaymentDate'].str.replace(r'(\d{2})/(\d{2})/(\d{4})', r'\3\2\1', regex=True)
-
-        # Drop 'Payment' column as it's no longer needed
-        df = df.drop(columns=['Payment'])
+        self._norm_df = normalised_divis(
+            df['SecurityId'], df['Name'], df['Type'],
+            yyyymmdd(df['ExDivDate'], '%d/%m/%Y'),
+            yyyymmdd(df['PaymentDate'], '%d/%m/%Y'),
+            payment[0].astype(float),
+            payment[1]
+        )
 
-        self._norm_df = df
-
-        return df
+        return self._norm_df
 
     def aggregate_divis(self):   
         # Group by 'securityId' and aggregate
-        aggregated_df = self.normalised().groupby(['SecurityId','Name']).agg(
+        aggregated_df = self.normalised().groupby(['SecurityId','Name'], observed=True).agg(
             Count=('Amount', 'size'),           # Count of rows per securityId
             AnnualDividend=('Amount', 'sum'),   # Sum of value per securityId
             Unit=('Unit', 'min'),               # Retain column Unit
@@ -162,34 +202,25 @@ class WsDividendsFE(Ws):
 
     def normalise_divis(self):
         df = self.rawdata()
-        # Treat 'Scale' and 'DividendAmount' as float and date columns as strings
-        df['Scale']  = df['Scale'].astype(float)
-        df['Amount'] = df['DividendAmount'].astype(float)
-        df['ExDivDate'] = df['ExDivDate'].astype(str)
-        df['PaymentDate'] = df['PaymentDate'].astype(str)
-
-        # Some dividends (e.g. RL) are expressed in pence, so scale up
-        df['Amount'] = df['Amount'] * df['Scale']
-        # Convert to dividend in pence (from pounds)
-        df['Amount'] = df['Amount'] * 100
-        # Set Unit as pence
-        df['Unit'] = 'p'
-        # Create 'Type' column
-        df['Type'] = df['DividendType']
-        # Convert date columns from DD.MM.YYYY to YYYYMMDD as strings
-        df['ExDivDate'] = df['ExDivDate'].str.replace(r'(\d{2})\.(\d{2})\.(\d{4})', r'\3\2\1', regex=True)
-        df['PaymentDate'] = df['PaymentDate'].str.replace(r'(\d{2})\.(\d{2})\.(\d{4})', r'\3\2\1', regex=True)
 
-        # Drop columns no longer needed
-        df = df.drop(columns=['DividendType','DividendAmount','Scale','TaxIndicator'])
-    
-        self._norm_df = df
+        # Some dividends (e.g. RL) are expressed in pence, so scale up,
+        # then convert to dividend in pence (from pounds)
+        amount = df['DividendAmount'].astype(float) * df['Scale'].astype(float) * 100
 
-        return df
+        # Convert date columns from DD.MM.YYYY to YYYYMMDD as strings
+        self._norm_df = normalised_divis(
+            df['SecurityId'], df['Name'], df['DividendType'],
+            yyyymmdd(df['ExDivDate'], '%d.%m.%Y'),
+            yyyymmdd(df['PaymentDate'], '%d.%m.%Y'),
+            amount,
+            'p'
+        )
+
+        return self._norm_df
 
     def aggregate_divis(self):   
         # Group by 'securityId' and aggregate
-        aggregated_df = self.normalised().groupby(['SecurityId','Name']).agg(
+        aggregated_df = self.normalised().groupby(['SecurityId','Name'], observed=True).agg(
             Count=('Amount', 'size'),           # Count of rows per securityId
             AnnualDividend=('Amount', 'sum'),   # Sum of value per securityId
             Unit=('Unit', 'min'),               # Retain column Unit
@@ -238,8 +269,9 @@ class WsDividendsBySecurity(Ws):
         other['AnnualDividend'] = other['AnnualDividend'].astype(float)
 
         # Aggregate normalised data to use for hist
-        self._dfn = pd.concat([hl.normalised(), fe.normalised()], 
-                  ignore_index=True).sort_values(by='SecurityId')
+        self._dfn = categorise_divis(pd.concat([hl.normalised(), fe.normalised()], 
+                  ignore_index=True).sort_values(by='SecurityId'))
+        self._prev_index = None
         
         # Aggregate aggregated data to get annual dividend information
         self._df = pd.concat([hl.aggregated(), fe.aggregated(), other], 
@@ -256,24 +288,23 @@ class WsDividendsBySecurity(Ws):
         self.wbinstance().df_to_worksheet(self.aggregated(), self.wsname())
         apply_formatting(self.wbinstance(), self.wsname())
     
+    # Previous dividends for every security, most recent payment first,
+    # built with a single pass over the normalised data
+    def prev_divis_index(self):
+        if self._prev_index is None:
+            df = self.normalised().sort_values('PaymentDate', ascending=False, kind='stable')
+            self._prev_index = {}
+            for SecurityId, g in df.groupby('SecurityId', observed=True, sort=False):
+                self._prev_index[SecurityId] = [
+                    {'tag': t, 'ex-div': x, 'payment': p, 'amount': a, 'unit': u}
+                    for t, x, p, a, u in zip(g['Type'].tolist(), g['ExDivDate'].tolist(),
+                                             g['PaymentDate'].tolist(), g['Amount'].tolist(),
+                                             g['Unit'].tolist())
+                ]
+        return self._prev_index
+
     def json_prev_divis(self, SecurityId):
-        df = self.normalised()
-        divis = df[(df['SecurityId'] == SecurityId)].to_dict('records')
-        prev = []
-        if len(divis) > 0:
-            for d in divis:
-                prev.append({
-                    'tag':      d['Type'],
-                    'ex-div':   d['ExDivDate'],
-                    'payment':  d['PaymentDate'],
-                    'amount':   d['Amount'],
-                    'unit':     d['Unit']
-                })
-
-            # Sort the list in descending order based on 'payment'
-            prev = sorted(prev, key=lambda x: x['payment'], reverse=True)
-
-        return prev
+        return [dict(d) for d in self.prev_divis_index().get(SecurityId, [])]
 
     def __repr__(self):
         return self.aggregated()
@@ -283,6 +314,28 @@ class WsDividendsBySecurity(Ws):
 # Create worksheet containing projected dividends by account
 #-----------------------------------------------------------------------
 
+EST_POSITION_COLS = ['AccountId','Who','Type','SecurityId','Quantity','Value']
+EST_SECURITY_COLS = ['SecurityId','Date','Freq','Yield','Unit','PayoutFreq','Status']
+EST_INCOME_COLS   = ['AccountId','Year','Month','Day','Tax Year','Who','Type','SecurityId',
+                     'Freq','Quantity','Value','Yield','Unit','Amount','Status']
+
+# Income in pounds for each position/payment row, as Position.dividend_projections()
+# but for the whole table at once
+def position_amounts(df):
+    bad = ~df['Unit'].isin(['p','e','£','%'])
+    assert not bad.any(), f"Bad unit={df.loc[bad,'Unit'].tolist()} for {df.loc[bad,'SecurityId'].tolist()}"
+
+    quantity  = df['Quantity'].astype(float)
+    amount    = df['Yield'].astype(float)
+    npayments = df['PayoutFreq'].map({'A':1,'S':2,'Q':4,'M':12})
+
+    income = np.select(
+        [df['Unit'] == 'p', df['Unit'] == 'e', df['Unit'] == '£'],
+        [quantity * amount / 100.0, quantity * amount / 120.0, quantity * amount],
+        df['Value'].astype(float) * amount / 100.0 / npayments
+    )
+    return truncate_decimal_array(income)
+
 class WsEstimatedIncome(Ws):
     def __init__(self, wbDestination, nWeeks=13):
         # Initialise based on workbook where sheet will be created
@@ -320,76 +373,66 @@ class WsEstimatedIncome(Ws):
     #   Amount      335.09
 
     def projected_income(self, positions, secu):
-        self._projected = []
-    
-        for pos in positions:
-            acc = pos.account()
-            acc_id = "%s_%s_%s" % (acc.usercode(), pos.platform(), pos.account_type())
-
-            acctype = pos.account_type()
-            if acctype == 'Sav':
-                acctype = 'Savings'
-
-            sec = secu.find_security(pos.sname())
-
-            projections = pos.dividend_projections(self.start_date(), self.end_date())
-            sec_divis   = sec.dividend_projections(self.start_date(), self.end_date())
-
-            for dt in projections.keys():
-                # Multiple dividend payments per date
-                for dp in projections[dt]:
-                    logging.debug(f"--- {pos.sname()} dt={dt} dp={dp}")
-                    dt_obj = datetime.strptime(dt, "%Y%m%d")
-                    tax_yend = datetime(dt_obj.year,4,5)
-                    if dt_obj <= tax_yend:
-                        tax_year = dt_obj.year - 1
-                    else:
-                        tax_year = dt_obj.year
-                    s_tax_year = f"{tax_year}/{tax_year-2000+1}"
-
-                    try:
-                        freq = sec.data()['divis']['freq']
-                    except:
-                        freq = ""
-
-                    divi_amount = ''
-                    divi_unit   = ''
-                    for sec_divi_dt in sec_divis.keys():
-                        if dt == sec_divi_dt:
-                            for dtdp in sec_divis[dt]:
-                                divi_amount = dtdp['amount']
-                                divi_unit   = dtdp['unit']
-
-                    p = {
-                        'AccountId':    acc_id,
-                        'Year':         dt_obj.year,
-                        'Month':        dt_obj.month,
-                        'Day':          dt_obj.day,
-                        'Tax Year':     s_tax_year,
-                        'Who':          acc.username(),
-                        'Type':         acctype,                    
-                        'SecurityId':   pos.sname(),
-                        'Freq':         freq,
-                        'Quantity':     pos.quantity(),
-                        'Value':        pos.value(),
-                        'Yield':        divi_amount,
-                        'Unit':         divi_unit,
-                        'Amount':       dp['amount'],
-                        'Status':       dp['status']
-                    }
-            
-                    logging.debug(f"---> {p}")
-
-                    self._projected.append(p)
+        # One row per position, keyed on SecurityId
+        pos_df = pd.DataFrame([{
+            'AccountId':    "%s_%s_%s" % (pos.account().usercode(), pos.platform(), pos.account_type()),
+            'Who':          pos.account().username(),
+            'Type':         pos.account_type(),
+            'SecurityId':   pos.sname(),
+            'Quantity':     pos.quantity(),
+            'Value':        pos.value()
+        } for pos in positions], columns=EST_POSITION_COLS)
+        pos_df['Type'] = pos_df['Type'].replace('Sav', 'Savings')
+
+        # Projections are per security, so only work them out once each
+        sec_df = self.security_projections(pos_df['SecurityId'].unique(), secu)
+
+        df = pos_df.merge(sec_df, on='SecurityId', how='inner')
+
+        # Date parts and tax year from the calendar tables
+        buckets = date_buckets(df['Date'])
+        df['Year']     = buckets['year']
+        df['Month']    = buckets['month']
+        df['Day']      = buckets['day']
+        df['Tax Year'] = buckets['tax_year_label']
+
+        df['Amount'] = position_amounts(df)
 
         # Create dataframe of full list of positions in sorted order
-        self._df = pd.DataFrame(self._projected).sort_values(
+        self._df = df[EST_INCOME_COLS].sort_values(
             ['Year','Month','Day','AccountId'],ascending=[True,True,True,True]
         ).reset_index(drop=True)
 
         return self._df
 
+    # Table of projected payments for each security within the window
+    def security_projections(self, snames, secu):
+        rows = []
+        for sname in snames:
+            sec = secu.find_security(sname)
+            try:
+                freq = sec.data()['divis']['freq']
+            except:
+                freq = ""
+
+            sec_divis = sec.dividend_projections(self.start_date(), self.end_date())
+            for dt in sec_divis.keys():
+                # Multiple dividend payments per date
+                for dtdp in sec_divis[dt]:
+                    rows.append({
+                        'SecurityId':   sname,
+                        'Date':         dt,
+                        'Freq':         freq,
+                        'Yield':        dtdp['amount'],
+                        'Unit':         dtdp['unit'],
+                        'PayoutFreq':   dtdp['freq'],
+                        'Status':       dtdp['status']
+                    })
+
+        return pd.DataFrame(rows, columns=EST_SECURITY_COLS)
+
     # Apply formatting to newly created/updated sheet
+    @timed('sheets.apply_formatting')
     def apply_formatting(self):
         worksheet = self.workbook().worksheet(self.wsname())
 
@@ -418,7 +461,7 @@ class WsEstimatedIncome(Ws):
         response = self.wbinstance().service().spreadsheets().batchUpdate(
                 spreadsheetId=self.wbinstance().spreadsheet_id(),
                 body={'requests': requests}
-            ).execute()
+            ).execute(num_retries=GS_NUM_RETRIES)
         
         logging.debug(f"service request response {response}")
 
@@ -0,0 +1,101 @@
+#------------------------------------------------------------------------------
+# Refresh all generated worksheets in one pass
+#
+# The DataFrame for each sheet is built first (local data plus any source
+# sheets that have to be read) and the results are then pushed to the
+# workbooks concurrently. Rate limiting (HTTP 429) is handled by the
+# backoff/retry in the workbook clients, so a full sync takes roughly as
+# long as the slowest single sheet rather than the sum of all of them.
+#------------------------------------------------------------------------------
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from wb import WsSecInfo, WsSecUrls, WsByPosition
+from wb import WS_SEC_DIVIDENDS
+from wb_bysecurity import WsDividendsBySecurity, WsEstimatedIncome
+
+# Upper limit on sheets being built or pushed at the same time
+WB_MAX_WORKERS = 5
+
+
+# Run each (name, fn) task in the thread pool and wait for all of them.
+# Every task is allowed to finish before the first failure is re-raised.
+def run_concurrently(tasks, max_workers=WB_MAX_WORKERS):
+    results = {}
+    errors  = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {name: pool.submit(timed, name, fn) for name, fn in tasks}
+        for name, future in futures.items():
+            try:
+                results[name] = future.result()
+            except Exception as e:
+                logging.error(f"run_concurrently: '{name}' failed: {e}")
+                errors.append(e)
+    if errors:
+        raise errors[0]
+    return results
+
+def timed(name, fn):
+    t0 = time.perf_counter()
+    result = fn()
+    logging.debug(f"{name} took {time.perf_counter()-t0:.2f}s")
+    return result
+
+
+# Build and push 'Security Information', 'Detailed Information', 'By Position',
+# 'By Security' and 'Estimated Income'. Returns the built DataFrames by sheet name.
+def refresh_all(ForeverIncome, SecurityMaster, secu, positions, nWeeks=52, max_workers=WB_MAX_WORKERS):
+    secInfo   = WsSecInfo(SecurityMaster, secu)
+    secUrls   = WsSecUrls(SecurityMaster, secu)
+    byPos     = WsByPosition(ForeverIncome)
+    estimated = WsEstimatedIncome(ForeverIncome, nWeeks)
+    built     = {}
+
+    # Stage 1: construct the dataframes (reads of source sheets overlap)
+    def build_by_security():
+        built['bySecurity'] = WsDividendsBySecurity(ForeverIncome, SecurityMaster)
+        return built['bySecurity'].aggregated()
+
+    frames = run_concurrently([
+        (secInfo.wsname(),   secInfo.build),
+        (secUrls.wsname(),   secUrls.build),
+        (byPos.wsname(),     lambda: byPos.build(positions)),
+        (estimated.wsname(), lambda: estimated.projected_income(positions, secu)),
+        (WS_SEC_DIVIDENDS,   build_by_security),
+    ], max_workers)
+
+    # Stage 2: write all sheets to the workbooks concurrently
+    run_concurrently([
+        (secInfo.wsname(),   secInfo.push),
+        (secUrls.wsname(),   secUrls.push),
+        (byPos.wsname(),     byPos.push),
+        (estimated.wsname(), estimated.refresh),
+        (WS_SEC_DIVIDENDS,   built['bySecurity'].refresh),
+    ], max_workers)
+
+    return frames
+
+
+if __name__ == '__main__':
+
+    from wb import GspreadAuth, WbIncome, WbSecMaster
+    from SecurityClasses import SecurityUniverse
+    from AccountClasses import AccountGroup
+    from PortfolioClasses import UserPortfolioGroup
+    from config import SECURITYINFO, ACCOUNTINFO
+
+    logging.basicConfig(format='%(levelname)s:%(message)s', level=logging.DEBUG)
+
+    secu  = SecurityUniverse(SECURITYINFO)
+    uport = UserPortfolioGroup(secu, ACCOUNTINFO)
+    ag    = AccountGroup(uport.accounts(), None, None)
+
+    gsauth = GspreadAuth()
+    ForeverIncome = WbIncome(gsauth)
+    SecurityMaster = WbSecMaster(gsauth)
+
+    t0 = time.perf_counter()
+    refresh_all(ForeverIncome, SecurityMaster, secu, ag.positions())
+    print(f"refresh_all took {time.perf_counter()-t0:.2f}s")